@@ -39,6 +39,11 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def token_expires_at(token: str) -> Optional[datetime]:
+    """Expiry of a token that get_current_user has already accepted (for long-lived connections)."""
+    exp = jwt.get_unverified_claims(token).get("exp")
+    return datetime.utcfromtimestamp(exp) if exp is not None else None
+
 async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
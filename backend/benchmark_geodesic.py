@@ -0,0 +1,35 @@
+"""Benchmark scalar haversine loops against the vectorized geodesic matrices."""
+import random
+import time
+
+import numpy as np
+
+import geodesic
+
+
+def scalar_matrix(points):
+    return [[geodesic.haversine_km(a[0], a[1], b[0], b[1]) for b in points] for a in points]
+
+
+def timed(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+if __name__ == "__main__":
+    random.seed(42)
+    print(f"{'n':>6} {'scalar ms':>10} {'f64 ms':>8} {'f32 ms':>8} {'cached ms':>10} {'speedup':>8} {'f32 max err m':>14}")
+    for n in (10, 50, 200, 500, 1000):
+        points = [(12.8 + random.random() * 0.5, 77.4 + random.random() * 0.5) for _ in range(n)]
+        scalar_ms, scalar = timed(lambda: scalar_matrix(points), repeat=1 if n >= 500 else 3)
+        f64_ms, f64 = timed(lambda: geodesic.haversine_matrix(points))
+        f32_ms, f32 = timed(lambda: geodesic.haversine_matrix(points, dtype=np.float32))
+        geodesic.cached_matrix(points)
+        cached_ms, _ = timed(lambda: geodesic.cached_matrix(points))
+        assert np.allclose(f64, np.array(scalar), atol=1e-9)
+        err_m = float(np.max(np.abs(f32.astype(np.float64) - f64))) * 1000
+        print(f"{n:>6} {scalar_ms:>10.2f} {f64_ms:>8.2f} {f32_ms:>8.2f} {cached_ms:>10.3f} {scalar_ms / f64_ms:>7.0f}x {err_m:>14.2f}")
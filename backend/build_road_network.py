@@ -0,0 +1,70 @@
+"""
+Convert an OpenStreetMap XML extract (.osm) into the road graph read by road_network.py.
+
+    python build_road_network.py bengaluru.osm data/bengaluru_roads.json.gz
+
+Keeps drivable highway ways, splits them into edges between consecutive nodes,
+takes speeds from maxspeed (or a default per highway type) and honours oneway tags.
+Nodes not on any kept way are dropped. Export a small .osm from openstreetmap.org
+or cut one from a regional PBF with osmium (osmium extract ... -o area.osm).
+"""
+import gzip
+import json
+import sys
+import xml.etree.ElementTree as ET
+
+import geodesic
+
+# Free-flow speeds (km/h) when a way has no usable maxspeed
+DEFAULT_SPEEDS = {
+    "motorway": 80, "trunk": 60, "primary": 45, "secondary": 35, "tertiary": 30,
+    "motorway_link": 40, "trunk_link": 35, "primary_link": 30, "secondary_link": 25, "tertiary_link": 25,
+    "unclassified": 25, "residential": 20, "living_street": 10, "service": 15,
+}
+
+
+def _speed(tags: dict) -> float:
+    raw = tags.get("maxspeed", "").split(";")[0].strip().lower()
+    try:
+        if raw.endswith("mph"):
+            return float(raw[:-3]) * 1.609
+        return float(raw)
+    except ValueError:
+        return DEFAULT_SPEEDS[tags["highway"]]
+
+
+def convert(osm_path: str) -> dict:
+    coords, ways = {}, []
+    for _, elem in ET.iterparse(osm_path, events=("end",)):
+        if elem.tag == "node":
+            coords[int(elem.get("id"))] = (float(elem.get("lat")), float(elem.get("lon")))
+            elem.clear()
+        elif elem.tag == "way":
+            tags = {t.get("k"): t.get("v") for t in elem.findall("tag")}
+            if tags.get("highway") in DEFAULT_SPEEDS and tags.get("access") not in ("no", "private"):
+                ways.append(([int(nd.get("ref")) for nd in elem.findall("nd")], tags))
+            elem.clear()
+
+    edges, used = [], set()
+    for refs, tags in ways:
+        refs = [r for r in refs if r in coords]
+        oneway = tags.get("oneway") in ("yes", "true", "1", "-1") or tags.get("junction") == "roundabout"
+        if tags.get("oneway") == "-1":
+            refs.reverse()
+        speed = _speed(tags)
+        for a, b in zip(refs, refs[1:]):
+            metres = geodesic.haversine_km(*coords[a], *coords[b]) * 1000
+            edges.append([a, b, round(metres, 1), speed, int(oneway)])
+            used.update((a, b))
+    nodes = [[node_id, round(coords[node_id][0], 7), round(coords[node_id][1], 7)] for node_id in sorted(used)]
+    return {"nodes": nodes, "edges": edges}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    graph = convert(sys.argv[1])
+    opener = gzip.open if sys.argv[2].endswith(".gz") else open
+    with opener(sys.argv[2], "wt", encoding="utf-8") as f:
+        json.dump(graph, f, separators=(",", ":"))
+    print(f"{len(graph['nodes'])} nodes, {len(graph['edges'])} edges -> {sys.argv[2]}")
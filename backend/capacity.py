@@ -0,0 +1,94 @@
+"""
+Atomic vehicle capacity reservation.
+
+Reading current_weight_used / current_volume_used into Python, adding to them and
+committing lets two concurrent dispatchers oversubscribe the same truck. Instead,
+reservations are a single conditional UPDATE:
+
+    UPDATE vehicles
+       SET current_weight_used = current_weight_used + :w, ..., version = version + 1
+     WHERE id = :id AND weight_capacity - current_weight_used >= :w AND ...
+
+which either applies in full or matches no row. Every capacity change bumps
+Vehicle.version so in-memory indexes can tell newer rows from older ones.
+"""
+import os
+from typing import Optional
+
+from sqlalchemy import update, select, case, and_, literal
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+
+MAX_RESERVE_ATTEMPTS = int(os.getenv("DISPATCH_MAX_RESERVE_ATTEMPTS", "5"))
+
+ACTIVE_STATUSES = [models.ShipmentStatus.ASSIGNED, models.ShipmentStatus.PICKED_UP, models.ShipmentStatus.IN_TRANSIT]
+
+
+def _status(value: models.VehicleStatus):
+    return literal(value, models.Vehicle.status.type)
+
+
+async def reserve_capacity(
+    db: AsyncSession, vehicle_id: int, weight: float, volume: float, require_available: bool = True
+) -> Optional[models.Vehicle]:
+    """
+    Atomically add (weight, volume) to the vehicle's load and mark it ON_TRIP.
+    Returns the refreshed vehicle, or None if it no longer has room (or is not
+    AVAILABLE when require_available is set).
+    """
+    V = models.Vehicle
+    weight, volume = weight or 0.0, volume or 0.0
+    stmt = (
+        update(V)
+        .where(
+            V.id == vehicle_id,
+            V.weight_capacity - V.current_weight_used >= weight,
+            V.volume_capacity - V.current_volume_used >= volume,
+        )
+        .values(
+            current_weight_used=V.current_weight_used + weight,
+            current_volume_used=V.current_volume_used + volume,
+            status=_status(models.VehicleStatus.ON_TRIP),
+            version=V.version + 1,
+        )
+        .execution_options(synchronize_session="fetch")
+    )
+    if require_available:
+        stmt = stmt.where(V.status == models.VehicleStatus.AVAILABLE)
+    result = await db.execute(stmt)
+    if result.rowcount != 1:
+        return None
+    return await db.get(V, vehicle_id, populate_existing=True)
+
+
+async def release_capacity(
+    db: AsyncSession, vehicle_id: int, weight: float, volume: float, shipment_id: Optional[int] = None
+) -> Optional[models.Vehicle]:
+    """
+    Atomically take (weight, volume) off the vehicle's load (never below zero) and
+    flip it back to AVAILABLE if it has no other active shipment.
+    """
+    V, S = models.Vehicle, models.Shipment
+    weight, volume = weight or 0.0, volume or 0.0
+    others = select(S.id).where(S.assigned_vehicle_id == V.id, S.status.in_(ACTIVE_STATUSES))
+    if shipment_id is not None:
+        others = others.where(S.id != shipment_id)
+    stmt = (
+        update(V)
+        .where(V.id == vehicle_id)
+        .values(
+            current_weight_used=case((V.current_weight_used > weight, V.current_weight_used - weight), else_=0.0),
+            current_volume_used=case((V.current_volume_used > volume, V.current_volume_used - volume), else_=0.0),
+            status=case(
+                (and_(V.status == models.VehicleStatus.ON_TRIP, ~others.exists()), _status(models.VehicleStatus.AVAILABLE)),
+                else_=V.status,
+            ),
+            version=V.version + 1,
+        )
+        .execution_options(synchronize_session="fetch")
+    )
+    result = await db.execute(stmt)
+    if result.rowcount != 1:
+        return None
+    return await db.get(V, vehicle_id, populate_existing=True)
@@ -0,0 +1,111 @@
+"""
+Batch dispatch solver.
+
+Assigning a set of pending shipments to available vehicles is a two-dimensional
+(weight, volume) bin-packing problem. The solver here is best-fit decreasing with
+zone affinity: shipments are placed largest-first, each into the vehicle in its own
+zone that leaves the least spare capacity, opening a new vehicle only when no
+already-loaded one fits.
+
+Inputs are plain dicts so the solver can run without a database session:
+    shipment: {"id", "weight", "volume", "zone_id"}
+    vehicle:  {"id", "weight_capacity", "volume_capacity", "weight_used", "volume_used", "zone_id"}
+"""
+from typing import Dict, List, Optional
+
+
+def _affinity(shipment_zone: Optional[int], vehicle_zone: Optional[int]) -> int:
+    """0 = same zone, 1 = either side has no zone, 2 = different zone."""
+    if shipment_zone is None or vehicle_zone is None:
+        return 1
+    return 0 if shipment_zone == vehicle_zone else 2
+
+
+def _remaining(vehicle: dict, loads: Dict[int, list]):
+    weight, volume = loads.get(vehicle["id"], (0.0, 0.0))
+    return (
+        (vehicle["weight_capacity"] or 0.0) - (vehicle["weight_used"] or 0.0) - weight,
+        (vehicle["volume_capacity"] or 0.0) - (vehicle["volume_used"] or 0.0) - volume,
+    )
+
+
+def _add_load(loads: Dict[int, list], vehicle_id: int, shipment: dict):
+    load = loads.setdefault(vehicle_id, [0.0, 0.0])
+    load[0] += shipment["weight"] or 0.0
+    load[1] += shipment["volume"] or 0.0
+
+
+def pack_shipments(shipments: List[dict], vehicles: List[dict]) -> Dict[int, int]:
+    """Best-fit decreasing with zone affinity. Returns {shipment_id: vehicle_id}."""
+    if not shipments or not vehicles:
+        return {}
+
+    max_weight = max((v["weight_capacity"] or 0.0) for v in vehicles) or 1.0
+    max_volume = max((v["volume_capacity"] or 0.0) for v in vehicles) or 1.0
+
+    def size(s):
+        return max((s["weight"] or 0.0) / max_weight, (s["volume"] or 0.0) / max_volume)
+
+    loads: Dict[int, list] = {}
+    assignment: Dict[int, int] = {}
+    for s in sorted(shipments, key=size, reverse=True):
+        wt, vol = s["weight"] or 0.0, s["volume"] or 0.0
+        best, best_key = None, None
+        for v in vehicles:
+            rem_w, rem_v = _remaining(v, loads)
+            if rem_w < wt or rem_v < vol:
+                continue
+            slack = (rem_w - wt) / (v["weight_capacity"] or max_weight) + (rem_v - vol) / (v["volume_capacity"] or max_volume)
+            key = (_affinity(s["zone_id"], v["zone_id"]), 0 if v["id"] in loads else 1, slack)
+            if best_key is None or key < best_key:
+                best, best_key = v, key
+        if best is not None:
+            assignment[s["id"]] = best["id"]
+            _add_load(loads, best["id"], s)
+    return assignment
+
+
+def simulate_first_fit(shipments: List[dict], vehicles: List[dict]) -> Dict[int, int]:
+    """
+    Replay what one /shipments/{id}/dispatch call per shipment does: in arrival order,
+    take the first vehicle in the shipment's zone that fits (then any zone). A vehicle
+    leaves the AVAILABLE pool once it has been assigned.
+    """
+    pool = list(vehicles)
+    assignment: Dict[int, int] = {}
+    for s in shipments:
+        wt, vol = s["weight"] or 0.0, s["volume"] or 0.0
+        zoned = [v for v in pool if s["zone_id"] and v["zone_id"] == s["zone_id"]]
+        chosen = None
+        for candidates in (zoned, pool) if zoned else (pool,):
+            for v in candidates:
+                rem_w, rem_v = _remaining(v, {})
+                if rem_w >= wt and rem_v >= vol:
+                    chosen = v
+                    break
+            if chosen:
+                break
+        if chosen:
+            assignment[s["id"]] = chosen["id"]
+            pool.remove(chosen)
+    return assignment
+
+
+def utilization(shipments: List[dict], vehicles: List[dict], assignment: Dict[int, int]) -> dict:
+    """Utilization of the vehicles an assignment actually uses."""
+    by_id = {s["id"]: s for s in shipments}
+    loads: Dict[int, list] = {}
+    for sid, vid in assignment.items():
+        _add_load(loads, vid, by_id[sid])
+    used = [v for v in vehicles if v["id"] in loads]
+    weight_cap = sum(v["weight_capacity"] or 0.0 for v in used)
+    volume_cap = sum(v["volume_capacity"] or 0.0 for v in used)
+    weight_loaded = sum((v["weight_used"] or 0.0) + loads[v["id"]][0] for v in used)
+    volume_loaded = sum((v["volume_used"] or 0.0) + loads[v["id"]][1] for v in used)
+    return {
+        "shipments_assigned": len(assignment),
+        "shipments_unassigned": len(shipments) - len(assignment),
+        "vehicles_used": len(used),
+        "weight_utilization": round(weight_loaded / weight_cap * 100, 1) if weight_cap > 0 else 0,
+        "volume_utilization": round(volume_loaded / volume_cap * 100, 1) if volume_cap > 0 else 0,
+    }
@@ -0,0 +1,139 @@
+"""
+Asynchronous dispatch queue with micro-batching.
+
+POST /shipments/{id}/dispatch with {"queue": true} enqueues a job and returns 202
+with its id instead of dispatching inline. A single background worker waits for
+the first job, keeps collecting for DISPATCH_BATCH_WINDOW_MS (200 ms by default)
+and hands everything it collected, grouped by company, to the batch handler.
+Shipments arriving together are therefore packed jointly against one vehicle
+snapshot per company instead of one per request, which smooths out the load when
+a customer uploads a morning batch. Finished jobs are reported through the
+Notification table and can be polled at GET /dispatch/jobs/{job_id}.
+"""
+import asyncio
+import datetime
+import os
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+WINDOW_SECONDS = int(os.getenv("DISPATCH_BATCH_WINDOW_MS", "200")) / 1000.0
+MAX_BATCH = int(os.getenv("DISPATCH_MAX_BATCH", "500"))
+JOB_HISTORY = int(os.getenv("DISPATCH_JOB_HISTORY", "10000"))
+
+QUEUED, RUNNING, DONE, FAILED = "QUEUED", "RUNNING", "DONE", "FAILED"
+
+
+class DispatchJob:
+    """One queued dispatch of a single shipment."""
+
+    def __init__(self, shipment_id: int, company_id: Optional[int], user_id: int):
+        self.id = uuid.uuid4().hex
+        self.shipment_id = shipment_id
+        self.company_id = company_id
+        self.user_id = user_id
+        self.status = QUEUED
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.created_at = datetime.datetime.utcnow()
+        self.finished_at: Optional[datetime.datetime] = None
+
+    def finish(self, result: Optional[dict] = None, error: Optional[str] = None):
+        self.status = FAILED if error else DONE
+        self.result, self.error = result, error
+        self.finished_at = datetime.datetime.utcnow()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "shipment_id": self.shipment_id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+# Handler: (company_id, jobs) -> None; it must finish() every job it is given
+Handler = Callable[[Optional[int], List[DispatchJob]], Awaitable[None]]
+
+_queue: Optional[asyncio.Queue] = None
+_worker: Optional[asyncio.Task] = None
+_jobs: "OrderedDict[str, DispatchJob]" = OrderedDict()
+_open_by_shipment: Dict[int, DispatchJob] = {}
+
+
+def enqueue(shipment_id: int, company_id: Optional[int], user_id: int) -> DispatchJob:
+    """Queue the shipment for the next batch; a shipment already waiting keeps its job."""
+    if _queue is None:
+        raise RuntimeError("Dispatch queue is not running")
+    job = _open_by_shipment.get(shipment_id)
+    if job is not None:
+        return job
+    job = DispatchJob(shipment_id, company_id, user_id)
+    _jobs[job.id] = job
+    while len(_jobs) > JOB_HISTORY:
+        _jobs.popitem(last=False)
+    _open_by_shipment[shipment_id] = job
+    _queue.put_nowait(job)
+    return job
+
+
+def get_job(job_id: str) -> Optional[DispatchJob]:
+    return _jobs.get(job_id)
+
+
+async def _collect() -> List[DispatchJob]:
+    """Block for the first job, then gather whatever else arrives within the window."""
+    loop = asyncio.get_running_loop()
+    batch = [await _queue.get()]
+    deadline = loop.time() + WINDOW_SECONDS
+    while len(batch) < MAX_BATCH:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+async def _drain(handler: Handler):
+    while True:
+        batch = await _collect()
+        by_company: Dict[Optional[int], List[DispatchJob]] = {}
+        for job in batch:
+            job.status = RUNNING
+            by_company.setdefault(job.company_id, []).append(job)
+        for company_id, jobs in by_company.items():
+            try:
+                await handler(company_id, jobs)
+            except Exception as e:
+                print(f"Dispatch batch for company {company_id} failed: {str(e)}")
+                for job in jobs:
+                    if job.status == RUNNING:
+                        job.finish(error=f"Dispatch failed: {e}")
+            finally:
+                for job in jobs:
+                    _open_by_shipment.pop(job.shipment_id, None)
+
+
+def start(handler: Handler):
+    """Start the background worker (call from the app lifespan)."""
+    global _queue, _worker
+    _queue = asyncio.Queue()
+    _worker = asyncio.create_task(_drain(handler))
+
+
+async def stop():
+    global _queue, _worker
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+    _queue, _worker = None, None
+    _open_by_shipment.clear()
@@ -0,0 +1,95 @@
+"""
+Grid index over vehicle positions for proximity-aware dispatch.
+
+Vehicles are placed in a uniform lat/lng grid at their best known position; the
+live fleet store (fleet_state) keeps one grid per company, placing each vehicle at
+its last GPS fix or, until it reports one, the centroid of its home zone, and moves
+it as location updates arrive. nearest() walks rings of cells outward from the
+pickup point and returns the closest vehicle accepted by the caller, so ranking
+never scans the whole fleet.
+"""
+import heapq
+import math
+import os
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple
+
+import geodesic
+
+CELL_DEG = float(os.getenv("FLEET_GRID_CELL_DEG", "0.05"))  # ~5.5 km of latitude
+KM_PER_DEG = 111.32
+
+
+class PositionGrid:
+    """vehicle_id -> (lat, lng, source) bucketed into CELL_DEG x CELL_DEG cells."""
+
+    def __init__(self, cell_deg: float = CELL_DEG):
+        self.cell_deg = cell_deg
+        self.positions: Dict[int, Tuple[float, float, str]] = {}
+        self._cells: Dict[Tuple[int, int], Set[int]] = {}
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def update(self, vehicle_id: int, lat: float, lng: float, source: str = "live"):
+        self.remove(vehicle_id)
+        self.positions[vehicle_id] = (lat, lng, source)
+        self._cells.setdefault(self._cell(lat, lng), set()).add(vehicle_id)
+
+    def remove(self, vehicle_id: int):
+        old = self.positions.pop(vehicle_id, None)
+        if old is None:
+            return
+        cell = self._cell(old[0], old[1])
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(vehicle_id)
+            if not members:
+                del self._cells[cell]
+
+    def _ring(self, center: Tuple[int, int], r: int) -> Iterator[Tuple[int, int]]:
+        ci, cj = center
+        if r == 0:
+            yield center
+            return
+        for dj in range(-r, r + 1):
+            yield ci - r, cj + dj
+            yield ci + r, cj + dj
+        for di in range(-r + 1, r):
+            yield ci + di, cj - r
+            yield ci + di, cj + r
+
+    def iter_nearest(self, lat: float, lng: float) -> Iterator[Tuple[int, float]]:
+        """Yield (vehicle_id, distance_km) in increasing distance."""
+        if not self._cells:
+            return
+        center = self._cell(lat, lng)
+        max_ring = max(max(abs(i - center[0]), abs(j - center[1])) for i, j in self._cells)
+        # Smallest cell side in km around this latitude bounds how close the next ring can be
+        cell_km = self.cell_deg * KM_PER_DEG * max(math.cos(math.radians(min(abs(lat) + self.cell_deg * max_ring, 89.0))), 0.01)
+        heap = []
+        for r in range(max_ring + 1):
+            ring_ids = [vid for cell in self._ring(center, r) for vid in self._cells.get(cell, ())]
+            if ring_ids:
+                # Whole ring in one vectorized call
+                km = geodesic.haversine_matrix([(lat, lng)], [self.positions[vid][:2] for vid in ring_ids])[0]
+                for vid, dist in zip(ring_ids, km.tolist()):
+                    heapq.heappush(heap, (dist, vid))
+            # Anything in ring r+1 or beyond is at least r * cell_km away
+            bound = r * cell_km
+            while heap and heap[0][0] <= bound:
+                dist, vid = heapq.heappop(heap)
+                yield vid, dist
+        while heap:
+            dist, vid = heapq.heappop(heap)
+            yield vid, dist
+
+    def nearest(self, lat: float, lng: float, accept: Callable[[int], bool] = lambda vid: True) -> Optional[Tuple[int, float]]:
+        """Closest (vehicle_id, distance_km) for which accept(vehicle_id) is true."""
+        for vid, dist in self.iter_nearest(lat, lng):
+            if accept(vid):
+                return vid, dist
+        return None
+
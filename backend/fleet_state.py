@@ -0,0 +1,504 @@
+"""
+Live fleet state: where each vehicle is and what it is doing, held in memory.
+
+Per company the store keeps its vehicles (position, status, load, current trip and
+that trip's next open stop), its active shipments (ASSIGNED, PICKED_UP, IN_TRANSIT;
+a shipment belongs to the company of the vehicle it is assigned to), the open stops
+of its PLANNED/IN_PROGRESS trips and its active zones. A company is loaded from the
+database on first use; after that location pings, shipment transitions and trip
+changes update it in place once their transaction has committed, so the operations
+dashboard and /fleet/live are answered without SQL. Each company also carries the
+dispatch indexes built from the same entries: a PositionGrid (fleet_positions) with
+every vehicle at its last fix or home zone centroid, and a CapacityIndex
+(vehicle_index) of its AVAILABLE vehicles. Single, batch and planned dispatch read
+vehicles from here instead of querying them.
+
+A worker reloads every loaded company each FLEET_STATE_RECONCILE_S seconds to repair
+anything a code path did not report, and counts the entries it had to correct. A
+reload that raced with an update is discarded and retried on the next round.
+Loads overlay the positions still waiting in the location buffer, which are newer
+than the trip rows.
+"""
+import asyncio
+import datetime
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import location_buffer
+import models
+from fleet_positions import PositionGrid
+from vehicle_index import CapacityIndex
+from zone_index import get_zone_index
+
+RECONCILE_S = float(os.getenv("FLEET_STATE_RECONCILE_S", "60"))
+
+ACTIVE_SHIPMENT = (models.ShipmentStatus.ASSIGNED, models.ShipmentStatus.PICKED_UP, models.ShipmentStatus.IN_TRANSIT)
+ACTIVE_TRIP = (models.TripStatus.PLANNED, models.TripStatus.IN_PROGRESS)
+DONE_STOPS = (models.TripStopStatus.COMPLETED.value, models.TripStopStatus.SKIPPED.value)
+
+# Column selects (not entities): rows read like the model objects without touching the session's identity map
+_V, _S, _T, _TS, _Z = models.Vehicle, models.Shipment, models.Trip, models.TripStop, models.Zone
+_VEHICLE_COLUMNS = (_V.id, _V.company_id, _V.name, _V.plate_number, _V.vehicle_type, _V.status, _V.zone_id,
+                    _V.current_driver_id, _V.weight_capacity, _V.volume_capacity, _V.current_weight_used,
+                    _V.current_volume_used, _V.version)
+_SHIPMENT_COLUMNS = (_S.id, _S.tracking_number, _S.status, _S.pickup_address, _S.drop_address, _S.zone_id,
+                     _S.assigned_driver_id, _S.assigned_vehicle_id, _S.total_weight, _S.total_volume, _S.updated_at)
+_STOP_COLUMNS = (_TS.id, _TS.trip_id, _TS.sequence_order, _TS.shipment_id, _TS.stop_type, _TS.status)
+
+
+def _value(enum_value) -> Optional[str]:
+    return enum_value.value if enum_value is not None else None
+
+
+class VehicleState:
+    def __init__(self, vehicle):
+        self.vehicle_id = vehicle.id
+        self.lat: Optional[float] = None
+        self.lng: Optional[float] = None
+        self.position_at: Optional[datetime.datetime] = None
+        self.trip_id: Optional[int] = None
+        self.apply(vehicle)
+
+    def apply(self, vehicle):
+        self.name = vehicle.name
+        self.plate_number = vehicle.plate_number
+        self.vehicle_type = _value(vehicle.vehicle_type)
+        self.status = _value(vehicle.status)
+        self.zone_id = vehicle.zone_id
+        self.driver_id = vehicle.current_driver_id
+        self.weight_capacity = vehicle.weight_capacity or 0.0
+        self.volume_capacity = vehicle.volume_capacity or 0.0
+        self.weight_used = vehicle.current_weight_used or 0.0
+        self.volume_used = vehicle.current_volume_used or 0.0
+        self.version = vehicle.version or 0
+
+    def signature(self) -> tuple:
+        return (self.status, self.zone_id, self.driver_id, self.weight_used, self.volume_used, self.trip_id)
+
+
+class TripState:
+    def __init__(self, trip_id: int, vehicle_id: int, driver_id: int, status: str, stops: Iterable):
+        self.trip_id = trip_id
+        self.vehicle_id = vehicle_id
+        self.driver_id = driver_id
+        self.status = status
+        # stop_id -> [sequence_order, shipment_id, stop_type, status]
+        self.stops: Dict[int, list] = {
+            stop.id: [stop.sequence_order, stop.shipment_id, _value(stop.stop_type), _value(stop.status)]
+            for stop in sorted(stops, key=lambda stop: stop.sequence_order)
+        }
+
+    def active_stop(self) -> Optional[dict]:
+        for stop_id, (sequence_order, shipment_id, stop_type, status) in self.stops.items():
+            if status not in DONE_STOPS:
+                return {"stop_id": stop_id, "sequence_order": sequence_order, "shipment_id": shipment_id,
+                        "stop_type": stop_type, "status": status}
+        return None
+
+    def signature(self) -> tuple:
+        return (self.status, tuple((stop_id, *entry) for stop_id, entry in self.stops.items()))
+
+
+class CompanyFleet:
+    def __init__(self, company_id: Optional[int]):
+        self.company_id = company_id
+        self.vehicles: Dict[int, VehicleState] = {}
+        self.shipments: Dict[int, dict] = {}
+        self.trips: Dict[int, TripState] = {}
+        self.zones: Dict[int, dict] = {}
+        self.zone_centroids: Dict[int, Tuple[float, float]] = {}
+        self.grid = PositionGrid()  # vehicle positions for proximity dispatch
+        self.capacity = CapacityIndex()  # AVAILABLE vehicles by remaining capacity
+        self.revision = 0  # bumped by every update except positions
+        self.loaded_at = datetime.datetime.utcnow()
+
+    def place(self, vehicle: VehicleState):
+        """Put the vehicle in the position grid at its last fix, else its home zone centroid."""
+        if vehicle.lat is not None and vehicle.lng is not None:
+            self.grid.update(vehicle.vehicle_id, vehicle.lat, vehicle.lng, source="live")
+            return
+        home = self.zone_centroids.get(vehicle.zone_id)
+        if home:
+            self.grid.update(vehicle.vehicle_id, home[0], home[1], source="zone")
+        else:
+            self.grid.remove(vehicle.vehicle_id)
+
+    def available(self, with_driver: bool = False) -> List[VehicleState]:
+        """AVAILABLE vehicles (optionally only those with a standing driver), lowest id first."""
+        return sorted(
+            (v for v in self.vehicles.values()
+             if v.status == models.VehicleStatus.AVAILABLE.value and (v.driver_id or not with_driver)),
+            key=lambda v: v.vehicle_id,
+        )
+
+    def pick_trip(self, vehicle_id: int):
+        """A vehicle's current trip: the IN_PROGRESS one, else its latest PLANNED one."""
+        vehicle = self.vehicles.get(vehicle_id)
+        if vehicle is None:
+            return
+        trips = [t for t in self.trips.values() if t.vehicle_id == vehicle_id]
+        trips.sort(key=lambda t: (t.status == models.TripStatus.IN_PROGRESS.value, t.trip_id))
+        vehicle.trip_id = trips[-1].trip_id if trips else None
+
+    def signatures(self) -> dict:
+        sig = {("vehicle", vid): v.signature() for vid, v in self.vehicles.items()}
+        sig.update({("shipment", sid): (s["status"], s["assigned_vehicle_id"], s["assigned_driver_id"])
+                    for sid, s in self.shipments.items()})
+        sig.update({("trip", tid): t.signature() for tid, t in self.trips.items()})
+        return sig
+
+
+def _shipment_entry(shipment) -> dict:
+    return {
+        "id": shipment.id,
+        "tracking_number": shipment.tracking_number,
+        "status": _value(shipment.status),
+        "pickup_address": shipment.pickup_address,
+        "drop_address": shipment.drop_address,
+        "zone_id": shipment.zone_id,
+        "assigned_driver_id": shipment.assigned_driver_id,
+        "assigned_vehicle_id": shipment.assigned_vehicle_id,
+        "total_weight": shipment.total_weight,
+        "total_volume": shipment.total_volume,
+        "updated_at": shipment.updated_at,
+    }
+
+
+_fleets: Dict[Optional[int], CompanyFleet] = {}
+_worker: Optional[asyncio.Task] = None
+_session_factory: Optional[Callable] = None
+
+stats = {
+    "loads": 0, "reconciles": 0, "reconcile_corrections": 0, "reconcile_skipped": 0,
+    "reconcile_failures": 0, "last_reconcile_at": None, "last_reconcile_ms": None,
+}
+
+
+async def _load(db: AsyncSession, company_id: Optional[int]) -> CompanyFleet:
+    fleet = CompanyFleet(company_id)
+    veh_res = await db.execute(select(*_VEHICLE_COLUMNS).where(_V.company_id == company_id).order_by(_V.id))
+    for row in veh_res.all():
+        fleet.vehicles[row.id] = VehicleState(row)
+        fleet.capacity.sync(row)
+
+    # Latest reported position per vehicle, over all of its trips
+    pos_res = await db.execute(
+        select(_T.vehicle_id, _T.current_lat, _T.current_lng, _T.last_location_at)
+        .where(_T.company_id == company_id, _T.current_lat.isnot(None), _T.current_lng.isnot(None))
+        .order_by(_T.last_location_at)
+    )
+    for vehicle_id, lat, lng, at in pos_res.all():
+        vehicle = fleet.vehicles.get(vehicle_id)
+        if vehicle is not None:
+            vehicle.lat, vehicle.lng, vehicle.position_at = lat, lng, at
+
+    trip_res = await db.execute(
+        select(_T.id, _T.vehicle_id, _T.driver_id, _T.status)
+        .where(_T.company_id == company_id, _T.status.in_(ACTIVE_TRIP))
+    )
+    trips = trip_res.all()
+    stops_by_trip: Dict[int, list] = {row.id: [] for row in trips}
+    if trips:
+        stop_res = await db.execute(select(*_STOP_COLUMNS).where(_TS.trip_id.in_(list(stops_by_trip))))
+        for stop in stop_res.all():
+            stops_by_trip[stop.trip_id].append(stop)
+    for row in trips:
+        fleet.trips[row.id] = TripState(row.id, row.vehicle_id, row.driver_id, _value(row.status), stops_by_trip[row.id])
+    for vehicle_id in fleet.vehicles:
+        fleet.pick_trip(vehicle_id)
+
+    ship_res = await db.execute(
+        select(*_SHIPMENT_COLUMNS).join(_V, _S.assigned_vehicle_id == _V.id)
+        .where(_V.company_id == company_id, _S.status.in_(ACTIVE_SHIPMENT))
+    )
+    for row in ship_res.all():
+        fleet.shipments[row.id] = _shipment_entry(row)
+
+    zone_res = await db.execute(
+        select(_Z.id, _Z.name, _Z.color)
+        .where(_Z.company_id == company_id, _Z.status == models.ZoneStatus.ACTIVE).order_by(_Z.id)
+    )
+    for zone_id, name, color in zone_res.all():
+        fleet.zones[zone_id] = {"zone_id": zone_id, "zone_name": name, "color": color}
+    zone_index = await get_zone_index(db, company_id)
+    for zone_id in fleet.zones:
+        centroid = zone_index.centroid(zone_id)
+        if centroid:
+            fleet.zone_centroids[zone_id] = centroid
+
+    # Positions still in the location buffer (read last, so pings during the queries count)
+    for trip_id, (lat, lng, at) in location_buffer.pending_positions().items():
+        active = location_buffer.lookup_trip(trip_id)
+        if active is not None and active.company_id == company_id:
+            vehicle_id = active.vehicle_id
+        elif trip_id in fleet.trips:
+            vehicle_id = fleet.trips[trip_id].vehicle_id
+        else:
+            continue
+        vehicle = fleet.vehicles.get(vehicle_id)
+        if vehicle is not None and (vehicle.position_at is None or at >= vehicle.position_at):
+            vehicle.lat, vehicle.lng, vehicle.position_at = lat, lng, at
+    for vehicle in fleet.vehicles.values():
+        fleet.place(vehicle)
+    stats["loads"] += 1
+    return fleet
+
+
+async def get_fleet(db: AsyncSession, company_id: Optional[int]) -> CompanyFleet:
+    fleet = _fleets.get(company_id)
+    if fleet is None:
+        fleet = await _load(db, company_id)
+        fleet = _fleets.setdefault(company_id, fleet)  # a concurrent first load may have won
+    return fleet
+
+
+def invalidate(company_id: Optional[int]):
+    """Drop the company so it is reloaded on next use (e.g. after zone changes)."""
+    _fleets.pop(company_id, None)
+
+
+def _fleet_of_vehicle(vehicle_id: Optional[int]) -> Optional[CompanyFleet]:
+    if vehicle_id is None:
+        return None
+    return next((fleet for fleet in _fleets.values() if vehicle_id in fleet.vehicles), None)
+
+
+def _fleet_of_trip(trip_id: int) -> Optional[CompanyFleet]:
+    return next((fleet for fleet in _fleets.values() if trip_id in fleet.trips), None)
+
+
+# --- Updates (call after committing) ---
+def sync_vehicle(vehicle: models.Vehicle):
+    fleet = _fleets.get(vehicle.company_id)
+    if fleet is None:
+        return
+    state = fleet.vehicles.get(vehicle.id)
+    if state is None:
+        state = fleet.vehicles[vehicle.id] = VehicleState(vehicle)
+        fleet.pick_trip(vehicle.id)
+    elif (vehicle.version or 0) >= state.version:
+        state.apply(vehicle)
+    fleet.capacity.sync(vehicle)
+    fleet.place(state)
+    fleet.revision += 1
+
+
+def sync_shipment(shipment: models.Shipment):
+    """Track the shipment while it is active on one of a loaded company's vehicles."""
+    for fleet in _fleets.values():
+        if fleet.shipments.pop(shipment.id, None) is not None:
+            fleet.revision += 1
+    if shipment.status not in ACTIVE_SHIPMENT:
+        return
+    fleet = _fleet_of_vehicle(shipment.assigned_vehicle_id)
+    if fleet is not None:
+        fleet.shipments[shipment.id] = _shipment_entry(shipment)
+        fleet.revision += 1
+
+
+def drop_shipments(shipment_ids: Iterable[int]):
+    """Shipments moved out of the active statuses by a bulk UPDATE."""
+    for shipment_id in shipment_ids:
+        for fleet in _fleets.values():
+            if fleet.shipments.pop(shipment_id, None) is not None:
+                fleet.revision += 1
+
+
+def sync_trip(trip: models.Trip, shipments: Iterable[models.Shipment] = ()):
+    """A trip loaded with its stops was created, edited, completed or cancelled."""
+    for shipment in shipments:
+        sync_shipment(shipment)
+    fleet = _fleets.get(trip.company_id)
+    if fleet is None:
+        return
+    if trip.status in ACTIVE_TRIP:
+        fleet.trips[trip.id] = TripState(trip.id, trip.vehicle_id, trip.driver_id, _value(trip.status), trip.stops)
+    else:
+        fleet.trips.pop(trip.id, None)
+    fleet.pick_trip(trip.vehicle_id)
+    fleet.revision += 1
+
+
+def set_stop_status(trip_id: int, stop_id: int, status: models.TripStopStatus):
+    fleet = _fleet_of_trip(trip_id)
+    entry = fleet.trips[trip_id].stops.get(stop_id) if fleet is not None else None
+    if entry is not None:
+        entry[3] = status.value
+        fleet.revision += 1
+
+
+def sync_stops(stops: Iterable[models.TripStop]):
+    for stop in stops:
+        set_stop_status(stop.trip_id, stop.id, stop.status)
+
+
+def record_position(company_id: Optional[int], vehicle_id: int, trip_id: int,
+                    lat: float, lng: float, at: datetime.datetime):
+    """A live GPS fix; it also shows that the trip is IN_PROGRESS."""
+    fleet = _fleets.get(company_id)
+    if fleet is None:
+        return
+    vehicle = fleet.vehicles.get(vehicle_id)
+    if vehicle is not None and (vehicle.position_at is None or at >= vehicle.position_at):
+        vehicle.lat, vehicle.lng, vehicle.position_at = lat, lng, at
+        fleet.place(vehicle)
+    trip = fleet.trips.get(trip_id)
+    if trip is not None and trip.status != models.TripStatus.IN_PROGRESS.value:
+        trip.status = models.TripStatus.IN_PROGRESS.value
+        fleet.pick_trip(vehicle_id)
+        fleet.revision += 1
+
+
+# --- Reads (no SQL) ---
+def vehicle_view(fleet: CompanyFleet, vehicle: VehicleState) -> dict:
+    trip = fleet.trips.get(vehicle.trip_id) if vehicle.trip_id is not None else None
+    return {
+        "vehicle_id": vehicle.vehicle_id,
+        "name": vehicle.name,
+        "plate_number": vehicle.plate_number,
+        "vehicle_type": vehicle.vehicle_type,
+        "status": vehicle.status,
+        "zone_id": vehicle.zone_id,
+        "driver_id": trip.driver_id if trip else vehicle.driver_id,
+        "lat": vehicle.lat,
+        "lng": vehicle.lng,
+        "position_at": vehicle.position_at,
+        "load": {
+            "weight_used": vehicle.weight_used,
+            "weight_capacity": vehicle.weight_capacity,
+            "volume_used": vehicle.volume_used,
+            "volume_capacity": vehicle.volume_capacity,
+            "weight_pct": round(vehicle.weight_used / vehicle.weight_capacity * 100, 1) if vehicle.weight_capacity else 0.0,
+        },
+        "trip_id": vehicle.trip_id,
+        "trip_status": trip.status if trip else None,
+        "active_stop": trip.active_stop() if trip else None,
+    }
+
+
+def vehicles(fleet: CompanyFleet, status: Optional[str] = None, zone_id: Optional[int] = None) -> List[dict]:
+    return [
+        vehicle_view(fleet, v) for v in fleet.vehicles.values()
+        if (status is None or v.status == status) and (zone_id is None or v.zone_id == zone_id)
+    ]
+
+
+def dashboard(fleet: CompanyFleet) -> dict:
+    """The operations dashboard: active shipments, vehicle status counts and zone activity."""
+    epoch = datetime.datetime.min
+    active = sorted(fleet.shipments.values(), key=lambda s: s["updated_at"] or epoch, reverse=True)
+    status_counts: Dict[str, int] = {}
+    vehicles_in_zone: Dict[int, int] = {}
+    for v in fleet.vehicles.values():
+        status_counts[v.status] = status_counts.get(v.status, 0) + 1
+        vehicles_in_zone[v.zone_id] = vehicles_in_zone.get(v.zone_id, 0) + 1
+    shipments_in_zone: Dict[int, int] = {}
+    for s in active:
+        shipments_in_zone[s["zone_id"]] = shipments_in_zone.get(s["zone_id"], 0) + 1
+    return {
+        "active_shipments": [
+            {
+                "id": s["id"],
+                "tracking_number": s["tracking_number"],
+                "status": s["status"],
+                "pickup_address": s["pickup_address"],
+                "drop_address": s["drop_address"],
+                "assigned_driver_id": s["assigned_driver_id"],
+                "assigned_vehicle_id": s["assigned_vehicle_id"],
+                "total_weight": s["total_weight"],
+                "updated_at": str(s["updated_at"]) if s["updated_at"] else None,
+            }
+            for s in active
+        ],
+        "vehicle_status": {
+            "available": status_counts.get(models.VehicleStatus.AVAILABLE.value, 0),
+            "on_trip": status_counts.get(models.VehicleStatus.ON_TRIP.value, 0),
+            "maintenance": status_counts.get(models.VehicleStatus.MAINTENANCE.value, 0),
+        },
+        "zone_activity": [
+            {**zone, "vehicle_count": vehicles_in_zone.get(zone_id, 0),
+             "active_shipments": shipments_in_zone.get(zone_id, 0)}
+            for zone_id, zone in fleet.zones.items()
+        ],
+    }
+
+
+# --- Reconciliation ---
+async def reconcile() -> int:
+    """Reload every loaded company from the database; returns the number of corrected entries."""
+    if _session_factory is None:
+        return 0
+    started = time.monotonic()
+    corrected = 0
+    async with _session_factory() as db:
+        for company_id in list(_fleets):
+            current = _fleets.get(company_id)
+            if current is None:
+                continue
+            revision = current.revision
+            fresh = await _load(db, company_id)
+            if _fleets.get(company_id) is not current or current.revision != revision:
+                stats["reconcile_skipped"] += 1  # updated while loading; try again next round
+                continue
+            for vehicle_id, vehicle in fresh.vehicles.items():
+                live = current.vehicles.get(vehicle_id)
+                if live is not None and live.position_at is not None and (
+                        vehicle.position_at is None or live.position_at > vehicle.position_at):
+                    vehicle.lat, vehicle.lng, vehicle.position_at = live.lat, live.lng, live.position_at
+                    fresh.place(vehicle)
+            old, new = current.signatures(), fresh.signatures()
+            diff = sum(1 for key in old.keys() | new.keys() if old.get(key) != new.get(key))
+            if diff:
+                print(f"Fleet state of company {company_id}: {diff} entries corrected from the database")
+            corrected += diff
+            _fleets[company_id] = fresh
+    stats["reconciles"] += 1
+    stats["reconcile_corrections"] += corrected
+    stats["last_reconcile_at"] = datetime.datetime.utcnow()
+    stats["last_reconcile_ms"] = round((time.monotonic() - started) * 1000, 1)
+    return corrected
+
+
+async def _run():
+    while True:
+        await asyncio.sleep(RECONCILE_S)
+        try:
+            await reconcile()
+        except Exception as e:
+            stats["reconcile_failures"] += 1
+            print(f"Fleet state reconcile failed: {str(e)}")
+
+
+def start(session_factory: Callable):
+    """Start the reconcile worker (call from the app lifespan)."""
+    global _worker, _session_factory
+    _session_factory = session_factory
+    _worker = asyncio.create_task(_run())
+
+
+async def stop():
+    global _worker
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+    _worker = None
+    _fleets.clear()
+
+
+def metrics() -> dict:
+    return {
+        **stats,
+        "companies": len(_fleets),
+        "vehicles": sum(len(f.vehicles) for f in _fleets.values()),
+        "active_shipments": sum(len(f.shipments) for f in _fleets.values()),
+        "active_trips": sum(len(f.trips) for f in _fleets.values()),
+        "reconcile_interval_s": RECONCILE_S,
+        "running": _worker is not None,
+    }
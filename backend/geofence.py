@@ -0,0 +1,142 @@
+"""
+Geofences around the open stops of active trips.
+
+Every open TripStop of a trip that has sent a ping gets a circular fence of
+GEOFENCE_RADIUS_M around its pickup or drop point. Fences sit in a uniform grid of
+GEOFENCE_CELL_DEG cells, so a ping is only compared with the fences of its own trip
+in the 3x3 cells around it plus those it is currently inside: the cost per ping
+does not grow with the number of active trips. Entering a fence is an arrival;
+leaving GEOFENCE_EXIT_RADIUS_M (larger, against GPS jitter) is a departure with
+the dwell time in between.
+
+A trip's fences are loaded on its first ping and dropped by forget_trip() when its
+stops change, so the next ping reloads them (arrivals persisted on TripStop survive).
+Positions older than the last one checked for the trip are ignored: an offline
+backlog uploaded after live pings cannot replay arrivals the live pings have already
+closed. On load the watermark starts at the trip's latest persisted arrival/departure.
+"""
+import datetime
+import math
+import os
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import geodesic
+
+RADIUS_M = float(os.getenv("GEOFENCE_RADIUS_M", "150"))
+EXIT_RADIUS_M = float(os.getenv("GEOFENCE_EXIT_RADIUS_M", "250"))
+MIN_DWELL_S = float(os.getenv("GEOFENCE_MIN_DWELL_S", "60"))
+AUTO_ADVANCE = os.getenv("GEOFENCE_AUTO_ADVANCE", "0") == "1"
+CELL_DEG = float(os.getenv("GEOFENCE_CELL_DEG", "0.01"))  # ~1.1 km, must exceed the exit radius
+
+ARRIVED, DEPARTED = "ARRIVED", "DEPARTED"
+
+
+class Fence:
+    def __init__(self, stop_id: int, trip_id: int, lat: float, lng: float,
+                 arrived_at: Optional[datetime.datetime] = None):
+        self.stop_id = stop_id
+        self.trip_id = trip_id
+        self.lat = lat
+        self.lng = lng
+        self.arrived_at = arrived_at  # set while the vehicle is inside
+
+
+class GeofenceEvent:
+    def __init__(self, kind: str, fence: Fence, at: datetime.datetime, dwell_s: Optional[float] = None):
+        self.kind = kind
+        self.stop_id = fence.stop_id
+        self.trip_id = fence.trip_id
+        self.at = at
+        self.dwell_s = dwell_s
+
+
+class GeofenceIndex:
+    def __init__(self, cell_deg: float = CELL_DEG):
+        self.cell_deg = cell_deg
+        self.fences: Dict[int, Fence] = {}
+        self._cells: Dict[Tuple[int, int], Set[int]] = {}
+        self._by_trip: Dict[int, Set[int]] = {}
+        self._last_at: Dict[int, datetime.datetime] = {}  # newest position checked per trip
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg))
+
+    def loaded(self, trip_id: int) -> bool:
+        return trip_id in self._by_trip
+
+    def load_trip(self, trip_id: int, fences: Iterable[Fence], last_at: Optional[datetime.datetime] = None):
+        self.forget_trip(trip_id)
+        self._by_trip[trip_id] = set()
+        if last_at is not None:
+            self._last_at[trip_id] = last_at
+        for fence in fences:
+            self.fences[fence.stop_id] = fence
+            self._by_trip[trip_id].add(fence.stop_id)
+            self._cells.setdefault(self._cell(fence.lat, fence.lng), set()).add(fence.stop_id)
+
+    def remove(self, stop_id: int):
+        fence = self.fences.pop(stop_id, None)
+        if fence is None:
+            return
+        self._by_trip.get(fence.trip_id, set()).discard(stop_id)
+        cell = self._cell(fence.lat, fence.lng)
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(stop_id)
+            if not members:
+                del self._cells[cell]
+
+    def forget_trip(self, trip_id: int):
+        self._last_at.pop(trip_id, None)
+        for stop_id in list(self._by_trip.pop(trip_id, ())):
+            self.remove(stop_id)
+
+    def check(self, trip_id: int, lat: float, lng: float, at: datetime.datetime) -> List[GeofenceEvent]:
+        """Arrivals and departures of the trip caused by a position at time `at` (none if `at` is out of order)."""
+        own = self._by_trip.get(trip_id)
+        if not own:
+            return []
+        last_at = self._last_at.get(trip_id)
+        if last_at is not None and at < last_at:
+            return []
+        self._last_at[trip_id] = at
+        ci, cj = self._cell(lat, lng)
+        candidates = {stop_id for di in (-1, 0, 1) for dj in (-1, 0, 1)
+                      for stop_id in self._cells.get((ci + di, cj + dj), ()) if stop_id in own}
+        candidates.update(stop_id for stop_id in own if self.fences[stop_id].arrived_at is not None)
+
+        events = []
+        for stop_id in sorted(candidates):
+            fence = self.fences[stop_id]
+            metres = geodesic.haversine_km(lat, lng, fence.lat, fence.lng) * 1000
+            if fence.arrived_at is None and metres <= RADIUS_M:
+                fence.arrived_at = at
+                events.append(GeofenceEvent(ARRIVED, fence, at))
+            elif fence.arrived_at is not None and metres > EXIT_RADIUS_M:
+                dwell_s = max((at - fence.arrived_at).total_seconds(), 0.0)
+                fence.arrived_at = None
+                events.append(GeofenceEvent(DEPARTED, fence, at, dwell_s))
+        return events
+
+
+_index = GeofenceIndex()
+
+
+def loaded(trip_id: int) -> bool:
+    return _index.loaded(trip_id)
+
+
+def load_trip(trip_id: int, fences: Iterable[Fence], last_at: Optional[datetime.datetime] = None):
+    _index.load_trip(trip_id, fences, last_at)
+
+
+def forget_trip(trip_id: int):
+    _index.forget_trip(trip_id)
+
+
+def remove(stop_id: int):
+    _index.remove(stop_id)
+
+
+def check(trip_id: int, lat: float, lng: float, at: datetime.datetime) -> List[GeofenceEvent]:
+    return _index.check(trip_id, lat, lng, at)
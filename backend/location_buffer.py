@@ -0,0 +1,213 @@
+"""
+Write-coalescing buffer for driver GPS pings.
+
+The update-location endpoints acknowledge a ping as soon as it is recorded here.
+Only the latest position per trip is kept; a background worker writes the waiting
+positions to Trip every LOCATION_FLUSH_INTERVAL_MS (or as soon as
+LOCATION_MAX_PENDING trips are waiting) with bulk UPDATEs of up to
+LOCATION_FLUSH_BATCH rows. A failed flush puts its positions back unless a newer
+ping arrived meanwhile; stop() flushes what is left on shutdown.
+
+The trip a ping belongs to is resolved once and remembered while the trip is
+IN_PROGRESS, so steady-state pings touch the database only through the flush.
+Positions waiting here are lost if the process dies: metrics() reports how many
+trips are exposed and how old their positions are.
+"""
+import asyncio
+import datetime
+import os
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from sqlalchemy import bindparam, or_, update
+
+import models
+
+FLUSH_INTERVAL_S = int(os.getenv("LOCATION_FLUSH_INTERVAL_MS", "2000")) / 1000.0
+MAX_PENDING = int(os.getenv("LOCATION_MAX_PENDING", "5000"))
+FLUSH_BATCH = int(os.getenv("LOCATION_FLUSH_BATCH", "500"))
+
+# Core executemany: a trip deleted meanwhile, or holding a newer position, just matches no row
+_trips = models.Trip.__table__
+_UPDATE = (
+    update(_trips)
+    .where(_trips.c.id == bindparam("trip_id"),
+           or_(_trips.c.last_location_at.is_(None), _trips.c.last_location_at <= bindparam("at")))
+    .values(current_lat=bindparam("lat"), current_lng=bindparam("lng"), last_location_at=bindparam("at"))
+)
+
+
+class ActiveTrip:
+    """What a ping needs to know about its trip."""
+
+    def __init__(self, trip: models.Trip):
+        self.trip_id = trip.id
+        self.driver_id = trip.driver_id
+        self.company_id = trip.company_id
+        self.vehicle_id = trip.vehicle_id
+
+
+# trip_id -> (lat, lng, at, monotonic time received)
+_pending: Dict[int, Tuple[float, float, datetime.datetime, float]] = {}
+_flushing: Dict[int, Tuple[float, float, datetime.datetime, float]] = {}  # the batch being written
+_active: Dict[int, ActiveTrip] = {}
+_by_driver: Dict[int, int] = {}
+_last_at: Dict[int, datetime.datetime] = {}  # newest position recorded per trip
+_wake: Optional[asyncio.Event] = None
+_worker: Optional[asyncio.Task] = None
+_session_factory: Optional[Callable] = None
+
+stats = {
+    "pings": 0, "coalesced": 0, "flushes": 0, "rows_written": 0, "flush_failures": 0,
+    "last_flush_at": None, "last_flush_ms": None, "last_flush_lag_s": None, "max_flush_lag_s": 0.0,
+}
+
+
+# --- Trip lookup ---
+def lookup_trip(trip_id: int) -> Optional[ActiveTrip]:
+    return _active.get(trip_id)
+
+
+def lookup_driver(driver_id: int) -> Optional[ActiveTrip]:
+    trip_id = _by_driver.get(driver_id)
+    return _active.get(trip_id) if trip_id is not None else None
+
+
+def remember(trip: models.Trip) -> ActiveTrip:
+    """Resolve future pings of an IN_PROGRESS trip without a query."""
+    active = ActiveTrip(trip)
+    if trip.status == models.TripStatus.IN_PROGRESS:
+        _active[trip.id] = active
+        _by_driver[trip.driver_id] = trip.id
+    return active
+
+
+def forget_trip(trip_id: int):
+    """The trip finished or was cancelled: resolve its next ping from the database."""
+    active = _active.pop(trip_id, None)
+    _last_at.pop(trip_id, None)
+    if active is not None and _by_driver.get(active.driver_id) == trip_id:
+        del _by_driver[active.driver_id]
+
+
+def forget_driver(driver_id: int):
+    """The driver got a new trip: /driver/update-location must pick the latest one again."""
+    _by_driver.pop(driver_id, None)
+
+
+# --- Pings ---
+def record(trip_id: int, lat: float, lng: float, at: Optional[datetime.datetime] = None) -> bool:
+    """Queue the position; False if a newer one was already recorded (late uploaded points)."""
+    at = at or datetime.datetime.utcnow()
+    stats["pings"] += 1
+    if _last_at.get(trip_id, at) > at:
+        return False
+    if trip_id in _pending:
+        stats["coalesced"] += 1
+    _pending[trip_id] = (lat, lng, at, time.monotonic())
+    _last_at[trip_id] = at
+    if len(_pending) >= MAX_PENDING and _wake is not None:
+        _wake.set()
+    return True
+
+
+def pending_positions() -> Dict[int, Tuple[float, float, datetime.datetime]]:
+    """{trip_id: (lat, lng, at)} of every position not yet committed to its trip row."""
+    positions = {trip_id: entry[:3] for trip_id, entry in _flushing.items()}
+    positions.update((trip_id, entry[:3]) for trip_id, entry in _pending.items())
+    return positions
+
+
+def overlay(trip: models.Trip) -> Tuple[Optional[float], Optional[float], Optional[datetime.datetime]]:
+    """
+    (lat, lng, at) of a loaded trip: its buffered position when newer than the row. The
+    trip is not modified, so reading it never makes the session flush an UPDATE.
+    """
+    entry = _pending.get(trip.id) or _flushing.get(trip.id)
+    if entry and (trip.last_location_at is None or entry[2] >= trip.last_location_at):
+        return entry[:3]
+    return trip.current_lat, trip.current_lng, trip.last_location_at
+
+
+async def flush() -> int:
+    """Write every waiting position; returns the number of trips written."""
+    global _pending, _flushing
+    if not _pending or _session_factory is None:
+        return 0
+    batch, _pending = _pending, {}
+    _flushing = batch
+    started = time.monotonic()
+    lag = started - min(entry[3] for entry in batch.values())
+    rows = [{"trip_id": trip_id, "lat": lat, "lng": lng, "at": at}
+            for trip_id, (lat, lng, at, _) in batch.items()]
+    try:
+        async with _session_factory() as db:
+            for i in range(0, len(rows), FLUSH_BATCH):
+                await db.execute(_UPDATE, rows[i:i + FLUSH_BATCH])
+            await db.commit()
+    except BaseException as e:
+        for trip_id, entry in batch.items():
+            _pending.setdefault(trip_id, entry)  # a newer ping wins
+        if not isinstance(e, Exception):
+            raise  # cancelled mid-flush: stop() writes them
+        stats["flush_failures"] += 1
+        print(f"Location flush of {len(rows)} trips failed: {str(e)}")
+        return 0
+    finally:
+        _flushing = {}
+    stats["flushes"] += 1
+    stats["rows_written"] += len(rows)
+    stats["last_flush_at"] = datetime.datetime.utcnow()
+    stats["last_flush_ms"] = round((time.monotonic() - started) * 1000, 1)
+    stats["last_flush_lag_s"] = round(lag, 3)
+    stats["max_flush_lag_s"] = max(stats["max_flush_lag_s"], round(lag, 3))
+    return len(rows)
+
+
+async def _run():
+    while True:
+        try:
+            await asyncio.wait_for(_wake.wait(), FLUSH_INTERVAL_S)
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+        await flush()
+
+
+def start(session_factory: Callable):
+    """Start the flush worker (call from the app lifespan)."""
+    global _wake, _worker, _session_factory
+    _session_factory = session_factory
+    _wake = asyncio.Event()
+    _worker = asyncio.create_task(_run())
+
+
+async def stop():
+    """Stop the worker and write whatever is still waiting."""
+    global _wake, _worker
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+    _wake, _worker = None, None
+    await flush()
+    _active.clear()
+    _by_driver.clear()
+    _last_at.clear()
+
+
+def metrics() -> dict:
+    now = time.monotonic()
+    oldest = min((entry[3] for entry in _pending.values()), default=None)
+    return {
+        **stats,
+        "pending_trips": len(_pending),
+        "oldest_pending_s": round(now - oldest, 3) if oldest is not None else 0.0,
+        "tracked_trips": len(_active),
+        "flush_interval_s": FLUSH_INTERVAL_S,
+        "max_pending": MAX_PENDING,
+        "flush_batch": FLUSH_BATCH,
+        "running": _worker is not None,
+    }
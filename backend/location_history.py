@@ -0,0 +1,320 @@
+"""
+Location history of trips.
+
+Every ping is appended to an open in-memory segment of its trip. A segment is
+sealed when it holds HISTORY_SEGMENT_POINTS points, is HISTORY_SEGMENT_MAX_AGE_S
+old or the day changes, and a background worker writes sealed segments to
+trip_location_segments (one row per segment, indexed by trip and day) every
+HISTORY_FLUSH_INTERVAL_S.
+
+A segment stores its points as varints: the first point absolute, every further
+point as the zigzag delta of its epoch second and of lat/lng in 1e-5 degrees
+(about 1 m), so a ping costs 3-6 bytes instead of three columns of a row.
+Raw segments older than HISTORY_DOWNSAMPLE_AFTER_H are merged per trip and day,
+keeping one point per HISTORY_DOWNSAMPLE_S.
+"""
+import asyncio
+import datetime
+import os
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+
+SEGMENT_POINTS = int(os.getenv("HISTORY_SEGMENT_POINTS", "256"))
+SEGMENT_MAX_AGE_S = float(os.getenv("HISTORY_SEGMENT_MAX_AGE_S", "300"))
+FLUSH_INTERVAL_S = float(os.getenv("HISTORY_FLUSH_INTERVAL_S", "30"))
+DOWNSAMPLE_AFTER_H = float(os.getenv("HISTORY_DOWNSAMPLE_AFTER_H", "24"))
+DOWNSAMPLE_S = int(os.getenv("HISTORY_DOWNSAMPLE_S", "30"))
+COMPACT_INTERVAL_S = float(os.getenv("HISTORY_COMPACT_INTERVAL_S", "3600"))
+BATCH_MAX_POINTS = int(os.getenv("LOCATION_BATCH_MAX_POINTS", "5000"))
+MAX_CLOCK_SKEW_S = int(os.getenv("LOCATION_MAX_CLOCK_SKEW_S", "300"))
+COMPACT_GROUPS = 200  # (trip, day) groups merged per compaction run
+SCALE = 100000
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# (epoch seconds, lat, lng)
+Point = Tuple[int, float, float]
+
+
+# --- Encoding ---
+def _put_varint(buf: bytearray, n: int):
+    n = n * 2 if n >= 0 else -n * 2 - 1  # zigzag
+    while n >= 0x80:
+        buf.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def encode(points: Sequence[Point]) -> bytes:
+    buf = bytearray()
+    prev = (0, 0, 0)
+    for ts, lat, lng in points:
+        cur = (ts, round(lat * SCALE), round(lng * SCALE))
+        for value, base in zip(cur, prev):
+            _put_varint(buf, value - base)
+        prev = cur
+    return bytes(buf)
+
+
+def decode(data: bytes) -> List[Point]:
+    values, n, shift = [], 0, 0
+    for byte in data:
+        n |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(n >> 1 if not n & 1 else -((n + 1) >> 1))
+        n, shift = 0, 0
+    points, ts, lat, lng = [], 0, 0, 0
+    for i in range(0, len(values) - 2, 3):
+        ts, lat, lng = ts + values[i], lat + values[i + 1], lng + values[i + 2]
+        points.append((ts, lat / SCALE, lng / SCALE))
+    return points
+
+
+def to_epoch(at: datetime.datetime) -> int:
+    return int((at - _EPOCH).total_seconds())
+
+
+def from_epoch(ts: int) -> datetime.datetime:
+    return _EPOCH + datetime.timedelta(seconds=ts)
+
+
+def downsample(points: Sequence[Point], interval_s: int) -> List[Point]:
+    """One point per interval (the first in it), always keeping the last point."""
+    kept, next_ts = [], None
+    for point in points:
+        if next_ts is None or point[0] >= next_ts:
+            kept.append(point)
+            next_ts = point[0] + interval_s
+    if points and kept[-1] is not points[-1]:
+        kept.append(points[-1])
+    return kept
+
+
+def decimate(points: Sequence, max_points: int) -> List:
+    """Evenly spaced subset of at most max_points points, keeping both ends."""
+    if len(points) <= max_points:
+        return list(points)
+    if max_points < 2:
+        return [points[-1]]
+    step = (len(points) - 1) / (max_points - 1)
+    return [points[round(i * step)] for i in range(max_points)]
+
+
+# --- Buffering ---
+_open: Dict[int, List[Point]] = {}
+_opened_at: Dict[int, float] = {}
+_sealed: List[Tuple[int, List[Point]]] = []
+_versions: Dict[int, int] = {}  # bumped whenever a trip's history changes
+_worker: Optional[asyncio.Task] = None
+_session_factory: Optional[Callable] = None
+
+stats = {"points": 0, "segments_written": 0, "bytes_written": 0, "flush_failures": 0,
+         "segments_compacted": 0, "last_compact_at": None}
+
+
+def version(trip_id: int) -> int:
+    """Changes whenever points of the trip are added or downsampled (for caches of derived tracks)."""
+    return _versions.get(trip_id, 0)
+
+
+def _bump(trip_id: int):
+    _versions[trip_id] = _versions.get(trip_id, 0) + 1
+
+
+def _seal(trip_id: int):
+    points = _open.pop(trip_id, None)
+    _opened_at.pop(trip_id, None)
+    if points:
+        _sealed.append((trip_id, points))
+
+
+def append(trip_id: int, lat: float, lng: float, at: Optional[datetime.datetime] = None):
+    ts = to_epoch(at or datetime.datetime.utcnow())
+    points = _open.get(trip_id)
+    if points and ts // 86400 != points[0][0] // 86400:
+        _seal(trip_id)  # segments never span days
+        points = None
+    if points is None:
+        points = _open[trip_id] = []
+        _opened_at[trip_id] = time.monotonic()
+    points.append((ts, lat, lng))
+    stats["points"] += 1
+    _bump(trip_id)
+    if len(points) >= SEGMENT_POINTS:
+        _seal(trip_id)
+
+
+def _segment_row(trip_id: int, points: List[Point], resolution_s: int = 0) -> dict:
+    points = sorted(points)
+    start_at = from_epoch(points[0][0])
+    return {
+        "trip_id": trip_id, "day": start_at.date(), "start_at": start_at, "end_at": from_epoch(points[-1][0]),
+        "point_count": len(points), "resolution_s": resolution_s, "data": encode(points),
+    }
+
+
+async def flush(seal_all: bool = False) -> int:
+    """Write the sealed segments (and open ones past their age); returns the number written."""
+    global _sealed
+    now = time.monotonic()
+    for trip_id, opened in list(_opened_at.items()):
+        if seal_all or now - opened >= SEGMENT_MAX_AGE_S:
+            _seal(trip_id)
+    if not _sealed or _session_factory is None:
+        return 0
+    batch, _sealed = _sealed, []
+    rows = [_segment_row(trip_id, points) for trip_id, points in batch]
+    try:
+        async with _session_factory() as db:
+            await db.execute(insert(models.TripLocationSegment), rows)
+            await db.commit()
+    except BaseException as e:
+        _sealed = batch + _sealed
+        if not isinstance(e, Exception):
+            raise
+        stats["flush_failures"] += 1
+        print(f"Location history flush of {len(rows)} segments failed: {str(e)}")
+        return 0
+    stats["segments_written"] += len(rows)
+    stats["bytes_written"] += sum(len(row["data"]) for row in rows)
+    return len(rows)
+
+
+def clean_batch(raw: Sequence[Tuple[float, float, datetime.datetime]],
+                now: Optional[datetime.datetime] = None) -> Tuple[List[Point], int]:
+    """
+    Uploaded (lat, lng, at) points -> (valid points in time order without duplicates,
+    number rejected). Points outside lat/lng bounds or more than MAX_CLOCK_SKEW_S in
+    the future are rejected; of several points in the same second the last one wins.
+    """
+    horizon = to_epoch(now or datetime.datetime.utcnow()) + MAX_CLOCK_SKEW_S
+    by_second: Dict[int, Point] = {}
+    rejected = 0
+    for lat, lng, at in raw:
+        ts = to_epoch(at)
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180) or ts > horizon:
+            rejected += 1
+            continue
+        by_second[ts] = (ts, lat, lng)
+    return [by_second[ts] for ts in sorted(by_second)], rejected
+
+
+async def write(db: AsyncSession, trip_id: int, points: Sequence[Point]) -> int:
+    """
+    Store time-ordered points directly as segments with one INSERT (the caller commits).
+    Seconds already recorded for the trip are skipped, so a re-sent upload is harmless.
+    Returns the number of points written.
+    """
+    if not points:
+        return 0
+    known = {p[0] for p in await track(db, trip_id, from_epoch(points[0][0]), from_epoch(points[-1][0]))}
+    points = [p for p in points if p[0] not in known]
+    rows, run = [], []
+    for point in points:
+        if run and (len(run) >= SEGMENT_POINTS or point[0] // 86400 != run[0][0] // 86400):
+            rows.append(_segment_row(trip_id, run))
+            run = []
+        run.append(point)
+    if run:
+        rows.append(_segment_row(trip_id, run))
+    if rows:
+        await db.execute(insert(models.TripLocationSegment), rows)
+        _bump(trip_id)
+        stats["points"] += len(points)
+        stats["segments_written"] += len(rows)
+        stats["bytes_written"] += sum(len(row["data"]) for row in rows)
+    return len(points)
+
+
+async def compact(db: AsyncSession, now: Optional[datetime.datetime] = None) -> int:
+    """Merge raw segments older than DOWNSAMPLE_AFTER_H into one downsampled segment per trip and day."""
+    now = now or datetime.datetime.utcnow()
+    S = models.TripLocationSegment
+    result = await db.execute(
+        select(S).where(S.resolution_s == 0, S.end_at < now - datetime.timedelta(hours=DOWNSAMPLE_AFTER_H))
+        .order_by(S.trip_id, S.day, S.start_at)
+    )
+    groups: Dict[Tuple[int, datetime.date], List[models.TripLocationSegment]] = {}
+    for segment in result.scalars().all():
+        key = (segment.trip_id, segment.day)
+        if key not in groups and len(groups) >= COMPACT_GROUPS:
+            continue
+        groups.setdefault(key, []).append(segment)
+    if not groups:
+        return 0
+
+    rows, old_ids = [], []
+    for (trip_id, _), segments in groups.items():
+        points = sorted(p for segment in segments for p in decode(segment.data))
+        rows.append(_segment_row(trip_id, downsample(points, DOWNSAMPLE_S), DOWNSAMPLE_S))
+        old_ids.extend(segment.id for segment in segments)
+    await db.execute(delete(S).where(S.id.in_(old_ids)))
+    await db.execute(insert(S), rows)
+    await db.commit()
+    for trip_id, _ in groups:
+        _bump(trip_id)
+    stats["segments_compacted"] += len(old_ids)
+    stats["last_compact_at"] = now
+    return len(old_ids)
+
+
+async def track(db: AsyncSession, trip_id: int, start: Optional[datetime.datetime] = None,
+                end: Optional[datetime.datetime] = None) -> List[Point]:
+    """Stored and still buffered points of the trip between start and end, in time order."""
+    S = models.TripLocationSegment
+    query = select(S.data).where(S.trip_id == trip_id)
+    if start is not None:
+        query = query.where(S.end_at >= start)
+    if end is not None:
+        query = query.where(S.start_at <= end)
+    result = await db.execute(query)
+    points = [p for (data,) in result.all() for p in decode(data)]
+    points.extend(p for tid, seg in _sealed if tid == trip_id for p in seg)
+    points.extend(_open.get(trip_id, ()))
+
+    lo = to_epoch(start) if start is not None else None
+    hi = to_epoch(end) if end is not None else None
+    points = sorted(p for p in points if (lo is None or p[0] >= lo) and (hi is None or p[0] <= hi))
+    return [p for i, p in enumerate(points) if i == 0 or p != points[i - 1]]
+
+
+# --- Worker ---
+async def _run():
+    last_compact = time.monotonic()
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL_S)
+        await flush()
+        if time.monotonic() - last_compact >= COMPACT_INTERVAL_S:
+            last_compact = time.monotonic()
+            try:
+                async with _session_factory() as db:
+                    await compact(db)
+            except Exception as e:
+                print(f"Location history compaction failed: {str(e)}")
+
+
+def start(session_factory: Callable):
+    """Start the flush/compaction worker (call from the app lifespan)."""
+    global _worker, _session_factory
+    _session_factory = session_factory
+    _worker = asyncio.create_task(_run())
+
+
+async def stop():
+    """Stop the worker and write every open segment."""
+    global _worker
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+    _worker = None
+    await flush(seal_all=True)
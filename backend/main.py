@@ -4,20 +4,41 @@ import asyncio
 if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Query
+from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Query, WebSocket
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, delete, or_
+from sqlalchemy import select, func, delete, insert, update, or_
 from sqlalchemy.orm import selectinload, aliased, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from contextlib import asynccontextmanager
+from collections import Counter
 import datetime
-from typing import List, Optional
+from typing import List, Literal, Optional
 
-from database import engine, Base, get_db
+from database import engine, Base, get_db, AsyncSessionLocal
 import models
 import schemas
-from auth import get_current_user, create_access_token, verify_password, get_password_hash, get_current_admin
+from auth import get_current_user, create_access_token, verify_password, get_password_hash, get_current_admin, token_expires_at
+from zone_index import match_zone, rebuild_zone_index
+import dispatch
+import workload
+import vehicle_index
+import capacity
+import dispatch_queue
+import routing
+import planner
+import route_client
+import road_network
+import trip_eta
+import location_buffer
+import location_history
+import tracking_hub
+import geofence
+import track_simplify
+import fleet_state
+import telemetry
 from fastapi.security import OAuth2PasswordRequestForm
 
 # --- Lifecycle ---
@@ -26,7 +47,23 @@ async def lifespan(app: FastAPI):
     # Create tables on startup (Auto-migration for dev)
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSessionLocal() as db:
+        await workload.rebuild_driver_workloads(db)
+    try:
+        await asyncio.to_thread(road_network.load)
+    except Exception as e:
+        print(f"Road network not loaded, using straight-line distances: {e}")
+    dispatch_queue.start(_run_dispatch_jobs)
+    location_buffer.start(AsyncSessionLocal)
+    location_history.start(AsyncSessionLocal)
+    fleet_state.start(AsyncSessionLocal)
     yield
+    await location_buffer.stop()
+    await location_history.stop()
+    await fleet_state.stop()
+    await dispatch_queue.stop()
+    planner.shutdown()
+    await route_client.close()
 
 app = FastAPI(lifespan=lifespan, title="Plant Inbound Logistics")
 
@@ -256,6 +293,8 @@ async def create_driver(req: CreateDriverRequest, db: AsyncSession = Depends(get
         license_number=req.license_number,
     )
     db.add(driver)
+    await db.flush()
+    await workload.ensure_driver_row(db, driver)
     await db.commit()
     await db.refresh(driver)
     return driver
@@ -289,6 +328,9 @@ async def create_user_for_company(req: CreateUserRequest, db: AsyncSession = Dep
         phone=req.phone,
     )
     db.add(new_user)
+    if role_enum == models.UserRole.DRIVER:
+        await db.flush()
+        await workload.ensure_driver_row(db, new_user)
     await db.commit()
     await db.refresh(new_user)
     return new_user
@@ -617,6 +659,9 @@ async def create_user_admin(user: schemas.UserCreate, db: AsyncSession = Depends
         phone=user.phone
     )
     db.add(new_user)
+    if new_user.role == models.UserRole.DRIVER:
+        await db.flush()
+        await workload.ensure_driver_row(db, new_user)
     await db.commit()
     await db.refresh(new_user)
     return new_user
@@ -800,7 +845,6 @@ async def get_audit_logs(
 
 import uuid
 import json
-import math
 
 # --- Helper: Generate Tracking Number ---
 def generate_tracking_number():
@@ -818,22 +862,48 @@ async def add_timeline_entry(db: AsyncSession, shipment_id: int, status, user_id
     )
     db.add(entry)
 
-# --- Helper: Point in Polygon (for zone matching) ---
-def point_in_polygon(lat: float, lng: float, polygon: list) -> bool:
-    """Ray casting algorithm for point-in-polygon test."""
-    if not polygon or len(polygon) < 3:
-        return False
-    n = len(polygon)
-    inside = False
-    j = n - 1
-    for i in range(n):
-        xi, yi = polygon[i][1], polygon[i][0]  # [lng, lat] → lat, lng
-        xj, yj = polygon[j][1], polygon[j][0]
-        if ((yi > lng) != (yj > lng)) and (lat < (xj - xi) * (lng - yi) / (yj - yi) + xi):
-            inside = not inside
-        j = i
-    return inside
-
+# --- Helper: Time Windows ---
+def _utc_naive(value: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    """Timestamps are stored as naive UTC; convert timezone-aware client values."""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+def _check_time_windows(shipment: models.Shipment):
+    for stop in ("pickup", "drop"):
+        start, end = getattr(shipment, f"{stop}_window_start"), getattr(shipment, f"{stop}_window_end")
+        if start and end and start > end:
+            raise HTTPException(400, f"{stop.capitalize()} window ends before it starts")
+    if shipment.service_time_min is not None and shipment.service_time_min < 0:
+        raise HTTPException(400, "Service time cannot be negative")
+
+# --- Helper: Sync Trip Stops with Shipment Status ---
+async def sync_trip_stops(db: AsyncSession, shipment_id: int, status: models.ShipmentStatus):
+    """
+    Mirror a shipment status change on its stops in non-cancelled trips. Trips with
+    pickup+drop stops complete the PICKUP stop on pickup and move the DROP stop along;
+    older trips with a single stop per shipment move that stop.
+    """
+    stop_res = await db.execute(
+        select(models.TripStop).join(models.Trip).where(
+            models.TripStop.shipment_id == shipment_id,
+            models.Trip.status != models.TripStatus.CANCELLED,
+        )
+    )
+    stops = stop_res.scalars().all()
+    has_drop = any(stop.stop_type == models.TripStopType.DROP for stop in stops)
+    now = datetime.datetime.utcnow()
+    for stop in stops:
+        is_pickup = has_drop and stop.stop_type == models.TripStopType.PICKUP
+        if status == models.ShipmentStatus.DELIVERED or (status == models.ShipmentStatus.PICKED_UP and is_pickup):
+            stop.status = models.TripStopStatus.COMPLETED
+            stop.completed_at = stop.completed_at or now
+        elif status in (models.ShipmentStatus.PICKED_UP, models.ShipmentStatus.IN_TRANSIT) and not is_pickup:
+            stop.status = models.TripStopStatus.IN_TRANSIT
+    for trip_id in {stop.trip_id for stop in stops}:
+        trip_eta.invalidate(trip_id)
+        geofence.forget_trip(trip_id)
+    return stops
 
 # ===============================
 # SHIPMENT ENDPOINTS (MSME)
@@ -865,9 +935,16 @@ async def create_shipment(
         total_volume=req.total_volume,
         description=req.description,
         special_instructions=req.special_instructions,
+        pickup_window_start=_utc_naive(req.pickup_window_start),
+        pickup_window_end=_utc_naive(req.pickup_window_end),
+        drop_window_start=_utc_naive(req.drop_window_start),
+        drop_window_end=_utc_naive(req.drop_window_end),
+        service_time_min=req.service_time_min,
         status=models.ShipmentStatus.PENDING,
         po_number=req.po_number,
+        zone_id=await match_zone(db, user.company_id, req.pickup_lat, req.pickup_lng),
     )
+    _check_time_windows(shipment)
     db.add(shipment)
     await db.flush()
 
@@ -1116,7 +1193,8 @@ async def update_shipment(
         raise HTTPException(400, "Can only update pending shipments")
 
     for field, value in req.dict(exclude_unset=True).items():
-        setattr(shipment, field, value)
+        setattr(shipment, field, _utc_naive(value) if field.endswith(("_start", "_end")) else value)
+    _check_time_windows(shipment)
 
     await db.commit()
     result = await db.execute(
@@ -1139,10 +1217,12 @@ async def cancel_shipment(
     if shipment.status not in [models.ShipmentStatus.PENDING, models.ShipmentStatus.ASSIGNED]:
         raise HTTPException(400, "Cannot cancel shipment in current status")
 
+    await workload.record_transition(db, shipment.assigned_driver_id, shipment.status, models.ShipmentStatus.CANCELLED)
     shipment.status = models.ShipmentStatus.CANCELLED
     await add_timeline_entry(db, shipment.id, models.ShipmentStatus.CANCELLED, user.id, "Shipment cancelled")
     await create_audit_log(db, user.id, "SHIPMENT_CANCELLED", "SHIPMENT", shipment.id, f"Shipment {shipment.tracking_number} cancelled")
     await db.commit()
+    fleet_state.sync_shipment(shipment)
     return {"message": "Shipment cancelled"}
 
 
@@ -1174,56 +1254,59 @@ async def auto_dispatch_shipment(
     vehicle_id = req.vehicle_id if req else None
     driver_id = req.driver_id if req else None
 
+    if req and req.queue:
+        if vehicle_id or driver_id:
+            raise HTTPException(400, "Queued dispatch does not take a vehicle or driver override")
+        job = dispatch_queue.enqueue(shipment.id, user.company_id, user.id)
+        return JSONResponse(status_code=202, content={"job_id": job.id, "shipment_id": shipment.id, "status": job.status})
+
     # Step 1: Zone matching (if pickup coordinates available)
-    zone_id = None
-    if shipment.pickup_lat and shipment.pickup_lng:
-        zones_result = await db.execute(
-            select(models.Zone).where(models.Zone.status == models.ZoneStatus.ACTIVE)
-        )
-        zones = zones_result.scalars().all()
-        for zone in zones:
-            if zone.coordinates and point_in_polygon(shipment.pickup_lat, shipment.pickup_lng, zone.coordinates):
-                zone_id = zone.id
-                break
+    zone_id = await match_zone(db, user.company_id, shipment.pickup_lat, shipment.pickup_lng)
 
     # Step 2: Find available vehicle (or use manual override)
+    deadhead_km = None
+    wt = shipment.total_weight or 0.0
+    vol = shipment.total_volume or 0.0
     if vehicle_id:
         veh_result = await db.execute(select(models.Vehicle).where(models.Vehicle.id == vehicle_id))
         vehicle = veh_result.scalars().first()
         if not vehicle:
             raise HTTPException(404, "Vehicle not found")
+        vehicle = await capacity.reserve_capacity(db, vehicle.id, wt, vol, require_available=False)
+        if not vehicle:
+            raise HTTPException(400, "Vehicle capacity exceeded")
     else:
-        # Auto-find vehicle with capacity
-        veh_query = select(models.Vehicle).where(
-            models.Vehicle.status == models.VehicleStatus.AVAILABLE,
-        )
-        if zone_id:
-            veh_query = veh_query.where(models.Vehicle.zone_id == zone_id)
-
-        veh_result = await db.execute(veh_query)
-        vehicles = veh_result.scalars().all()
-
-        # Filter by capacity
+        # Auto-find vehicle with capacity from the capacity-ordered index (zone first, then any zone)
+        policy = (req.policy if req and req.policy else None) or vehicle_index.DEFAULT_POLICY
+        if policy not in vehicle_index.POLICIES:
+            raise HTTPException(400, f"Unknown vehicle policy '{policy}'. Use one of: {', '.join(vehicle_index.POLICIES)}")
+        fleet = await fleet_state.get_fleet(db, user.company_id)
+        index = fleet.capacity
+        positions = None
+        if policy == "nearest" and shipment.pickup_lat is not None and shipment.pickup_lng is not None:
+            positions = fleet.grid
         vehicle = None
-        for v in vehicles:
-            remaining_weight = v.weight_capacity - v.current_weight_used
-            remaining_volume = v.volume_capacity - v.current_volume_used
-            if remaining_weight >= shipment.total_weight and remaining_volume >= shipment.total_volume:
-                vehicle = v
+        for _ in range(capacity.MAX_RESERVE_ATTEMPTS):
+            candidate_id, deadhead_km = None, None
+            if positions is not None:
+                # Closest vehicle (last GPS fix or home zone centroid) that has room for the load
+                nearest = positions.nearest(shipment.pickup_lat, shipment.pickup_lng,
+                                            accept=lambda vid: index.fits(vid, wt, vol))
+                if nearest:
+                    candidate_id, deadhead_km = nearest
+            if candidate_id is None:
+                candidate_id = index.select(wt, vol, policy, zone_id)
+            if candidate_id is None:
                 break
-
-        if not vehicle:
-            # Try vehicles from any zone if zone-specific search failed
-            if zone_id:
-                veh_result = await db.execute(
-                    select(models.Vehicle).where(models.Vehicle.status == models.VehicleStatus.AVAILABLE)
-                )
-                for v in veh_result.scalars().all():
-                    remaining_weight = v.weight_capacity - v.current_weight_used
-                    remaining_volume = v.volume_capacity - v.current_volume_used
-                    if remaining_weight >= shipment.total_weight and remaining_volume >= shipment.total_volume:
-                        vehicle = v
-                        break
+            vehicle = await capacity.reserve_capacity(db, candidate_id, wt, vol)
+            if vehicle:
+                break
+            # Stale entry (taken or deleted by another worker) — resync from the row and pick again
+            candidate = await db.get(models.Vehicle, candidate_id, populate_existing=True)
+            if candidate is None:
+                index.remove(candidate_id)
+            else:
+                fleet_state.sync_vehicle(candidate)
 
         if not vehicle:
             await create_notification(db, user.id, "OVERLOAD", "No Vehicle Available",
@@ -1245,29 +1328,8 @@ async def auto_dispatch_shipment(
         if vehicle.current_driver_id:
             driver_id = vehicle.current_driver_id
         else:
-            # Find any available driver
-            drv_result = await db.execute(
-                select(models.User).where(
-                    models.User.company_id == user.company_id,
-                    models.User.role == models.UserRole.DRIVER
-                )
-            )
-            drivers = drv_result.scalars().all()
-            # Pick first available driver not currently on a trip
-            for d in drivers:
-                active_check = await db.execute(
-                    select(func.count(models.Shipment.id)).where(
-                        models.Shipment.assigned_driver_id == d.id,
-                        models.Shipment.status.in_([
-                            models.ShipmentStatus.ASSIGNED,
-                            models.ShipmentStatus.PICKED_UP,
-                            models.ShipmentStatus.IN_TRANSIT
-                        ])
-                    )
-                )
-                if active_check.scalar() == 0:
-                    driver_id = d.id
-                    break
+            # Find any available driver (no active shipments)
+            driver_id = await workload.pick_idle_driver(db, user.company_id)
 
             if not driver_id:
                 raise HTTPException(400, "No available driver found")
@@ -1279,21 +1341,19 @@ async def auto_dispatch_shipment(
     shipment.status = models.ShipmentStatus.ASSIGNED
     shipment.assigned_at = datetime.datetime.utcnow()
 
-    # Update vehicle capacity usage
-    wt = shipment.total_weight or 0.0
-    vol = shipment.total_volume or 0.0
-    vehicle.current_weight_used += wt
-    vehicle.current_volume_used += vol
-    vehicle.status = models.VehicleStatus.ON_TRIP
+    await workload.record_transition(db, driver_id, models.ShipmentStatus.PENDING, models.ShipmentStatus.ASSIGNED)
 
     await add_timeline_entry(db, shipment.id, models.ShipmentStatus.ASSIGNED, user.id,
                              f"Assigned to vehicle {vehicle.plate_number}")
     await create_notification(db, driver_id, "ASSIGNMENT", "New Shipment Assigned",
                               f"Shipment {shipment.tracking_number} assigned to you")
     await create_audit_log(db, user.id, "SHIPMENT_DISPATCHED", "SHIPMENT", shipment.id,
-                           f"Shipment {shipment.tracking_number} dispatched to vehicle {vehicle.plate_number}")
+                           f"Shipment {shipment.tracking_number} dispatched to vehicle {vehicle.plate_number}"
+                           + (f" ({deadhead_km:.1f} km from pickup)" if deadhead_km is not None else ""))
 
     await db.commit()
+    fleet_state.sync_vehicle(vehicle)
+    fleet_state.sync_shipment(shipment)
 
     result = await db.execute(
         select(models.Shipment).options(selectinload(models.Shipment.items), selectinload(models.Shipment.timeline).joinedload(models.ShipmentTimeline.updated_by), selectinload(models.Shipment.assigned_vehicle), selectinload(models.Shipment.assigned_driver), selectinload(models.Shipment.receipt))
@@ -1302,6 +1362,192 @@ async def auto_dispatch_shipment(
     return result.scalars().first()
 
 
+# --- Helper: Pack and assign a set of PENDING shipments ---
+async def _batch_assign(db: AsyncSession, company_id: Optional[int], shipments: list, dry_run: bool = False,
+                        user_id: Optional[int] = None, requested_by: Optional[dict] = None) -> dict:
+    """
+    Bin-pack shipments onto the company's AVAILABLE vehicles and, unless dry_run, commit the assignment.
+    user_id is the acting user (None for a system action); requested_by maps shipment ids to the user
+    credited on that shipment's timeline instead.
+    """
+    requested_by = requested_by or {}
+    vehicles = (await fleet_state.get_fleet(db, company_id)).available()
+
+    # Only vehicles that can be driven take part (in the packing and in the first-fit
+    # baseline alike): those with a standing driver, then driverless ones while idle
+    # drivers last, lowest ids first
+    drivers_by_vehicle = {v.vehicle_id: v.driver_id for v in vehicles if v.driver_id}
+    driverless = [v.vehicle_id for v in vehicles if v.vehicle_id not in drivers_by_vehicle]
+    if driverless:
+        idle_drivers = await workload.idle_drivers(db, company_id, exclude=drivers_by_vehicle.values())
+        drivers_by_vehicle.update(zip(driverless, idle_drivers))
+    vehicles = [v for v in vehicles if v.vehicle_id in drivers_by_vehicle]
+    vehicles_by_id = {v.vehicle_id: v for v in vehicles}
+
+    ship_rows = [
+        {"id": s.id, "weight": s.total_weight, "volume": s.total_volume, "zone_id": s.zone_id}
+        for s in shipments
+    ]
+    veh_rows = [
+        {"id": v.vehicle_id, "weight_capacity": v.weight_capacity, "volume_capacity": v.volume_capacity,
+         "weight_used": v.weight_used, "volume_used": v.volume_used, "zone_id": v.zone_id}
+        for v in vehicles
+    ]
+    assignment = dispatch.pack_shipments(ship_rows, veh_rows)
+
+    # Reserve each vehicle's whole load atomically; a vehicle taken by a concurrent
+    # dispatch since it was read keeps its shipments PENDING and leaves the baseline too
+    reserved = {}
+    if not dry_run:
+        loads = {}
+        for row in ship_rows:
+            vid = assignment.get(row["id"])
+            if vid:
+                w, v = loads.get(vid, (0.0, 0.0))
+                loads[vid] = (w + (row["weight"] or 0.0), v + (row["volume"] or 0.0))
+        for vid, (w, v) in loads.items():
+            reserved[vid] = await capacity.reserve_capacity(db, vid, w, v)
+            if not reserved[vid]:
+                stale = await db.get(models.Vehicle, vid, populate_existing=True)
+                if stale is not None:
+                    fleet_state.sync_vehicle(stale)
+                assignment = {sid: v_id for sid, v_id in assignment.items() if v_id != vid}
+                veh_rows = [row for row in veh_rows if row["id"] != vid]
+
+    baseline = dispatch.simulate_first_fit(ship_rows, veh_rows)
+    report = {
+        "batch": dispatch.utilization(ship_rows, veh_rows, assignment),
+        "first_fit": dispatch.utilization(ship_rows, veh_rows, baseline),
+    }
+
+    assigned = []
+    now = datetime.datetime.utcnow()
+    driver_counts = {}
+    for s in shipments:
+        vid = assignment.get(s.id)
+        if not vid:
+            continue
+        vehicle = vehicles_by_id[vid]
+        driver_id = drivers_by_vehicle[vid]
+        assigned.append({
+            "shipment_id": s.id,
+            "tracking_number": s.tracking_number,
+            "vehicle_id": vid,
+            "plate_number": vehicle.plate_number,
+            "driver_id": driver_id,
+        })
+        if dry_run:
+            continue
+
+        s.assigned_vehicle_id = vid
+        s.assigned_driver_id = driver_id
+        s.status = models.ShipmentStatus.ASSIGNED
+        s.assigned_at = now
+        await workload.record_transition(db, driver_id, models.ShipmentStatus.PENDING, models.ShipmentStatus.ASSIGNED)
+        await add_timeline_entry(db, s.id, models.ShipmentStatus.ASSIGNED, requested_by.get(s.id, user_id),
+                                 f"Batch dispatched to vehicle {vehicle.plate_number}")
+        driver_counts[driver_id] = driver_counts.get(driver_id, 0) + 1
+
+    if not dry_run and assigned:
+        for driver_id, count in driver_counts.items():
+            await create_notification(db, driver_id, "ASSIGNMENT", "New Shipments Assigned",
+                                      f"{count} shipment(s) assigned to you by batch dispatch")
+        await create_audit_log(db, user_id, "SHIPMENTS_BATCH_DISPATCHED", "SHIPMENT", None,
+                               f"Batch dispatched {len(assigned)} of {len(shipments)} pending shipments "
+                               f"to {report['batch']['vehicles_used']} vehicles")
+        await db.commit()
+        for vid in set(assignment.values()):
+            fleet_state.sync_vehicle(reserved[vid])
+        for s in shipments:
+            if s.id in assignment:
+                fleet_state.sync_shipment(s)
+
+    return {
+        "assigned": assigned,
+        "unassigned": [s.id for s in shipments if s.id not in assignment],
+        "utilization": report,
+    }
+
+
+# --- Helper: Run one micro-batch of queued dispatch jobs ---
+async def _run_dispatch_jobs(company_id: Optional[int], jobs: list):
+    """
+    Dispatch the queued shipments of one company jointly and notify each requester. The
+    batch is a system action; each shipment's timeline credits the user who queued it.
+    """
+    requested_by = {}
+    for job in jobs:
+        requested_by.setdefault(job.shipment_id, job.user_id)
+    async with AsyncSessionLocal() as db:
+        ship_result = await db.execute(
+            select(models.Shipment).where(
+                models.Shipment.id.in_([job.shipment_id for job in jobs]),
+                models.Shipment.status == models.ShipmentStatus.PENDING,
+            ).order_by(models.Shipment.created_at, models.Shipment.id)
+        )
+        shipments = ship_result.scalars().all()
+        pending = {s.id: s for s in shipments}
+        outcome = await _batch_assign(db, company_id, shipments, requested_by=requested_by)
+        assigned = {a["shipment_id"]: a for a in outcome["assigned"]}
+
+        for job in jobs:
+            shipment = pending.get(job.shipment_id)
+            if job.shipment_id in assigned:
+                job.finish(result=assigned[job.shipment_id])
+                await create_notification(db, job.user_id, "ALERT", "Dispatch Complete",
+                                          f"Shipment {shipment.tracking_number} dispatched to vehicle "
+                                          f"{assigned[job.shipment_id]['plate_number']} (job {job.id})")
+            elif shipment is None:
+                job.finish(error="Shipment is no longer pending")
+                await create_notification(db, job.user_id, "ALERT", "Dispatch Skipped",
+                                          f"Shipment #{job.shipment_id} was no longer pending (job {job.id})")
+            else:
+                job.finish(error="No available vehicle with sufficient capacity")
+                await create_notification(db, job.user_id, "OVERLOAD", "No Vehicle Available",
+                                          f"No vehicle with sufficient capacity for shipment {shipment.tracking_number} (job {job.id})")
+        await db.commit()
+
+
+@app.get("/dispatch/jobs/{job_id}")
+async def get_dispatch_job(
+    job_id: str,
+    user: models.User = Depends(get_current_user)
+):
+    """Status of a queued dispatch job."""
+    job = dispatch_queue.get_job(job_id)
+    if not job or job.company_id != user.company_id:
+        raise HTTPException(404, "Dispatch job not found")
+    return job.to_dict()
+
+
+@app.post("/shipments/dispatch-batch")
+async def batch_dispatch_shipments(
+    req: schemas.BatchDispatchRequest = None,
+    db: AsyncSession = Depends(get_db),
+    user: models.User = Depends(get_current_user)
+):
+    """Dispatch every PENDING shipment at once: weight/volume bin-packing with zone affinity."""
+    if user.role != models.UserRole.ADMIN:
+        raise HTTPException(403, "Only admin/fleet manager can dispatch")
+    req = req or schemas.BatchDispatchRequest()
+
+    ship_query = select(models.Shipment).where(
+        models.Shipment.status == models.ShipmentStatus.PENDING,
+        models.Shipment.sender.has(models.User.company_id == user.company_id),
+    )
+    if req.zone_id:
+        ship_query = ship_query.where(models.Shipment.zone_id == req.zone_id)
+    if req.date_from:
+        ship_query = ship_query.where(models.Shipment.created_at >= datetime.datetime.combine(req.date_from, datetime.time.min))
+    if req.date_to:
+        ship_query = ship_query.where(models.Shipment.created_at <= datetime.datetime.combine(req.date_to, datetime.time.max))
+    ship_result = await db.execute(ship_query.order_by(models.Shipment.created_at, models.Shipment.id))
+    shipments = ship_result.scalars().all()
+
+    outcome = await _batch_assign(db, user.company_id, shipments, req.dry_run, user.id)
+    return {"dry_run": req.dry_run, **outcome}
+
+
 @app.post("/shipments/{id}/assign", response_model=schemas.ShipmentResponse)
 async def manual_assign_shipment(
     id: int,
@@ -1330,44 +1576,29 @@ async def manual_assign_shipment(
     if not drv_result.scalars().first():
         raise HTTPException(404, "Driver not found or not in your company")
 
-    # Capacity check (safe handling of None)
     wt = shipment.total_weight or 0.0
     vol = shipment.total_volume or 0.0
-    remaining_weight = vehicle.weight_capacity - vehicle.current_weight_used
-    remaining_volume = vehicle.volume_capacity - vehicle.current_volume_used
-    
-    if remaining_weight < wt or remaining_volume < vol:
-        raise HTTPException(400, f"Vehicle capacity exceeded. Remaining: {remaining_weight}kg / {remaining_volume}m³")
 
-    # If reassignment: restore capacity to old vehicle
+    # If reassignment: restore capacity to old vehicle (AVAILABLE again once it has no other active shipment)
+    old_vehicle = None
     if shipment.assigned_vehicle_id:
-        old_veh_res = await db.execute(select(models.Vehicle).where(models.Vehicle.id == shipment.assigned_vehicle_id))
-        old_vehicle = old_veh_res.scalars().first()
-        if old_vehicle:
-            old_vehicle.current_weight_used = max(0, old_vehicle.current_weight_used - wt)
-            old_vehicle.current_volume_used = max(0, old_vehicle.current_volume_used - vol)
-            # Check if old vehicle becomes empty/available
-            active_count = await db.execute(
-                select(func.count(models.Shipment.id)).where(
-                    models.Shipment.assigned_vehicle_id == old_vehicle.id,
-                    models.Shipment.status.in_([
-                        models.ShipmentStatus.ASSIGNED, models.ShipmentStatus.PICKED_UP, models.ShipmentStatus.IN_TRANSIT
-                    ]),
-                    models.Shipment.id != shipment.id
-                )
-            )
-            if active_count.scalar() == 0:
-                old_vehicle.status = models.VehicleStatus.AVAILABLE
+        old_vehicle = await capacity.release_capacity(db, shipment.assigned_vehicle_id, wt, vol, shipment_id=shipment.id)
+
+    # Capacity check and reservation in one conditional UPDATE
+    reserved = await capacity.reserve_capacity(db, vehicle.id, wt, vol, require_available=False)
+    if not reserved:
+        remaining_weight, remaining_volume = vehicle_index.remaining_capacity(
+            await db.get(models.Vehicle, vehicle.id, populate_existing=True))
+        raise HTTPException(400, f"Vehicle capacity exceeded. Remaining: {remaining_weight}kg / {remaining_volume}m³")
+
+    await workload.record_transition(db, shipment.assigned_driver_id, shipment.status, None)
+    await workload.record_transition(db, req.driver_id, None, models.ShipmentStatus.ASSIGNED)
 
     shipment.assigned_vehicle_id = req.vehicle_id
     shipment.assigned_driver_id = req.driver_id
     shipment.status = models.ShipmentStatus.ASSIGNED
     shipment.assigned_at = datetime.datetime.utcnow()
 
-    vehicle.current_weight_used += wt
-    vehicle.current_volume_used += vol
-    vehicle.status = models.VehicleStatus.ON_TRIP
-
     await add_timeline_entry(db, shipment.id, models.ShipmentStatus.ASSIGNED, user.id, "Manually assigned by admin")
     await create_notification(db, req.driver_id, "ASSIGNMENT", "New Shipment Assigned",
                               f"Shipment {shipment.tracking_number} assigned to you")
@@ -1375,6 +1606,10 @@ async def manual_assign_shipment(
                            f"Shipment {shipment.tracking_number} manually assigned to driver {req.driver_id}")
 
     await db.commit()
+    if old_vehicle:
+        fleet_state.sync_vehicle(old_vehicle)
+    fleet_state.sync_vehicle(vehicle)
+    fleet_state.sync_shipment(shipment)
 
     # Reload with relationships
     result = await db.execute(
@@ -1411,16 +1646,16 @@ async def pickup_shipment(
 
     shipment.status = models.ShipmentStatus.PICKED_UP
     shipment.picked_up_at = datetime.datetime.utcnow()
+    await workload.record_transition(db, user.id, models.ShipmentStatus.ASSIGNED, models.ShipmentStatus.PICKED_UP)
     await add_timeline_entry(db, shipment.id, models.ShipmentStatus.PICKED_UP, user.id, "Picked up by driver")
     await create_audit_log(db, user.id, "SHIPMENT_PICKED_UP", "SHIPMENT", shipment.id, f"Shipment {shipment.tracking_number} picked up")
     
     # Sync with TripStop if exists
-    stop_res = await db.execute(select(models.TripStop).where(models.TripStop.shipment_id == id))
-    stop = stop_res.scalars().first()
-    if stop:
-        stop.status = models.TripStopStatus.IN_TRANSIT
+    stops = await sync_trip_stops(db, shipment.id, models.ShipmentStatus.PICKED_UP)
 
     await db.commit()
+    fleet_state.sync_shipment(shipment)
+    fleet_state.sync_stops(stops)
     result = await db.execute(
         select(models.Shipment).options(selectinload(models.Shipment.items), selectinload(models.Shipment.timeline).joinedload(models.ShipmentTimeline.updated_by), selectinload(models.Shipment.assigned_vehicle), selectinload(models.Shipment.assigned_driver), selectinload(models.Shipment.receipt))
         .where(models.Shipment.id == id)
@@ -1444,16 +1679,16 @@ async def transit_shipment(
 
     shipment.status = models.ShipmentStatus.IN_TRANSIT
     shipment.in_transit_at = datetime.datetime.utcnow()
+    await workload.record_transition(db, user.id, models.ShipmentStatus.PICKED_UP, models.ShipmentStatus.IN_TRANSIT)
     await add_timeline_entry(db, shipment.id, models.ShipmentStatus.IN_TRANSIT, user.id, "In transit")
     await create_audit_log(db, user.id, "SHIPMENT_IN_TRANSIT", "SHIPMENT", shipment.id, f"Shipment {shipment.tracking_number} in transit")
 
     # Sync with TripStop if exists
-    stop_res = await db.execute(select(models.TripStop).where(models.TripStop.shipment_id == id))
-    stop = stop_res.scalars().first()
-    if stop:
-        stop.status = models.TripStopStatus.IN_TRANSIT
+    stops = await sync_trip_stops(db, shipment.id, models.ShipmentStatus.IN_TRANSIT)
 
     await db.commit()
+    fleet_state.sync_shipment(shipment)
+    fleet_state.sync_stops(stops)
     result = await db.execute(
         select(models.Shipment).options(selectinload(models.Shipment.items), selectinload(models.Shipment.timeline).joinedload(models.ShipmentTimeline.updated_by), selectinload(models.Shipment.assigned_vehicle), selectinload(models.Shipment.assigned_driver), selectinload(models.Shipment.receipt))
         .where(models.Shipment.id == id)
@@ -1481,6 +1716,7 @@ async def deliver_shipment(
 
     shipment.status = models.ShipmentStatus.DELIVERED
     shipment.delivered_at = datetime.datetime.utcnow()
+    await workload.record_transition(db, user.id, models.ShipmentStatus.IN_TRANSIT, models.ShipmentStatus.DELIVERED)
 
     # Create delivery receipt
     receipt = models.DeliveryReceipt(
@@ -1496,23 +1732,11 @@ async def deliver_shipment(
     await add_timeline_entry(db, shipment.id, models.ShipmentStatus.DELIVERED, user.id, "Delivered by driver")
 
     # Release vehicle capacity
+    vehicle = None
     if shipment.assigned_vehicle_id:
-        veh_result = await db.execute(select(models.Vehicle).where(models.Vehicle.id == shipment.assigned_vehicle_id))
-        vehicle = veh_result.scalars().first()
-        if vehicle:
-            vehicle.current_weight_used = max(0, vehicle.current_weight_used - shipment.total_weight)
-            vehicle.current_volume_used = max(0, vehicle.current_volume_used - shipment.total_volume)
-            # Check if vehicle has any other active shipments
-            active_count = await db.execute(
-                select(func.count(models.Shipment.id)).where(
-                    models.Shipment.assigned_vehicle_id == vehicle.id,
-                    models.Shipment.status.in_([
-                        models.ShipmentStatus.ASSIGNED, models.ShipmentStatus.PICKED_UP, models.ShipmentStatus.IN_TRANSIT
-                    ])
-                )
-            )
-            if active_count.scalar() <= 1:  # This shipment is becoming delivered
-                vehicle.status = models.VehicleStatus.AVAILABLE
+        # AVAILABLE again once the vehicle has no other active shipment
+        vehicle = await capacity.release_capacity(db, shipment.assigned_vehicle_id,
+                                                  shipment.total_weight, shipment.total_volume, shipment_id=shipment.id)
 
     # Notify sender
     await create_notification(db, shipment.sender_id, "ALERT", "Shipment Delivered",
@@ -1520,21 +1744,28 @@ async def deliver_shipment(
     await create_audit_log(db, user.id, "SHIPMENT_DELIVERED", "SHIPMENT", shipment.id, f"Shipment {shipment.tracking_number} delivered")
 
     # Sync with TripStop if exists
-    stop_res = await db.execute(select(models.TripStop).where(models.TripStop.shipment_id == id))
-    stop = stop_res.scalars().first()
-    if stop:
-        stop.status = models.TripStopStatus.COMPLETED
-        stop.completed_at = datetime.datetime.utcnow()
+    stops = await sync_trip_stops(db, shipment.id, models.ShipmentStatus.DELIVERED)
+    if stops:
         # Check if trip is finished
+        await db.flush()
         trip_res = await db.execute(
-            select(models.Trip).options(selectinload(models.Trip.stops)).where(models.Trip.id == stop.trip_id)
+            select(models.Trip).options(selectinload(models.Trip.stops)).where(models.Trip.id == stops[0].trip_id)
         )
         trip = trip_res.scalars().first()
         if trip and all(s.status == models.TripStopStatus.COMPLETED for s in trip.stops):
             trip.status = models.TripStatus.COMPLETED
             trip.completed_at = datetime.datetime.utcnow()
+            trip_eta.forget(trip.id)
+            geofence.forget_trip(trip.id)
+            location_buffer.forget_trip(trip.id)
 
     await db.commit()
+    if vehicle:
+        fleet_state.sync_vehicle(vehicle)
+    fleet_state.sync_shipment(shipment)
+    fleet_state.sync_stops(stops)
+    if stops and trip:
+        fleet_state.sync_trip(trip)
     result = await db.execute(
         select(models.Shipment).options(selectinload(models.Shipment.items), selectinload(models.Shipment.timeline).joinedload(models.ShipmentTimeline.updated_by), selectinload(models.Shipment.assigned_vehicle), selectinload(models.Shipment.assigned_driver), selectinload(models.Shipment.receipt))
         .where(models.Shipment.id == id)
@@ -1601,16 +1832,9 @@ async def driver_dashboard(
     if user.role != models.UserRole.DRIVER:
         raise HTTPException(403, "Not a driver")
 
-    # Active shipments
-    active_result = await db.execute(
-        select(func.count(models.Shipment.id)).where(
-            models.Shipment.assigned_driver_id == user.id,
-            models.Shipment.status.in_([
-                models.ShipmentStatus.ASSIGNED, models.ShipmentStatus.PICKED_UP, models.ShipmentStatus.IN_TRANSIT
-            ])
-        )
-    )
-    active = active_result.scalar() or 0
+    # Active / completed shipment counts from the workload index
+    load = await workload.get_workload(db, user.id)
+    active = load.active if load else 0
 
     # Completed today
     today_start = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
@@ -1623,14 +1847,7 @@ async def driver_dashboard(
     )
     completed_today = completed_result.scalar() or 0
 
-    # Total completed
-    total_result = await db.execute(
-        select(func.count(models.Shipment.id)).where(
-            models.Shipment.assigned_driver_id == user.id,
-            models.Shipment.status.in_([models.ShipmentStatus.DELIVERED, models.ShipmentStatus.CONFIRMED])
-        )
-    )
-    total_completed = total_result.scalar() or 0
+    total_completed = load.completed if load else 0
 
     # Get assigned vehicle info
     vehicle_info = None
@@ -1693,6 +1910,7 @@ async def create_vehicle(
     db.add(vehicle)
     await db.commit()
     await db.refresh(vehicle)
+    fleet_state.sync_vehicle(vehicle)
     return vehicle
 
 
@@ -1750,9 +1968,11 @@ async def update_vehicle(
              if driver_check.scalars().first():
                  raise HTTPException(400, "Driver is already assigned to another vehicle")
         setattr(vehicle, field, value)
+    vehicle.version = models.Vehicle.version + 1
 
     await db.commit()
     await db.refresh(vehicle)
+    fleet_state.sync_vehicle(vehicle)
     return vehicle
 
 
@@ -1828,6 +2048,8 @@ async def create_zone(
     db.add(zone)
     await db.commit()
     await db.refresh(zone)
+    await rebuild_zone_index(db, zone.company_id)
+    fleet_state.invalidate(zone.company_id)
     return zone
 
 
@@ -1863,6 +2085,8 @@ async def update_zone(
 
     await db.commit()
     await db.refresh(zone)
+    await rebuild_zone_index(db, zone.company_id)
+    fleet_state.invalidate(zone.company_id)
     return zone
 
 
@@ -1880,8 +2104,11 @@ async def delete_zone(
     if not zone:
         raise HTTPException(404, "Zone not found")
 
+    company_id = zone.company_id
     await db.delete(zone)
     await db.commit()
+    await rebuild_zone_index(db, company_id)
+    fleet_state.invalidate(company_id)
     return {"message": "Zone deleted"}
 
 
@@ -2149,35 +2376,18 @@ async def driver_analytics(
         raise HTTPException(403, "Not authorized")
 
     drivers_result = await db.execute(
-        select(models.User).where(
+        select(models.User, models.DriverWorkload)
+        .outerjoin(models.DriverWorkload, models.DriverWorkload.driver_id == models.User.id)
+        .where(
             models.User.company_id == user.company_id,
             models.User.role == models.UserRole.DRIVER
         )
     )
-    drivers = drivers_result.scalars().all()
 
     driver_data = []
-    for driver in drivers:
-        # Total completed
-        total_result = await db.execute(
-            select(func.count(models.Shipment.id)).where(
-                models.Shipment.assigned_driver_id == driver.id,
-                models.Shipment.status.in_([models.ShipmentStatus.DELIVERED, models.ShipmentStatus.CONFIRMED])
-            )
-        )
-        total = total_result.scalar() or 0
-
-        # Active
-        active_result = await db.execute(
-            select(func.count(models.Shipment.id)).where(
-                models.Shipment.assigned_driver_id == driver.id,
-                models.Shipment.status.in_([
-                    models.ShipmentStatus.ASSIGNED, models.ShipmentStatus.PICKED_UP, models.ShipmentStatus.IN_TRANSIT
-                ])
-            )
-        )
-        active = active_result.scalar() or 0
-
+    for driver, load in drivers_result.all():
+        total = load.completed if load else 0
+        active = load.active if load else 0
         driver_data.append({
             "driver_id": driver.id,
             "name": driver.name or driver.email,
@@ -2312,74 +2522,31 @@ async def operations_dashboard(
     db: AsyncSession = Depends(get_db),
     user: models.User = Depends(get_current_user)
 ):
+    """Active shipments, vehicle status counts and zone activity of the company, from the live fleet state."""
     if user.role != models.UserRole.ADMIN:
         raise HTTPException(403, "Not authorized")
+    fleet = await fleet_state.get_fleet(db, user.company_id)
+    return fleet_state.dashboard(fleet)
 
-    # Active shipments as list of objects
-    active_result = await db.execute(
-        select(models.Shipment).where(
-            models.Shipment.status.in_([
-                models.ShipmentStatus.ASSIGNED, models.ShipmentStatus.PICKED_UP, models.ShipmentStatus.IN_TRANSIT
-            ])
-        ).order_by(models.Shipment.updated_at.desc())
-    )
-    active_list = []
-    for s in active_result.scalars().all():
-        active_list.append({
-            "id": s.id,
-            "tracking_number": s.tracking_number,
-            "status": s.status.value if s.status else "PENDING",
-            "pickup_address": s.pickup_address,
-            "drop_address": s.drop_address,
-            "assigned_driver_id": s.assigned_driver_id,
-            "assigned_vehicle_id": s.assigned_vehicle_id,
-            "total_weight": s.total_weight,
-            "updated_at": str(s.updated_at) if s.updated_at else None,
-        })
 
-    # Vehicle status counts
-    available_ct = await db.execute(
-        select(func.count(models.Vehicle.id)).where(models.Vehicle.status == models.VehicleStatus.AVAILABLE)
-    )
-    on_trip_ct = await db.execute(
-        select(func.count(models.Vehicle.id)).where(models.Vehicle.status == models.VehicleStatus.ON_TRIP)
-    )
-    maintenance_ct = await db.execute(
-        select(func.count(models.Vehicle.id)).where(models.Vehicle.status == models.VehicleStatus.MAINTENANCE)
-    )
+@app.get("/fleet/live")
+async def live_fleet(
+    status: Optional[models.VehicleStatus] = None,
+    zone_id: Optional[int] = None,
+    db: AsyncSession = Depends(get_db),
+    user: models.User = Depends(get_current_user)
+):
+    """Every vehicle of the company with its position, status, load, trip and next stop (served from memory)."""
+    if user.role != models.UserRole.ADMIN:
+        raise HTTPException(403, "Not authorized")
+    fleet = await fleet_state.get_fleet(db, user.company_id)
+    return fleet_state.vehicles(fleet, status.value if status else None, zone_id)
 
-    # Zone activity
-    zones_result = await db.execute(select(models.Zone).where(models.Zone.status == models.ZoneStatus.ACTIVE))
-    zone_activity = []
-    for z in zones_result.scalars().all():
-        veh_in_zone = await db.execute(
-            select(func.count(models.Vehicle.id)).where(models.Vehicle.zone_id == z.id)
-        )
-        active_in_zone = await db.execute(
-            select(func.count(models.Shipment.id)).where(
-                models.Shipment.zone_id == z.id,
-                models.Shipment.status.in_([
-                    models.ShipmentStatus.ASSIGNED, models.ShipmentStatus.PICKED_UP, models.ShipmentStatus.IN_TRANSIT
-                ])
-            )
-        )
-        zone_activity.append({
-            "zone_id": z.id,
-            "zone_name": z.name,
-            "color": z.color,
-            "vehicle_count": veh_in_zone.scalar() or 0,
-            "active_shipments": active_in_zone.scalar() or 0,
-        })
 
-    return {
-        "active_shipments": active_list,
-        "vehicle_status": {
-            "available": available_ct.scalar() or 0,
-            "on_trip": on_trip_ct.scalar() or 0,
-            "maintenance": maintenance_ct.scalar() or 0,
-        },
-        "zone_activity": zone_activity,
-    }
+@app.get("/admin/fleet-state")
+async def get_fleet_state_metrics(user: models.User = Depends(get_current_admin)):
+    """Size of the live fleet state and how often reconciliation had to correct it."""
+    return fleet_state.metrics()
 
 
 # ===============================
@@ -2461,81 +2628,100 @@ async def autocomplete_locations(
 # TRIP PLANNING & SCHEDULING (SRS §4.2)
 # ===============================
 
-import math
 import os
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 
-def _haversine_km(lat1, lon1, lat2, lon2):
-    """Straight-line distance in km between two GPS coordinates."""
-    R = 6371.0
-    phi1, phi2 = math.radians(lat1), math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlam = math.radians(lon2 - lon1)
-    a = math.sin(dphi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlam/2)**2
-    return 2 * R * math.asin(math.sqrt(a))
+def _minutes_after(start_at: datetime.datetime, value: Optional[datetime.datetime]) -> Optional[float]:
+    return (value - start_at).total_seconds() / 60 if value is not None else None
 
 
-def _google_route_optimization_or_fallback(shipments_with_coords):
+async def _stop_matrices(points):
     """
-    SRS §4.2: Uses Google Route Optimization API (computeRoutes) for optimal sequence.
-    Provides graceful fallback to Haversine nearest-neighbor if GOOGLE_MAPS_API_KEY is not set.
+    (km, minutes) between stops: routing API distances when configured and reachable,
+    else the offline road network when loaded (both matrices), else straight lines
+    (minutes None: drive time follows from routing.AVG_SPEED_KMH).
     """
-    points = [s for s in shipments_with_coords if s.get('lat') and s.get('lng')]
-    no_coords = [s for s in shipments_with_coords if not (s.get('lat') and s.get('lng'))]
+    km = await route_client.distance_matrix(points)
+    if km is not None:
+        return km, None
+    network = road_network.get()
+    if network is not None and points:
+        return network.matrices(points)
+    return routing.distance_matrix(points), None
 
-    if not points:
-        return shipments_with_coords
 
-    api_key = os.getenv("GOOGLE_MAPS_API_KEY")
-    if api_key and len(points) >= 3:
-        try:
-            import requests
-            url = "https://routes.googleapis.com/directions/v2:computeRoutes"
-            headers = {
-                "Content-Type": "application/json",
-                "X-Goog-Api-Key": api_key,
-                "X-Goog-FieldMask": "routes.optimizedIntermediateWaypointIndex"
-            }
-            payload = {
-                "origin": {"location": {"latLng": {"latitude": points[0]['lat'], "longitude": points[0]['lng']}}},
-                "destination": {"location": {"latLng": {"latitude": points[-1]['lat'], "longitude": points[-1]['lng']}}},
-                "intermediates": [{"location": {"latLng": {"latitude": p['lat'], "longitude": p['lng']}}} for p in points[1:-1]],
-                "optimizeWaypointOrder": True,
-                "travelMode": "DRIVE"
-            }
-            
-            response = requests.post(url, headers=headers, json=payload, timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                if "routes" in data and len(data["routes"]) > 0:
-                    route = data["routes"][0]
-                    if "optimizedIntermediateWaypointIndex" in route:
-                        opt_indices = route["optimizedIntermediateWaypointIndex"]
-                        optimized_intermediates = [points[1 + i] for i in opt_indices]
-                        return [points[0]] + optimized_intermediates + [points[-1]] + no_coords
-        except Exception as e:
-            print(f"Google Routes API error: {str(e)}")
-
-    # Fallback to greedy nearest-neighbor
-    ordered = [points.pop(0)]
-    while points:
-        last = ordered[-1]
-        closest = min(points, key=lambda p: _haversine_km(last['lat'], last['lng'], p['lat'], p['lng']))
-        ordered.append(closest)
-        points.remove(closest)
-
-    return ordered + no_coords
-
-
-def _estimate_leg(lat1, lon1, lat2, lon2):
-    """Return (distance_km, duration_min) for a route leg — assumes 40 km/h avg speed."""
-    if lat1 and lon1 and lat2 and lon2:
-        d = _haversine_km(lat1, lon1, lat2, lon2)
-        return round(d, 2), round(d / 40 * 60, 1)
-    return None, None
+def _leg_minutes(km: float, minutes, prev: int, node: int) -> float:
+    return round(minutes[prev][node] if minutes is not None else km / routing.AVG_SPEED_KMH * 60, 1)
+
+
+def _time_windows(shipments, start_at: datetime.datetime, minutes=None) -> routing.TimeWindows:
+    """Shipment windows and service times as minutes after the trip start (nodes pickup_0, drop_0, ...)."""
+    windows, service = [], []
+    for s in shipments:
+        windows.append((_minutes_after(start_at, s.pickup_window_start), _minutes_after(start_at, s.pickup_window_end)))
+        windows.append((_minutes_after(start_at, s.drop_window_start), _minutes_after(start_at, s.drop_window_end)))
+        service_min = s.service_time_min if s.service_time_min is not None else routing.DEFAULT_SERVICE_MIN
+        service += [service_min, service_min]
+    return routing.TimeWindows(windows, service, minutes=minutes)
+
+
+def _infeasible_detail(e: routing.Infeasible, shipments) -> str:
+    def label(node):
+        return f"shipment {shipments[node // 2].id} {'drop' if node % 2 else 'pickup'}"
+
+    def describe(a, b):
+        if a == b:
+            return f"{label(a)} window is empty"
+        if a // 2 == b // 2:
+            return f"{label(b)} cannot be reached from its pickup in time"
+        return f"{label(a)} and {label(b)} cannot both be served in time"
+    if not e.conflicts:
+        return f"{e}"
+    pairs = [describe(a, b) for a, b in e.conflicts[:5]]
+    more = f" (+{len(e.conflicts) - 5} more)" if len(e.conflicts) > 5 else ""
+    return f"{e}: " + "; ".join(pairs) + more
+
+
+async def _sequence_trip_stops(shipments, vehicle, start_at: datetime.datetime):
+    """
+    Interleave the pickup and drop stops of a trip: every drop after its pickup, the
+    load on board within the vehicle's free capacity and every stop inside its time
+    window (nearest-feasible-stop start, then relocate / 2-opt local search). Uses road
+    distances from the routing API when configured and reachable, straight-line
+    distances otherwise (see _stop_matrices). Shipments missing coordinates go last as
+    pickup+drop pairs with no leg estimate or planned time.
+    Returns ([(shipment, stop_type, distance_km, duration_min, arrival_at, departure_at)],
+    route_report). Raises HTTP 400 when the time windows cannot be met.
+    """
+    routable = [s for s in shipments if s.pickup_lat and s.pickup_lng and s.drop_lat and s.drop_lng]
+    unroutable = [s for s in shipments if s not in routable]
+    points = [pt for s in routable for pt in ((s.pickup_lat, s.pickup_lng), (s.drop_lat, s.drop_lng))]
+    matrix, minutes = await _stop_matrices(points)
+    try:
+        report = routing.sequence_pickup_delivery(
+            [(s.pickup_lat, s.pickup_lng) for s in routable],
+            [(s.drop_lat, s.drop_lng) for s in routable],
+            [(s.total_weight or 0.0, s.total_volume or 0.0) for s in routable],
+            vehicle_index.remaining_capacity(vehicle),
+            matrix=matrix,
+            windows=_time_windows(routable, start_at, minutes),
+        )
+    except routing.Infeasible as e:
+        raise HTTPException(400, _infeasible_detail(e, routable))
+    stops = []
+    nodes = [2 * i + (stop_type == routing.DROP) for i, stop_type in report["stops"]]
+    for k, ((i, stop_type), km, (arrival, departure)) in enumerate(zip(report["stops"], report["legs_km"], report["schedule"])):
+        leg = (round(km, 2), _leg_minutes(km, minutes, nodes[k - 1], nodes[k])) if km is not None else (None, None)
+        planned = (start_at + datetime.timedelta(seconds=round(arrival * 60)),
+                   start_at + datetime.timedelta(seconds=round(departure * 60)))
+        stops.append((routable[i], models.TripStopType(stop_type)) + leg + planned)
+    for s in unroutable:
+        stops.append((s, models.TripStopType.PICKUP, None, None, None, None))
+        stops.append((s, models.TripStopType.DROP, None, None, None, None))
+    return stops, report
 
 
 async def _send_email_notification(to_email: str, subject: str, body: str):
@@ -2570,6 +2756,33 @@ def _generate_trip_number():
     return f"TRIP-{ts}-{random.randint(100, 999)}"
 
 
+# --- Helper: Live ETAs ---
+def _trip_etas(trip: models.Trip, position=None) -> Optional[dict]:
+    """Cached ETAs of an active trip loaded with its stops and shipments, None otherwise."""
+    if trip.status not in (models.TripStatus.PLANNED, models.TripStatus.IN_PROGRESS):
+        return None
+    return trip_eta.cached(trip.id) or trip_eta.compute(trip, trip.stops, position=position)
+
+
+def _attach_etas(trips):
+    """
+    Set eta_completion_at on the trips and eta_at on their stops for TripResponse,
+    showing positions the location buffer has not written yet. Those are set as the
+    loaded state (set_committed_value), so the session has nothing to flush.
+    """
+    for trip in trips:
+        position = location_buffer.overlay(trip)
+        if position[2] != trip.last_location_at:
+            for attr, value in zip(("current_lat", "current_lng", "last_location_at"), position):
+                set_committed_value(trip, attr, value)
+        etas = _trip_etas(trip, position)
+        by_stop = {e["stop_id"]: e["eta_at"] for e in etas["stops"]} if etas else {}
+        trip.eta_completion_at = etas["completion_eta_at"] if etas else None
+        for stop in trip.stops:
+            stop.eta_at = by_stop.get(stop.id)
+    return trips
+
+
 def _load_trip_query():
     return (
         select(models.Trip)
@@ -2589,20 +2802,12 @@ def _load_trip_query():
     )
 
 
-@app.post("/trips", response_model=schemas.TripResponse)
-async def create_trip(
-    req: schemas.TripCreate,
-    db: AsyncSession = Depends(get_db),
-    user: models.User = Depends(get_current_user)
-):
+async def _build_trip(db: AsyncSession, user: models.User, req: schemas.TripCreate):
     """
-    SRS §4.2 — Trip Planning & Scheduling.
-    Admin selects multiple order requests (shipments) and creates a trip.
-    Nearest-neighbor algorithm orders the stops optimally.
-    Notifies each requestor and the assigned driver.
+    Validate and stage one trip (stops, shipment assignment, notifications) without
+    committing. Returns (trip, vehicle, emails); the caller sends the emails with
+    _send_emails() only after its commit, so a rolled-back trip notifies nobody.
     """
-    if user.role != models.UserRole.ADMIN:
-        raise HTTPException(403, "Only admins can create trips")
     if not req.shipment_ids:
         raise HTTPException(400, "At least one shipment is required")
 
@@ -2621,23 +2826,28 @@ async def create_trip(
     if not driver:
         raise HTTPException(404, "Driver not found")
 
-    # Load shipments and validate
+    # Load shipments and validate (one IN query, request order kept, duplicates dropped)
+    shipment_ids = list(dict.fromkeys(req.shipment_ids))
+    s_res = await db.execute(select(models.Shipment).where(models.Shipment.id.in_(shipment_ids)))
+    by_id = {s.id: s for s in s_res.scalars().all()}
     shipments = []
-    for sid in req.shipment_ids:
-        s_res = await db.execute(select(models.Shipment).where(models.Shipment.id == sid))
-        s = s_res.scalars().first()
+    for sid in shipment_ids:
+        s = by_id.get(sid)
         if not s:
             raise HTTPException(404, f"Shipment {sid} not found")
         if s.status != models.ShipmentStatus.PENDING:
             raise HTTPException(400, f"Shipment {sid} is not PENDING (status: {s.status.value})")
         shipments.append(s)
 
-    # === ROUTE OPTIMIZATION — Google Area & Nearest-Neighbor Algorithm ===
-    coords_list = [
-        {"id": s.id, "lat": s.pickup_lat, "lng": s.pickup_lng, "shipment": s}
-        for s in shipments
-    ]
-    ordered = _google_route_optimization_or_fallback(coords_list)
+    # Every shipment must fit the vehicle on its own
+    free_w, free_v = vehicle_index.remaining_capacity(vehicle)
+    for s in shipments:
+        if (s.total_weight or 0.0) > free_w or (s.total_volume or 0.0) > free_v:
+            raise HTTPException(400, f"Shipment {s.id} exceeds vehicle capacity. Remaining: {free_w}kg / {free_v}m³")
+
+    # === ROUTE OPTIMIZATION — pickup & delivery sequencing with time windows ===
+    start_at = _utc_naive(req.start_at) or datetime.datetime.utcnow()
+    ordered, route_report = await _sequence_trip_stops(shipments, vehicle, start_at)
 
     # Create Trip
     trip = models.Trip(
@@ -2647,81 +2857,90 @@ async def create_trip(
         created_by_id=user.id,
         company_id=user.company_id,
         status=models.TripStatus.PLANNED,
+        planned_start_at=start_at,
     )
     db.add(trip)
     await db.flush()
 
-    # Create TripStops in optimized sequence and update shipment status
-    total_dist = 0.0
-    total_dur = 0.0
-    prev_lat, prev_lng = None, None
-
-    notified_senders = set()
-    for seq, item in enumerate(ordered, start=1):
-        s = item["shipment"]
-        dist, dur = _estimate_leg(prev_lat, prev_lng, s.pickup_lat, s.pickup_lng)
-        total_dist += dist or 0.0
-        total_dur += dur or 0.0
-
-        stop = models.TripStop(
-            trip_id=trip.id,
-            shipment_id=s.id,
-            sequence_order=seq,
-            estimated_distance_km=dist,
-            estimated_duration_min=dur,
-            status=models.TripStopStatus.PENDING,
-        )
-        db.add(stop)
-
-        # Mark shipment as ASSIGNED
-        s.status = models.ShipmentStatus.ASSIGNED
-        s.assigned_vehicle_id = req.vehicle_id
-        s.assigned_driver_id = req.driver_id
-        s.assigned_at = datetime.datetime.utcnow()
-
-        await add_timeline_entry(db, s.id, models.ShipmentStatus.ASSIGNED, user.id,
-                                 f"Assigned to trip {trip.trip_number} (stop #{seq})")
-
-        # Notify sender (once per sender)
-        if s.sender_id not in notified_senders:
-            await create_notification(
-                db, s.sender_id, "ASSIGNMENT",
-                f"Your order has been scheduled",
-                f"Shipment {s.tracking_number} is scheduled in trip {trip.trip_number}. "
-                f"Driver: {driver.name or driver.email}"
-            )
-            notified_senders.add(s.sender_id)
-
-            # Email notification (graceful skip if SMTP not configured)
-            sender_res = await db.execute(select(models.User).where(models.User.id == s.sender_id))
-            sender = sender_res.scalars().first()
-            if sender:
-                await _send_email_notification(
-                    sender.email,
-                    f"[Logistics] Your request has been scheduled — {s.tracking_number}",
-                    f"Dear {sender.name or 'User'},\n\n"
-                    f"Your logistics request (Tracking: {s.tracking_number}) has been scheduled.\n"
-                    f"Trip: {trip.trip_number}\n"
-                    f"Vehicle: {vehicle.name} ({vehicle.plate_number})\n"
-                    f"Driver: {driver.name or driver.email}\n\n"
-                    f"You can track your shipment in the portal.\n\nThank you."
-                )
+    # Create TripStops in optimized sequence (one multi-row INSERT)
+    stop_rows = []
+    pickup_seq = {}
+    for seq, (s, stop_type, dist, dur, arrival_at, departure_at) in enumerate(ordered, start=1):
+        stop_rows.append({
+            "trip_id": trip.id, "shipment_id": s.id, "sequence_order": seq, "stop_type": stop_type,
+            "estimated_distance_km": dist, "estimated_duration_min": dur, "status": models.TripStopStatus.PENDING,
+            "planned_arrival_at": arrival_at, "planned_departure_at": departure_at,
+        })
+        if stop_type == models.TripStopType.PICKUP:
+            pickup_seq[s.id] = seq
+    await db.execute(insert(models.TripStop), stop_rows)
+    total_dist = sum(row["estimated_distance_km"] or 0.0 for row in stop_rows)
+    # Planned duration includes waiting for windows and service at the stops
+    total_dur = route_report["schedule"][-1][1] if route_report["schedule"] else 0.0
+
+    # Mark all shipments ASSIGNED with one UPDATE; the PENDING guard catches a concurrent assignment
+    now = datetime.datetime.utcnow()
+    assigned = await db.execute(
+        update(models.Shipment)
+        .where(models.Shipment.id.in_(shipment_ids), models.Shipment.status == models.ShipmentStatus.PENDING)
+        .values(status=models.ShipmentStatus.ASSIGNED, assigned_vehicle_id=req.vehicle_id,
+                assigned_driver_id=req.driver_id, assigned_at=now)
+        .execution_options(synchronize_session="evaluate")
+    )
+    if assigned.rowcount != len(shipments):
+        raise HTTPException(409, "Some shipments were assigned by another request; reload and retry")
+    await workload.record_transition(db, req.driver_id, models.ShipmentStatus.PENDING,
+                                     models.ShipmentStatus.ASSIGNED, count=len(shipments))
+    await db.execute(insert(models.ShipmentTimeline), [
+        {"shipment_id": s.id, "status": models.ShipmentStatus.ASSIGNED, "updated_by_id": user.id,
+         "notes": f"Assigned to trip {trip.trip_number} (stop #{pickup_seq[s.id]})", "timestamp": now}
+        for s in shipments
+    ])
 
-        prev_lat, prev_lng = s.drop_lat, s.drop_lng
+    # Notify each sender once (senders loaded with one IN query)
+    first_by_sender = {}
+    for s in shipments:
+        first_by_sender.setdefault(s.sender_id, s)
+    sender_res = await db.execute(select(models.User).where(models.User.id.in_(list(first_by_sender))))
+    senders = {u.id: u for u in sender_res.scalars().all()}
+    driver_label = driver.name or driver.email
+    notifications = [
+        {"user_id": sender_id, "type": "ASSIGNMENT", "title": "Your order has been scheduled",
+         "message": f"Shipment {s.tracking_number} is scheduled in trip {trip.trip_number}. Driver: {driver_label}",
+         "created_at": now}
+        for sender_id, s in first_by_sender.items()
+    ]
 
     # Update trip metrics and vehicle status
     trip.total_distance_km = round(total_dist, 2)
     trip.total_duration_min = round(total_dur, 1)
     vehicle.status = models.VehicleStatus.ON_TRIP
 
-    # Notify driver
-    await create_notification(
-        db, req.driver_id, "ASSIGNMENT",
-        "New Trip Assigned",
-        f"Trip {trip.trip_number} assigned to you with {len(ordered)} stops. "
-        f"Vehicle: {vehicle.name} ({vehicle.plate_number})"
-    )
-    await _send_email_notification(
+    # Notify driver, then write all notifications in one INSERT
+    notifications.append({
+        "user_id": req.driver_id, "type": "ASSIGNMENT", "title": "New Trip Assigned",
+        "message": f"Trip {trip.trip_number} assigned to you with {len(ordered)} stops ({len(shipments)} shipments). "
+                   f"Vehicle: {vehicle.name} ({vehicle.plate_number})",
+        "created_at": now,
+    })
+    await db.execute(insert(models.Notification), notifications)
+
+    # Email notifications, sent by the caller after commit (graceful skip if SMTP not configured)
+    emails = []
+    for sender_id, s in first_by_sender.items():
+        sender = senders.get(sender_id)
+        if sender:
+            emails.append((
+                sender.email,
+                f"[Logistics] Your request has been scheduled — {s.tracking_number}",
+                f"Dear {sender.name or 'User'},\n\n"
+                f"Your logistics request (Tracking: {s.tracking_number}) has been scheduled.\n"
+                f"Trip: {trip.trip_number}\n"
+                f"Vehicle: {vehicle.name} ({vehicle.plate_number})\n"
+                f"Driver: {driver_label}\n\n"
+                f"You can track your shipment in the portal.\n\nThank you."
+            ))
+    emails.append((
         driver.email,
         f"[Logistics] New Trip Assigned — {trip.trip_number}",
         f"Dear {driver.name or 'Driver'},\n\n"
@@ -2730,14 +2949,126 @@ async def create_trip(
         f"Vehicle: {vehicle.name} ({vehicle.plate_number})\n"
         f"Estimated Distance: {round(total_dist, 2)} km\n\n"
         f"Please check the app for your tripsheet.\n\nThank you."
-    )
+    ))
 
     await create_audit_log(db, user.id, "TRIP_CREATED", "TRIP", trip.id,
-                           f"Trip {trip.trip_number} created with {len(ordered)} stops")
+                           f"Trip {trip.trip_number} created with {len(ordered)} stops "
+                           f"(stop order {route_report['improvement_pct']}% shorter than nearest-neighbour)")
+    return trip, vehicle, emails
+
+
+async def _send_emails(emails):
+    for to_email, subject, body in emails:
+        await _send_email_notification(to_email, subject, body)
+
+
+@app.post("/trips", response_model=schemas.TripResponse)
+async def create_trip(
+    req: schemas.TripCreate,
+    db: AsyncSession = Depends(get_db),
+    user: models.User = Depends(get_current_user)
+):
+    """
+    SRS §4.2 — Trip Planning & Scheduling.
+    Admin selects multiple order requests (shipments) and creates a trip.
+    Each shipment gets a pickup and a drop stop, sequenced under precedence and capacity.
+    Notifies each requestor and the assigned driver.
+    """
+    if user.role != models.UserRole.ADMIN:
+        raise HTTPException(403, "Only admins can create trips")
+    trip, vehicle, emails = await _build_trip(db, user, req)
     await db.commit()
+    await _send_emails(emails)
+    fleet_state.sync_vehicle(vehicle)
+    location_buffer.forget_driver(trip.driver_id)
 
     result = await db.execute(_load_trip_query().where(models.Trip.id == trip.id))
-    return result.scalars().first()
+    trip = result.scalars().first()
+    fleet_state.sync_trip(trip, [stop.shipment for stop in trip.stops])
+    return _attach_etas([trip])[0]
+
+
+@app.post("/trips/plan")
+async def plan_trips(
+    req: schemas.TripPlanRequest = None,
+    db: AsyncSession = Depends(get_db),
+    user: models.User = Depends(get_current_user)
+):
+    """
+    Propose trips for the PENDING backlog across all AVAILABLE vehicles that have a driver
+    (capacitated routing, solved in a worker process). Nothing is saved; send the
+    proposed trips to POST /trips/plan/commit to create them.
+    """
+    if user.role != models.UserRole.ADMIN:
+        raise HTTPException(403, "Only admins can plan trips")
+    req = req or schemas.TripPlanRequest()
+
+    ship_query = select(models.Shipment).where(
+        models.Shipment.status == models.ShipmentStatus.PENDING,
+        models.Shipment.sender.has(models.User.company_id == user.company_id),
+    )
+    if req.zone_id:
+        ship_query = ship_query.where(models.Shipment.zone_id == req.zone_id)
+    ship_result = await db.execute(ship_query.order_by(models.Shipment.created_at, models.Shipment.id))
+    shipments = ship_result.scalars().all()
+
+    fleet = await fleet_state.get_fleet(db, user.company_id)
+    vehicles = fleet.available(with_driver=True)
+
+    routable = [s for s in shipments if s.pickup_lat and s.pickup_lng and s.drop_lat and s.drop_lng]
+    ship_rows = [
+        {"id": s.id, "pickup": (s.pickup_lat, s.pickup_lng), "drop": (s.drop_lat, s.drop_lng),
+         "weight": s.total_weight or 0.0, "volume": s.total_volume or 0.0}
+        for s in routable
+    ]
+    veh_rows = []
+    for v in vehicles:
+        position = fleet.grid.positions.get(v.vehicle_id)
+        veh_rows.append({"id": v.vehicle_id, "driver_id": v.driver_id,
+                         "weight_free": v.weight_capacity - v.weight_used,
+                         "volume_free": v.volume_capacity - v.volume_used,
+                         "position": position[:2] if position else None})
+
+    plan = await planner.plan_in_worker(ship_rows, veh_rows, req.time_budget_ms)
+
+    by_id = {s.id: s for s in shipments}
+    plates = {v.vehicle_id: v.plate_number for v in vehicles}
+    for trip in plan["trips"]:
+        trip["plate_number"] = plates[trip["vehicle_id"]]
+        trip["tracking_numbers"] = [by_id[sid].tracking_number for sid in trip["shipment_ids"]]
+    plan["unassigned"] += [s.id for s in shipments if s not in routable]
+    plan["missing_coordinates"] = [s.id for s in shipments if s not in routable]
+    return plan
+
+
+@app.post("/trips/plan/commit", response_model=List[schemas.TripResponse])
+async def commit_trip_plan(
+    req: schemas.TripPlanCommit,
+    db: AsyncSession = Depends(get_db),
+    user: models.User = Depends(get_current_user)
+):
+    """Create every trip of a plan in one transaction (all or nothing)."""
+    if user.role != models.UserRole.ADMIN:
+        raise HTTPException(403, "Only admins can create trips")
+    if not req.trips:
+        raise HTTPException(400, "At least one trip is required")
+    for field in ("vehicle_id", "driver_id"):
+        values = [getattr(t, field) for t in req.trips]
+        if len(set(values)) != len(values):
+            raise HTTPException(400, f"Each trip needs a different {field.replace('_id', '')}")
+
+    built = [await _build_trip(db, user, trip_req) for trip_req in req.trips]
+    await db.commit()
+    for trip, vehicle, emails in built:
+        await _send_emails(emails)
+        fleet_state.sync_vehicle(vehicle)
+        location_buffer.forget_driver(trip.driver_id)
+
+    result = await db.execute(_load_trip_query().where(models.Trip.id.in_([trip.id for trip, _, _ in built])))
+    trips = {trip.id: trip for trip in result.scalars().all()}
+    for trip in trips.values():
+        fleet_state.sync_trip(trip, [stop.shipment for stop in trip.stops])
+    return _attach_etas([trips[trip.id] for trip, _, _ in built])
 
 
 @app.get("/trips", response_model=List[schemas.TripResponse])
@@ -2755,7 +3086,7 @@ async def list_trips(
         raise HTTPException(403, "Not authorized")
     query = query.order_by(models.Trip.created_at.desc())
     result = await db.execute(query)
-    return result.scalars().all()
+    return _attach_etas(result.scalars().all())
 
 
 @app.get("/trips/{id}", response_model=schemas.TripResponse)
@@ -2770,36 +3101,227 @@ async def get_trip(
         raise HTTPException(404, "Trip not found")
     if user.role == models.UserRole.DRIVER and trip.driver_id != user.id:
         raise HTTPException(403, "Not your trip")
+    return _attach_etas([trip])[0]
+
+
+# --- Helper: Trip tracking access ---
+async def _get_tracked_trip(db: AsyncSession, id: int, user: models.User) -> models.Trip:
+    """The trip (without relationships) if the user may follow it: its company's admins, its driver or a sender on it."""
+    result = await db.execute(select(models.Trip).where(models.Trip.id == id))
+    trip = result.scalars().first()
+    if not trip:
+        raise HTTPException(404, "Trip not found")
+    if user.role == models.UserRole.DRIVER and trip.driver_id != user.id:
+        raise HTTPException(403, "Not your trip")
+    if user.role == models.UserRole.ADMIN and trip.company_id != user.company_id:
+        raise HTTPException(404, "Trip not found")
+    if user.role == models.UserRole.MSME:
+        own = await db.execute(
+            select(models.TripStop.id).join(models.Shipment)
+            .where(models.TripStop.trip_id == id, models.Shipment.sender_id == user.id).limit(1)
+        )
+        if own.first() is None:
+            raise HTTPException(403, "No shipment of yours is on this trip")
     return trip
 
 
+@app.get("/trips/{id}/eta")
+async def get_trip_eta(
+    id: int,
+    db: AsyncSession = Depends(get_db),
+    user: models.User = Depends(get_current_user)
+):
+    """
+    Live ETAs of the trip's remaining stops from its latest position. Served from the
+    per-trip cache; recomputed only after a new location or a stop status change.
+    """
+    trip = await _get_tracked_trip(db, id, user)
+    if trip.status not in (models.TripStatus.PLANNED, models.TripStatus.IN_PROGRESS):
+        raise HTTPException(400, f"Trip is {trip.status.value}")
+
+    etas = trip_eta.cached(trip.id)
+    if etas is None:
+        stop_res = await db.execute(
+            select(models.TripStop).options(selectinload(models.TripStop.shipment))
+            .where(models.TripStop.trip_id == trip.id)
+        )
+        etas = trip_eta.compute(trip, stop_res.scalars().all(), position=location_buffer.overlay(trip))
+    return etas
+
+
+@app.get("/trips/{id}/track")
+async def get_trip_track(
+    id: int,
+    start: Optional[datetime.datetime] = Query(None, alias="from"),
+    end: Optional[datetime.datetime] = Query(None, alias="to"),
+    max_points: int = Query(1000, ge=2, le=10000),
+    zoom: Optional[float] = Query(None, ge=0, le=22),
+    tolerance_m: Optional[float] = Query(None, ge=0),
+    algorithm: Literal["dp", "vw"] = "dp",
+    format: Literal["points", "polyline"] = "points",
+    db: AsyncSession = Depends(get_db),
+    user: models.User = Depends(get_current_user)
+):
+    """
+    Recorded route of the trip between from and to (UTC). With a map zoom (or an explicit
+    tolerance_m) it is simplified with Douglas-Peucker, or Visvalingam for algorithm=vw;
+    format=polyline returns a Google encoded polyline. At most max_points points.
+    """
+    trip = await _get_tracked_trip(db, id, user)
+    start, end = _utc_naive(start), _utc_naive(end)
+    key = (trip.id, location_history.version(trip.id), start, end, algorithm, zoom, tolerance_m)
+    cached = track_simplify.cache_get(key)
+    if cached is None:
+        points = await location_history.track(db, trip.id, start, end)
+        tolerance = tolerance_m
+        if tolerance is None and zoom is not None and points:
+            tolerance = track_simplify.zoom_tolerance_m(zoom, sum(p[1] for p in points) / len(points))
+        if tolerance:
+            kept = track_simplify.simplify([(lat, lng) for _, lat, lng in points], tolerance, algorithm)
+            points_kept = [points[i] for i in kept]
+        else:
+            points_kept = points
+        cached = (len(points), tolerance, points_kept)
+        track_simplify.cache_put(key, cached)
+
+    total, tolerance, points = cached
+    points = location_history.decimate(points, max_points)
+    body = {
+        "trip_id": trip.id,
+        "from": start,
+        "to": end,
+        "total_points": total,
+        "returned_points": len(points),
+        "tolerance_m": round(tolerance, 2) if tolerance else None,
+    }
+    if format == "polyline":
+        body["polyline"] = track_simplify.encode_polyline([(lat, lng) for _, lat, lng in points])
+        body["start_at"] = location_history.from_epoch(points[0][0]) if points else None
+        body["end_at"] = location_history.from_epoch(points[-1][0]) if points else None
+    else:
+        body["points"] = [[lat, lng, location_history.from_epoch(ts)] for ts, lat, lng in points]
+    return body
+
+
+# --- Helper: Location pings ---
+async def _start_tracking(db: AsyncSession, trip: models.Trip, now: datetime.datetime) -> location_buffer.ActiveTrip:
+    """First ping of a PLANNED trip starts it; IN_PROGRESS trips are remembered by the buffer."""
+    if trip.status == models.TripStatus.PLANNED:
+        trip.status = models.TripStatus.IN_PROGRESS
+        trip.started_at = now
+        await db.commit()
+    return location_buffer.remember(trip)
+
+
+async def _driver_active_trip(db: AsyncSession, user: models.User,
+                              now: datetime.datetime) -> Optional[location_buffer.ActiveTrip]:
+    """The driver's latest PLANNED/IN_PROGRESS trip, if any."""
+    active = location_buffer.lookup_driver(user.id)
+    if active is None:
+        result = await db.execute(
+            select(models.Trip).where(
+                models.Trip.driver_id == user.id,
+                models.Trip.status.in_([models.TripStatus.PLANNED, models.TripStatus.IN_PROGRESS])
+            ).order_by(models.Trip.created_at.desc()).limit(1)
+        )
+        trip = result.scalars().first()
+        if trip:
+            active = await _start_tracking(db, trip, now)
+    return active
+
+
+async def _driver_trip(db: AsyncSession, id: int, user: models.User, now: datetime.datetime) -> location_buffer.ActiveTrip:
+    active = location_buffer.lookup_trip(id)
+    if active is None:
+        result = await db.execute(select(models.Trip).where(models.Trip.id == id))
+        trip = result.scalars().first()
+        if not trip or trip.driver_id != user.id:
+            raise HTTPException(404, "Trip not found")
+        active = await _start_tracking(db, trip, now)
+    elif active.driver_id != user.id:
+        raise HTTPException(404, "Trip not found")
+    return active
+
+
+def _record_ping(active: location_buffer.ActiveTrip, lat: float, lng: float, at: datetime.datetime,
+                 history: bool = True, extra: Optional[dict] = None) -> bool:
+    """Feed one position to every live consumer; False if it is older than the one already known."""
+    if not location_buffer.record(active.trip_id, lat, lng, at):
+        return False
+    if history:
+        location_history.append(active.trip_id, lat, lng, at)
+    tracking_hub.publish(active.company_id, active.trip_id, {
+        "trip_id": active.trip_id, "vehicle_id": active.vehicle_id, "lat": lat, "lng": lng, "at": at.isoformat(),
+        **(extra or {}),
+    })
+    fleet_state.record_position(active.company_id, active.vehicle_id, active.trip_id, lat, lng, at)
+    trip_eta.record_ping(active.trip_id, lat, lng, at)
+    return True
+
+
+# --- Helper: Geofence arrivals ---
+async def _check_geofences(db: AsyncSession, active: location_buffer.ActiveTrip, positions):
+    """Run (lat, lng, at) positions, oldest first, through the trip's stop fences and store arrivals/departures."""
+    if not geofence.loaded(active.trip_id):
+        result = await db.execute(
+            select(models.TripStop.id, models.TripStop.stop_type, models.TripStop.status,
+                   models.TripStop.arrived_at, models.TripStop.departed_at,
+                   models.Shipment.pickup_lat, models.Shipment.pickup_lng, models.Shipment.drop_lat, models.Shipment.drop_lng)
+            .join(models.Shipment, models.TripStop.shipment_id == models.Shipment.id)
+            .where(models.TripStop.trip_id == active.trip_id)
+        )
+        fences, last_at = [], None
+        for row in result.all():
+            # Positions before the latest persisted event of any stop were already processed
+            for at in (row.arrived_at, row.departed_at):
+                if at is not None and (last_at is None or at > last_at):
+                    last_at = at
+            if row.status not in (models.TripStopStatus.PENDING, models.TripStopStatus.IN_TRANSIT):
+                continue
+            is_drop = row.stop_type == models.TripStopType.DROP
+            lat, lng = (row.drop_lat, row.drop_lng) if is_drop else (row.pickup_lat, row.pickup_lng)
+            if lat is None or lng is None:
+                continue
+            inside = row.arrived_at is not None and (row.departed_at is None or row.departed_at < row.arrived_at)
+            fences.append(geofence.Fence(row.id, active.trip_id, lat, lng, row.arrived_at if inside else None))
+        geofence.load_trip(active.trip_id, fences, last_at)
+
+    events = [event for lat, lng, at in positions for event in geofence.check(active.trip_id, lat, lng, at)]
+    if not events:
+        return
+    completed = []
+    for event in events:
+        if event.kind == geofence.ARRIVED:
+            values = {"arrived_at": event.at, "departed_at": None, "dwell_min": None}
+        else:
+            values = {"departed_at": event.at, "dwell_min": round(event.dwell_s / 60, 1)}
+            if geofence.AUTO_ADVANCE and event.dwell_s >= geofence.MIN_DWELL_S:
+                values.update(status=models.TripStopStatus.COMPLETED, completed_at=event.at)
+                geofence.remove(event.stop_id)
+                completed.append(event.stop_id)
+        await db.execute(update(models.TripStop).where(models.TripStop.id == event.stop_id).values(**values))
+    await db.commit()
+    trip_eta.invalidate(active.trip_id)
+    for stop_id in completed:
+        fleet_state.set_stop_status(active.trip_id, stop_id, models.TripStopStatus.COMPLETED)
+
+
 @app.post("/driver/update-location")
 async def update_driver_location_general(
     req: schemas.UpdateTripLocationRequest,
     db: AsyncSession = Depends(get_db),
     user: models.User = Depends(get_current_user)
 ):
-    """General driver location update, syncs to active trip if any."""
+    """General driver location update, syncs to active trip if any (written by the location buffer)."""
     if user.role != models.UserRole.DRIVER:
         raise HTTPException(403, "Only drivers can update location")
 
-    # Find active trip
-    result = await db.execute(
-        select(models.Trip).where(
-            models.Trip.driver_id == user.id,
-            models.Trip.status.in_([models.TripStatus.PLANNED, models.TripStatus.IN_PROGRESS])
-        ).order_by(models.Trip.created_at.desc()).limit(1)
-    )
-    trip = result.scalars().first()
-    if trip:
-        trip.current_lat = req.lat
-        trip.current_lng = req.lng
-        trip.last_location_at = datetime.datetime.utcnow()
-        if trip.status == models.TripStatus.PLANNED:
-            trip.status = models.TripStatus.IN_PROGRESS
-            trip.started_at = datetime.datetime.utcnow()
-        await db.commit()
-    return {"status": "ok", "trip_updated": trip.id if trip else None}
+    now = datetime.datetime.utcnow()
+    active = await _driver_active_trip(db, user, now)
+    if active:
+        _record_ping(active, req.lat, req.lng, now)
+        await _check_geofences(db, active, [(req.lat, req.lng, now)])
+    return {"status": "ok", "trip_updated": active.trip_id if active else None}
 
 
 @app.post("/trips/{id}/update-location")
@@ -2809,25 +3331,157 @@ async def update_trip_location(
     db: AsyncSession = Depends(get_db),
     user: models.User = Depends(get_current_user)
 ):
-    """Driver posts real GPS coordinates for live tracking."""
+    """Driver posts real GPS coordinates for live tracking (written by the location buffer)."""
     if user.role != models.UserRole.DRIVER:
         raise HTTPException(403, "Only drivers can update location")
 
-    result = await db.execute(select(models.Trip).where(models.Trip.id == id))
-    trip = result.scalars().first()
-    if not trip or trip.driver_id != user.id:
-        raise HTTPException(404, "Trip not found")
+    now = datetime.datetime.utcnow()
+    active = await _driver_trip(db, id, user, now)
+    _record_ping(active, req.lat, req.lng, now)
+    await _check_geofences(db, active, [(req.lat, req.lng, now)])
+    return {"message": "Location updated", "lat": req.lat, "lng": req.lng}
 
-    trip.current_lat = req.lat
-    trip.current_lng = req.lng
-    trip.last_location_at = datetime.datetime.utcnow()
 
-    if trip.status == models.TripStatus.PLANNED:
-        trip.status = models.TripStatus.IN_PROGRESS
-        trip.started_at = datetime.datetime.utcnow()
+@app.post("/driver/locations/batch")
+async def upload_driver_locations(
+    req: schemas.LocationBatchRequest,
+    db: AsyncSession = Depends(get_db),
+    user: models.User = Depends(get_current_user)
+):
+    """
+    Points a driver recorded while offline, uploaded in one request on reconnect. They
+    are validated, ordered and de-duplicated, stored in the trip's history with one
+    insert, and the newest becomes the trip's position unless a newer ping arrived.
+    """
+    if user.role != models.UserRole.DRIVER:
+        raise HTTPException(403, "Only drivers can update location")
+    if len(req.points) > location_history.BATCH_MAX_POINTS:
+        raise HTTPException(400, f"At most {location_history.BATCH_MAX_POINTS} points per batch")
 
+    now = datetime.datetime.utcnow()
+    if req.trip_id is not None:
+        active = await _driver_trip(db, req.trip_id, user, now)
+    else:
+        active = await _driver_active_trip(db, user, now)
+    points, rejected = location_history.clean_batch([(p.lat, p.lng, _utc_naive(p.at)) for p in req.points], now)
+    if active is None or not points:
+        return {"status": "ok", "trip_updated": active.trip_id if active else None,
+                "received": len(req.points), "rejected": rejected, "stored": 0}
+
+    stored = await location_history.write(db, active.trip_id, points)
     await db.commit()
-    return {"message": "Location updated", "lat": req.lat, "lng": req.lng}
+    for ts, lat, lng in points[:-1]:
+        trip_eta.record_ping(active.trip_id, lat, lng, location_history.from_epoch(ts))
+    ts, lat, lng = points[-1]
+    _record_ping(active, lat, lng, location_history.from_epoch(ts), history=False)
+    await _check_geofences(db, active, [(lat, lng, location_history.from_epoch(ts)) for ts, lat, lng in points])
+    return {"status": "ok", "trip_updated": active.trip_id, "received": len(req.points),
+            "rejected": rejected, "stored": stored, "latest_at": location_history.from_epoch(ts)}
+
+
+# --- Helper: Driver telemetry frames ---
+async def _ingest_telemetry(user: models.User, trip_id: Optional[int], points: List[telemetry.Point]) -> dict:
+    """One telemetry frame through the /driver/update-location path: trip lookup, pings, geofences."""
+    now = datetime.datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        if trip_id is not None:
+            active = await _driver_trip(db, trip_id, user, now)
+        else:
+            active = await _driver_active_trip(db, user, now)
+        cleaned, rejected = location_history.clean_batch([(lat, lng, at) for lat, lng, at, _, _ in points], now)
+        if active is None:
+            return {"trip_id": None, "accepted": 0, "stale": 0, "rejected": rejected}
+        extras = {location_history.to_epoch(at): {"speed_kmh": speed, "heading": heading}
+                  for _, _, at, speed, heading in points if speed is not None or heading is not None}
+        accepted = []
+        for ts, lat, lng in cleaned:
+            at = location_history.from_epoch(ts)
+            if _record_ping(active, lat, lng, at, extra=extras.get(ts)):
+                accepted.append((lat, lng, at))
+        if accepted:
+            await _check_geofences(db, active, accepted)
+    return {"trip_id": active.trip_id, "accepted": len(accepted), "stale": len(cleaned) - len(accepted),
+            "rejected": rejected}
+
+
+@app.websocket("/ws/driver/telemetry")
+async def driver_telemetry_websocket(websocket: WebSocket, token: str = Query(...), trip_id: Optional[int] = None):
+    """
+    Driver GPS over one connection: the token (?token=) is checked once here, then every
+    frame of points goes through the same path as /driver/update-location. Pings go to
+    the driver's active trip, or to ?trip_id=. See telemetry for the frame formats.
+    """
+    async with AsyncSessionLocal() as db:
+        try:
+            user = await get_current_user(token=token, db=db)
+        except HTTPException as e:
+            await websocket.close(code=1008, reason=str(e.detail))
+            return
+    if user.role != models.UserRole.DRIVER:
+        await websocket.close(code=1008, reason="Only drivers can send telemetry")
+        return
+    await websocket.accept()
+    await telemetry.serve(websocket, lambda points: _ingest_telemetry(user, trip_id, points), token_expires_at(token))
+
+
+@app.get("/admin/telemetry")
+async def get_telemetry_metrics(user: models.User = Depends(get_current_admin)):
+    return telemetry.metrics()
+
+
+# --- Helper: Live tracking subscriptions ---
+async def _tracking_subscriber(db: AsyncSession, token: str, trip_id: Optional[int]) -> tracking_hub.Subscriber:
+    """Authorize like get_current_user; a trip channel follows the /trips/{id}/eta rules, the company channel is for admins."""
+    user = await get_current_user(token=token, db=db)
+    if trip_id is not None:
+        trip = await _get_tracked_trip(db, trip_id, user)
+        return tracking_hub.Subscriber(trip.company_id, trip.id)
+    if user.role != models.UserRole.ADMIN:
+        raise HTTPException(403, "Only admins can follow the whole fleet")
+    return tracking_hub.Subscriber(user.company_id)
+
+
+@app.websocket("/ws/tracking")
+async def tracking_websocket(websocket: WebSocket, token: str = Query(...), trip_id: Optional[int] = None):
+    """
+    Live positions of the admin's company, or of one trip with ?trip_id=. The JWT goes
+    in ?token= since browsers cannot set headers on WebSocket or EventSource requests.
+    """
+    async with AsyncSessionLocal() as db:
+        try:
+            sub = await _tracking_subscriber(db, token, trip_id)
+        except HTTPException as e:
+            await websocket.close(code=1008, reason=str(e.detail))
+            return
+    await websocket.accept()
+    await tracking_hub.serve_websocket(websocket, sub)
+
+
+@app.get("/tracking/stream")
+async def tracking_stream(
+    token: str = Query(...),
+    trip_id: Optional[int] = None
+):
+    """
+    Server-sent events variant of /ws/tracking. Like the WebSocket it authorizes with a
+    short-lived session: a Depends(get_db) session would hold a pooled connection until
+    the stream ends.
+    """
+    async with AsyncSessionLocal() as db:
+        sub = await _tracking_subscriber(db, token, trip_id)
+    return StreamingResponse(tracking_hub.sse_events(sub), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/admin/tracking-hub")
+async def get_tracking_hub_metrics(user: models.User = Depends(get_current_admin)):
+    return tracking_hub.metrics()
+
+
+@app.get("/admin/location-buffer")
+async def get_location_buffer_metrics(user: models.User = Depends(get_current_admin)):
+    """Ping coalescing, flush lag and the positions not yet written to the database."""
+    return location_buffer.metrics()
 
 
 @app.delete("/trips/{id}")
@@ -2850,14 +3504,25 @@ async def cancel_trip(
     if trip.status not in [models.TripStatus.PLANNED, models.TripStatus.IN_PROGRESS]:
         raise HTTPException(400, "Can only cancel PLANNED or IN_PROGRESS trips")
 
-    for stop in trip.stops:
-        if stop.status == models.TripStopStatus.PENDING:
-            s_res = await db.execute(select(models.Shipment).where(models.Shipment.id == stop.shipment_id))
-            s = s_res.scalars().first()
-            if s and s.status == models.ShipmentStatus.ASSIGNED:
-                s.status = models.ShipmentStatus.PENDING
-                s.assigned_vehicle_id = None
-                s.assigned_driver_id = None
+    # Reset the trip's still-ASSIGNED shipments with one SELECT and one UPDATE
+    pending_ids = {stop.shipment_id for stop in trip.stops if stop.status == models.TripStopStatus.PENDING}
+    rows = []
+    if pending_ids:
+        s_res = await db.execute(select(models.Shipment.id, models.Shipment.assigned_driver_id).where(
+            models.Shipment.id.in_(pending_ids),
+            models.Shipment.status == models.ShipmentStatus.ASSIGNED,
+        ))
+        rows = s_res.all()
+        for driver_id, count in Counter(driver_id for _, driver_id in rows).items():
+            await workload.record_transition(db, driver_id, models.ShipmentStatus.ASSIGNED,
+                                             models.ShipmentStatus.PENDING, count=count)
+        if rows:
+            await db.execute(
+                update(models.Shipment)
+                .where(models.Shipment.id.in_([sid for sid, _ in rows]))
+                .values(status=models.ShipmentStatus.PENDING, assigned_vehicle_id=None, assigned_driver_id=None)
+                .execution_options(synchronize_session="evaluate")
+            )
 
     trip.status = models.TripStatus.CANCELLED
 
@@ -2869,4 +3534,285 @@ async def cancel_trip(
     await create_audit_log(db, user.id, "TRIP_CANCELLED", "TRIP", trip.id,
                            f"Trip {trip.trip_number} cancelled by admin")
     await db.commit()
+    trip_eta.forget(trip.id)
+    geofence.forget_trip(trip.id)
+    location_buffer.forget_trip(trip.id)
+    if vehicle:
+        fleet_state.sync_vehicle(vehicle)
+    fleet_state.drop_shipments(sid for sid, _ in rows)
+    fleet_state.sync_trip(trip)
     return {"message": "Trip cancelled"}
+
+
+# --- Helper: Incremental trip edits ---
+_DONE_STOP = (models.TripStopStatus.COMPLETED, models.TripStopStatus.SKIPPED)
+
+
+def _stop_point(stop: models.TripStop, shipment: models.Shipment = None):
+    s = shipment or stop.shipment
+    if stop.stop_type == models.TripStopType.DROP:
+        return (s.drop_lat, s.drop_lng) if s.drop_lat and s.drop_lng else None
+    return (s.pickup_lat, s.pickup_lng) if s.pickup_lat and s.pickup_lng else None
+
+
+async def _load_trip_for_edit(db: AsyncSession, id: int) -> models.Trip:
+    result = await db.execute(
+        select(models.Trip)
+        .options(selectinload(models.Trip.stops).selectinload(models.TripStop.shipment))
+        .where(models.Trip.id == id)
+    )
+    trip = result.scalars().first()
+    if not trip:
+        raise HTTPException(404, "Trip not found")
+    if trip.status not in [models.TripStatus.PLANNED, models.TripStatus.IN_PROGRESS]:
+        raise HTTPException(400, "Can only edit PLANNED or IN_PROGRESS trips")
+    return trip
+
+
+class _TripRoute:
+    """
+    Routing view of a trip for incremental edits. Node k is the k-th stop with
+    coordinates (sequence order); new stops are appended as extra nodes. Stops up to the
+    last COMPLETED/SKIPPED one are fixed and the last routable one of them is the
+    origin; `route` holds the remaining routable nodes and `tail` the remaining stops
+    without coordinates (kept last).
+    """
+
+    def __init__(self, trip: models.Trip, new_stops=()):
+        self.trip = trip
+        stops = sorted(trip.stops, key=lambda st: st.sequence_order)
+        self.old_prev = {st: prev for prev, st in zip([None] + stops, stops)}
+        last_done = max((k for k, st in enumerate(stops) if st.status in _DONE_STOP), default=-1)
+        self.prefix = stops[:last_done + 1]
+        self.stops, self.points = [], []
+        for st, shipment in [(st, st.shipment) for st in stops] + list(new_stops):
+            point = _stop_point(st, shipment)
+            if point:
+                self.stops.append((st, shipment))
+                self.points.append(point)
+        node_of = {st: k for k, (st, _) in enumerate(self.stops)}
+        self.node_of = node_of
+        self.origin = max((node_of[st] for st in self.prefix if st in node_of), default=None)
+        self.route = [node_of[st] for st in stops[last_done + 1:] if st in node_of]
+        self.tail = [st for st in stops[last_done + 1:] if st not in node_of]
+
+        # Load changes per stop; legacy single-stop shipments carry no load
+        with_drop = {st.shipment_id for st, _ in self.stops if st.stop_type == models.TripStopType.DROP}
+        self.deltas = []
+        for st, s in self.stops:
+            load = (s.total_weight or 0.0, s.total_volume or 0.0) if s.id in with_drop else (0.0, 0.0)
+            sign = -1 if st.stop_type == models.TripStopType.DROP else 1
+            self.deltas.append((sign * load[0], sign * load[1]))
+        remaining = set(self.route)
+        on_board = {s.id: s for st, s in self.stops if st.stop_type == models.TripStopType.DROP
+                    and node_of[st] in remaining}
+        for st, s in self.stops:
+            if st.stop_type == models.TripStopType.PICKUP and node_of[st] in remaining:
+                on_board.pop(s.id, None)
+        self.initial_load = (sum(s.total_weight or 0.0 for s in on_board.values()),
+                             sum(s.total_volume or 0.0 for s in on_board.values()))
+
+        # Times run from the planned start until the trip is under way, from now afterwards
+        now = datetime.datetime.utcnow()
+        if trip.status == models.TripStatus.PLANNED and not self.prefix and trip.planned_start_at:
+            self.anchor = max(trip.planned_start_at, now)
+        else:
+            self.anchor = now
+        windows, service = [], []
+        for k, (st, s) in enumerate(self.stops):
+            kind = "drop" if st.stop_type == models.TripStopType.DROP else "pickup"
+            if k == self.origin:
+                windows.append((None, None))
+                service.append(0.0)
+                continue
+            windows.append((_minutes_after(self.anchor, getattr(s, f"{kind}_window_start")),
+                            _minutes_after(self.anchor, getattr(s, f"{kind}_window_end"))))
+            service.append(s.service_time_min if s.service_time_min is not None else routing.DEFAULT_SERVICE_MIN)
+        self.windows = routing.TimeWindows(windows, service)
+
+    async def load_matrix(self):
+        self.matrix, self.minutes = await _stop_matrices(self.points)
+        self.windows.minutes = self.minutes
+
+    def _end_min(self, route) -> float:
+        seq = ([self.origin] if self.origin is not None else []) + list(route)
+        timeline = self.windows.timeline(seq, self.matrix)
+        return timeline[-1][1] if timeline else 0.0
+
+    def describe(self, e: routing.Infeasible) -> str:
+        """Infeasible from insert_pickup_delivery with its (node, node) conflicts as stop labels."""
+        def label(node):
+            st, s = self.stops[node]
+            return f"shipment {s.id} {'drop' if st.stop_type == models.TripStopType.DROP else 'pickup'}"
+        if not e.conflicts:
+            return f"{e}"
+        late = [label(node) for node, _ in e.conflicts[:5]]
+        more = f" (+{len(e.conflicts) - 5} more)" if len(e.conflicts) > 5 else ""
+        return f"{e} (time window missed at {', '.join(late)}{more})"
+
+    def apply(self, new_route, extra_tail=()) -> float:
+        """
+        Write the new order back: sequence numbers that moved, legs of stops whose
+        predecessor changed and planned times from the first changed stop on.
+        Returns the change in planned duration (minutes).
+        """
+        remaining = [self.stops[node][0] for node in new_route] + self.tail + list(extra_tail)
+        final = self.prefix + remaining
+        seq_nodes = ([self.origin] if self.origin is not None else []) + list(new_route)
+        times = {node: (arrival, departure) for node, (arrival, departure, _)
+                 in zip(seq_nodes, self.windows.timeline(seq_nodes, self.matrix))}
+
+        changed = False
+        for seq, (prev, st) in enumerate(zip([None] + final, final), start=1):
+            if st.sequence_order != seq:
+                st.sequence_order = seq
+            moved = self.old_prev.get(st, "new") != prev
+            node, prev_node = self.node_of.get(st), self.node_of.get(prev) if prev is not None else None
+            if moved:
+                changed = True
+                if node is not None and prev_node is not None:
+                    km = self.matrix[prev_node][node]
+                    st.estimated_distance_km = round(km, 2)
+                    st.estimated_duration_min = _leg_minutes(km, self.minutes, prev_node, node)
+                else:
+                    st.estimated_distance_km = st.estimated_duration_min = None
+            if changed and st not in self.prefix and node in times:
+                arrival, departure = times[node]
+                st.planned_arrival_at = self.anchor + datetime.timedelta(seconds=round(arrival * 60))
+                st.planned_departure_at = self.anchor + datetime.timedelta(seconds=round(departure * 60))
+        return self._end_min(new_route) - self._end_min(self.route)
+
+
+@app.post("/trips/{id}/stops", response_model=schemas.TripResponse)
+async def add_trip_stop(
+    id: int,
+    req: schemas.TripStopAdd,
+    db: AsyncSession = Depends(get_db),
+    user: models.User = Depends(get_current_user)
+):
+    """
+    Add a PENDING shipment to a planned or running trip. Its pickup and drop go to the
+    cheapest positions that keep capacity and do not make an on-time stop late (windows
+    the trip already misses do not block it); stops already served stay put and the
+    others keep their order (no re-optimization).
+    """
+    if user.role != models.UserRole.ADMIN:
+        raise HTTPException(403, "Only admins can edit trips")
+    trip = await _load_trip_for_edit(db, id)
+
+    s_res = await db.execute(select(models.Shipment).where(models.Shipment.id == req.shipment_id))
+    shipment = s_res.scalars().first()
+    if not shipment:
+        raise HTTPException(404, f"Shipment {req.shipment_id} not found")
+    if shipment.status != models.ShipmentStatus.PENDING:
+        raise HTTPException(400, f"Shipment {shipment.id} is not PENDING (status: {shipment.status.value})")
+    vehicle = await db.get(models.Vehicle, trip.vehicle_id)
+    free_w, free_v = vehicle_index.remaining_capacity(vehicle)
+    if (shipment.total_weight or 0.0) > free_w or (shipment.total_volume or 0.0) > free_v:
+        raise HTTPException(400, f"Shipment {shipment.id} exceeds vehicle capacity. Remaining: {free_w}kg / {free_v}m³")
+
+    pickup = models.TripStop(trip_id=trip.id, shipment_id=shipment.id, stop_type=models.TripStopType.PICKUP,
+                             status=models.TripStopStatus.PENDING)
+    drop = models.TripStop(trip_id=trip.id, shipment_id=shipment.id, stop_type=models.TripStopType.DROP,
+                           status=models.TripStopStatus.PENDING)
+    route = _TripRoute(trip, [(pickup, shipment), (drop, shipment)])
+    await route.load_matrix()
+    if pickup in route.node_of:
+        try:
+            delta_km, new_route = routing.insert_pickup_delivery(
+                route.matrix, route.route, route.node_of[pickup], route.node_of[drop], route.deltas,
+                (free_w, free_v), route.initial_load, route.origin, route.windows,
+            )
+        except routing.Infeasible as e:
+            raise HTTPException(400, f"Shipment {shipment.id} does not fit anywhere in trip {trip.trip_number}: "
+                                     f"{route.describe(e)}")
+        extra_tail = ()
+    else:
+        delta_km, new_route, extra_tail = 0.0, route.route, (pickup, drop)
+    db.add_all([pickup, drop])
+    delta_min = route.apply(new_route, extra_tail)
+    trip.total_distance_km = round((trip.total_distance_km or 0.0) + delta_km, 2)
+    trip.total_duration_min = round((trip.total_duration_min or 0.0) + delta_min, 1)
+
+    await workload.record_transition(db, trip.driver_id, shipment.status, models.ShipmentStatus.ASSIGNED)
+    shipment.status = models.ShipmentStatus.ASSIGNED
+    shipment.assigned_vehicle_id = trip.vehicle_id
+    shipment.assigned_driver_id = trip.driver_id
+    shipment.assigned_at = datetime.datetime.utcnow()
+    await add_timeline_entry(db, shipment.id, models.ShipmentStatus.ASSIGNED, user.id,
+                             f"Added to trip {trip.trip_number} (stops #{pickup.sequence_order}, #{drop.sequence_order})")
+    await create_notification(db, shipment.sender_id, "ASSIGNMENT", "Your order has been scheduled",
+                              f"Shipment {shipment.tracking_number} is scheduled in trip {trip.trip_number}.")
+    await create_notification(db, trip.driver_id, "ASSIGNMENT", "Trip Updated",
+                              f"Shipment {shipment.tracking_number} was added to trip {trip.trip_number} "
+                              f"(stops #{pickup.sequence_order} and #{drop.sequence_order}).")
+    await create_audit_log(db, user.id, "TRIP_STOP_ADDED", "TRIP", trip.id,
+                           f"Shipment {shipment.tracking_number} added to trip {trip.trip_number} (+{delta_km:.2f} km)")
+    await db.commit()
+    trip_eta.invalidate(trip.id)
+    geofence.forget_trip(trip.id)
+
+    result = await db.execute(_load_trip_query().where(models.Trip.id == trip.id)
+                              .execution_options(populate_existing=True))
+    trip = result.scalars().first()
+    fleet_state.sync_trip(trip, [shipment] + [stop.shipment for stop in trip.stops])
+    return _attach_etas([trip])[0]
+
+
+@app.delete("/trips/{id}/stops/{stop_id}", response_model=schemas.TripResponse)
+async def remove_trip_stop(
+    id: int,
+    stop_id: int,
+    db: AsyncSession = Depends(get_db),
+    user: models.User = Depends(get_current_user)
+):
+    """
+    Take the stop's shipment (its pickup and drop stops) off a trip and return it to
+    PENDING. Only the neighbouring legs and later sequence numbers are updated.
+    """
+    if user.role != models.UserRole.ADMIN:
+        raise HTTPException(403, "Only admins can edit trips")
+    trip = await _load_trip_for_edit(db, id)
+    stop = next((st for st in trip.stops if st.id == stop_id), None)
+    if not stop:
+        raise HTTPException(404, "Stop not found")
+    removed = [st for st in trip.stops if st.shipment_id == stop.shipment_id]
+    if any(st.status != models.TripStopStatus.PENDING for st in removed):
+        raise HTTPException(400, "Shipment is already picked up; complete or cancel it instead")
+    if len(removed) == len(trip.stops):
+        raise HTTPException(400, "Cannot remove the last shipment; cancel the trip instead")
+
+    route = _TripRoute(trip)
+    await route.load_matrix()
+    nodes = [route.node_of[st] for st in removed if st in route.node_of]
+    delta_km = routing.removal_delta(route.matrix, route.route, nodes, route.origin)
+    new_route = [node for node in route.route if node not in nodes]
+    route.tail = [st for st in route.tail if st not in removed]
+    for st in removed:
+        trip.stops.remove(st)
+        await db.delete(st)
+    delta_min = route.apply(new_route)
+    trip.total_distance_km = round(max((trip.total_distance_km or 0.0) + delta_km, 0.0), 2)
+    trip.total_duration_min = round(max((trip.total_duration_min or 0.0) + delta_min, 0.0), 1)
+
+    shipment = stop.shipment
+    if shipment.status == models.ShipmentStatus.ASSIGNED:
+        await workload.record_transition(db, shipment.assigned_driver_id, shipment.status, models.ShipmentStatus.PENDING)
+        shipment.status = models.ShipmentStatus.PENDING
+        shipment.assigned_vehicle_id = None
+        shipment.assigned_driver_id = None
+        await add_timeline_entry(db, shipment.id, models.ShipmentStatus.PENDING, user.id,
+                                 f"Removed from trip {trip.trip_number}")
+    await create_notification(db, trip.driver_id, "ASSIGNMENT", "Trip Updated",
+                              f"Shipment {shipment.tracking_number} was removed from trip {trip.trip_number}.")
+    await create_audit_log(db, user.id, "TRIP_STOP_REMOVED", "TRIP", trip.id,
+                           f"Shipment {shipment.tracking_number} removed from trip {trip.trip_number} ({delta_km:.2f} km)")
+    await db.commit()
+    trip_eta.invalidate(trip.id)
+    geofence.forget_trip(trip.id)
+
+    result = await db.execute(_load_trip_query().where(models.Trip.id == trip.id)
+                              .execution_options(populate_existing=True))
+    trip = result.scalars().first()
+    fleet_state.sync_trip(trip, [shipment] + [stop.shipment for stop in trip.stops])
+    return _attach_etas([trip])[0]
@@ -0,0 +1,40 @@
+"""Add shipment time windows / service times, trip planned start and per-stop planned arrival and departure."""
+import asyncio
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from database import DATABASE_URL
+
+engine = create_async_engine(DATABASE_URL, echo=False)
+
+COLUMNS = [
+    ("shipments", "pickup_window_start", "TIMESTAMP"),
+    ("shipments", "pickup_window_end", "TIMESTAMP"),
+    ("shipments", "drop_window_start", "TIMESTAMP"),
+    ("shipments", "drop_window_end", "TIMESTAMP"),
+    ("shipments", "service_time_min", "DOUBLE PRECISION"),
+    ("trips", "planned_start_at", "TIMESTAMP"),
+    ("trip_stops", "planned_arrival_at", "TIMESTAMP"),
+    ("trip_stops", "planned_departure_at", "TIMESTAMP"),
+]
+
+async def migrate():
+    for table, column, column_type in COLUMNS:
+        async with engine.begin() as conn:
+            try:
+                await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {column_type}"))
+                print(f"Added {column} column to {table}")
+            except Exception as e:
+                print(f"Error adding {table}.{column} (may already exist): {e}")
+
+    print("Migration complete!")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    asyncio.run(migrate())
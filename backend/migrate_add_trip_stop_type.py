@@ -0,0 +1,40 @@
+"""Add stop_type column to trip_stops (pickup/drop stops). Existing stops become PICKUP stops."""
+import asyncio
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from database import DATABASE_URL
+
+engine = create_async_engine(DATABASE_URL, echo=False)
+
+async def migrate():
+    async with engine.begin() as conn:
+        try:
+            await conn.execute(text(
+                "DO $$ BEGIN CREATE TYPE tripstoptype AS ENUM ('PICKUP', 'DROP'); "
+                "EXCEPTION WHEN duplicate_object THEN null; END $$;"
+            ))
+            print("Created tripstoptype enum")
+        except Exception as e:
+            print(f"Error creating enum (may already exist): {e}")
+
+    async with engine.begin() as conn:
+        try:
+            await conn.execute(text(
+                "ALTER TABLE trip_stops ADD COLUMN IF NOT EXISTS stop_type tripstoptype NOT NULL DEFAULT 'PICKUP'"
+            ))
+            print("Added stop_type column to trip_stops")
+        except Exception as e:
+            print(f"Error adding column (may already exist): {e}")
+    
+    print("Migration complete!")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    asyncio.run(migrate())
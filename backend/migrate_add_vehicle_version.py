@@ -0,0 +1,30 @@
+"""Add version column to vehicles table if missing (atomic capacity reservation)."""
+import asyncio
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from database import DATABASE_URL
+
+engine = create_async_engine(DATABASE_URL, echo=False)
+
+async def migrate():
+    async with engine.begin() as conn:
+        try:
+            await conn.execute(text(
+                "ALTER TABLE vehicles ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0"
+            ))
+            print("Added version column to vehicles")
+        except Exception as e:
+            print(f"Error adding column (may already exist): {e}")
+    
+    print("Migration complete!")
+    await engine.dispose()
+
+if __name__ == "__main__":
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    asyncio.run(migrate())
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Enum, ForeignKey, Boolean, DateTime, Text, JSON
+from sqlalchemy import Column, Integer, String, Float, Enum, ForeignKey, Boolean, Date, DateTime, Text, JSON, Index, LargeBinary
 from sqlalchemy.orm import relationship
 import enum
 import datetime
@@ -74,6 +74,10 @@ class TripStopStatus(str, enum.Enum):
     COMPLETED = "COMPLETED"
     SKIPPED = "SKIPPED"
 
+class TripStopType(str, enum.Enum):
+    PICKUP = "PICKUP"
+    DROP = "DROP"
+
 # --- Core Models ---
 
 class Company(Base):
@@ -220,6 +224,7 @@ class Vehicle(Base):
     current_weight_used = Column(Float, default=0.0)
     current_volume_used = Column(Float, default=0.0)
     status = Column(Enum(VehicleStatus), default=VehicleStatus.AVAILABLE, index=True)
+    version = Column(Integer, default=0, nullable=False, server_default="0")  # bumped on every capacity change
     current_driver_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     zone_id = Column(Integer, ForeignKey("zones.id"), nullable=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
@@ -275,6 +280,13 @@ class Shipment(Base):
     description = Column(String, nullable=True)
     special_instructions = Column(String, nullable=True)
 
+    # Time windows (service must start inside them) and minutes spent at each stop
+    pickup_window_start = Column(DateTime, nullable=True)
+    pickup_window_end = Column(DateTime, nullable=True)
+    drop_window_start = Column(DateTime, nullable=True)
+    drop_window_end = Column(DateTime, nullable=True)
+    service_time_min = Column(Float, nullable=True)
+
     # Assignment
     zone_id = Column(Integer, ForeignKey("zones.id"), nullable=True)
     assigned_vehicle_id = Column(Integer, ForeignKey("vehicles.id"), nullable=True)
@@ -406,6 +418,7 @@ class Trip(Base):
     status = Column(Enum(TripStatus), default=TripStatus.PLANNED, index=True)
     total_distance_km = Column(Float, nullable=True)
     total_duration_min = Column(Float, nullable=True)
+    planned_start_at = Column(DateTime, nullable=True)
     current_lat = Column(Float, nullable=True)
     current_lng = Column(Float, nullable=True)
     last_location_at = Column(DateTime, nullable=True)
@@ -426,11 +439,54 @@ class TripStop(Base):
     trip_id = Column(Integer, ForeignKey("trips.id"), nullable=False, index=True)
     shipment_id = Column(Integer, ForeignKey("shipments.id"), nullable=False, index=True)
     sequence_order = Column(Integer, nullable=False)  # 1, 2, 3...
+    stop_type = Column(Enum(TripStopType), default=TripStopType.PICKUP, nullable=False, server_default="PICKUP")
     estimated_distance_km = Column(Float, nullable=True)
     estimated_duration_min = Column(Float, nullable=True)
+    planned_arrival_at = Column(DateTime, nullable=True)
+    planned_departure_at = Column(DateTime, nullable=True)
     status = Column(Enum(TripStopStatus), default=TripStopStatus.PENDING)
     notes = Column(String, nullable=True)
     completed_at = Column(DateTime, nullable=True)
+    arrived_at = Column(DateTime, nullable=True)  # geofence entry
+    departed_at = Column(DateTime, nullable=True)  # geofence exit
+    dwell_min = Column(Float, nullable=True)
 
     trip = relationship("Trip", back_populates="stops")
     shipment = relationship("Shipment")
+
+
+class DriverWorkload(Base):
+    """Per-driver shipment counts, maintained by the shipment status transitions."""
+    __tablename__ = "driver_workloads"
+    __table_args__ = (Index("ix_driver_workloads_company_active", "company_id", "active"),)
+
+    driver_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    company_id = Column(Integer, ForeignKey("companies.id"), nullable=True)
+    assigned = Column(Integer, default=0, nullable=False)
+    picked_up = Column(Integer, default=0, nullable=False)
+    in_transit = Column(Integer, default=0, nullable=False)
+    active = Column(Integer, default=0, nullable=False)  # assigned + picked_up + in_transit
+    completed = Column(Integer, default=0, nullable=False)  # delivered or confirmed
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    driver = relationship("User")
+
+
+class TripLocationSegment(Base):
+    """
+    A run of consecutive location pings of one trip within one day, delta/varint
+    encoded by location_history. resolution_s is 0 for raw segments and the sampling
+    interval once older data has been downsampled.
+    """
+    __tablename__ = "trip_location_segments"
+    __table_args__ = (Index("ix_trip_location_segments_trip_day", "trip_id", "day"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    trip_id = Column(Integer, ForeignKey("trips.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    start_at = Column(DateTime, nullable=False)
+    end_at = Column(DateTime, nullable=False)
+    point_count = Column(Integer, nullable=False)
+    resolution_s = Column(Integer, default=0, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
@@ -0,0 +1,274 @@
+"""
+Multi-vehicle trip planner for the PENDING backlog (capacitated VRP).
+
+Each shipment is a job: drive to its pickup, then to its drop. A trip is a chain
+of jobs on one vehicle whose total weight and volume fit the vehicle's free
+capacity, starting from the vehicle's last known position (or its first pickup
+when the position is unknown).
+
+1. Clarke-Wright savings: start with one route per shipment and merge the route
+   ending in i with the route starting at j in order of the distance saved by
+   driving drop_i -> pickup_j instead of coming from the depot (the centroid of
+   all pickups), as long as the merged load fits some vehicle. Merging continues
+   past the positive savings while there are more routes than vehicles.
+2. Routes are matched to vehicles largest load first, each taking the tightest
+   vehicle that can carry it.
+3. Local search until the time budget runs out: insert leftover shipments where
+   capacity allows, relocate single shipments within and between trips, and swap
+   shipments between trips when that fits both vehicles and shortens the plan.
+
+plan_routes() is a pure function over plain dicts/tuples so it can run in a worker
+process; plan_in_worker() runs it in the shared process pool.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import geodesic
+
+TIME_BUDGET_MS = int(os.getenv("PLANNER_TIME_BUDGET_MS", "2000"))
+WORKERS = int(os.getenv("PLANNER_WORKERS", "2"))
+EPS = 1e-9
+
+
+class _Plan:
+    """Distance lookups and cost deltas for one planning problem."""
+
+    def __init__(self, shipments: List[dict], vehicles: List[dict]):
+        self.shipments = shipments
+        self.vehicles = vehicles
+        n = len(shipments)
+        pickups = [s["pickup"] for s in shipments]
+        drops = [s["drop"] for s in shipments]
+        centroid = (sum(p[0] for p in pickups) / n, sum(p[1] for p in pickups) / n)
+        starts = [v["position"] for v in vehicles if v.get("position")]
+        self.start_index = {}
+        k = 0
+        for vi, v in enumerate(vehicles):
+            if v.get("position"):
+                self.start_index[vi] = k
+                k += 1
+        # drop -> pickup connections, shipment pickup -> drop legs, start -> pickup legs
+        self.conn = geodesic.haversine_matrix(drops, pickups).tolist()
+        self.pd = geodesic.haversine_pairs(pickups, drops).tolist()
+        self.depot = geodesic.haversine_matrix([centroid], pickups)[0].tolist()
+        self.from_start = geodesic.haversine_matrix(starts, pickups).tolist() if starts else []
+
+    def start_cost(self, vi: Optional[int], j: int) -> float:
+        k = self.start_index.get(vi)
+        return self.from_start[k][j] if k is not None else 0.0
+
+    def route_cost(self, vi: Optional[int], route: List[int]) -> float:
+        if not route:
+            return 0.0
+        cost = self.start_cost(vi, route[0]) + sum(self.pd[j] for j in route)
+        return cost + sum(self.conn[route[k]][route[k + 1]] for k in range(len(route) - 1))
+
+    def insert_delta(self, vi: Optional[int], route: List[int], k: int, j: int) -> float:
+        """Extra distance from serving shipment j before route[k] (k == len(route) appends)."""
+        delta = self.pd[j]
+        if k > 0:
+            delta += self.conn[route[k - 1]][j]
+        else:
+            delta += self.start_cost(vi, j)
+        if k < len(route):
+            nxt = route[k]
+            delta += self.conn[j][nxt]
+            delta -= self.conn[route[k - 1]][nxt] if k > 0 else self.start_cost(vi, nxt)
+        return delta
+
+    def best_insertion(self, vi: Optional[int], route: List[int], j: int):
+        return min(((self.insert_delta(vi, route, k, j), k) for k in range(len(route) + 1)), default=(0.0, 0))
+
+
+def _fits(load, cap) -> bool:
+    return load[0] <= cap[0] + EPS and load[1] <= cap[1] + EPS
+
+
+def _clarke_wright(plan: _Plan, caps: List[tuple]) -> List[List[int]]:
+    n = len(plan.shipments)
+    routes: Dict[int, List[int]] = {i: [i] for i in range(n)}
+    loads = {i: (plan.shipments[i]["weight"], plan.shipments[i]["volume"]) for i in range(n)}
+    route_of = list(range(n))
+    savings = sorted(
+        ((plan.depot[j] - plan.conn[i][j], i, j) for i in range(n) for j in range(n) if i != j),
+        reverse=True,
+    )
+    for saving, i, j in savings:
+        # Past the positive savings, keep merging only while there are more routes than vehicles
+        if saving <= 0 and len(routes) <= len(caps):
+            break
+        ri, rj = route_of[i], route_of[j]
+        if ri == rj or routes[ri][-1] != i or routes[rj][0] != j:
+            continue
+        load = (loads[ri][0] + loads[rj][0], loads[ri][1] + loads[rj][1])
+        if not any(_fits(load, cap) for cap in caps):
+            continue
+        routes[ri].extend(routes[rj])
+        loads[ri] = load
+        for s in routes.pop(rj):
+            route_of[s] = ri
+        del loads[rj]
+    return list(routes.values())
+
+
+def _load(plan: _Plan, route: List[int]):
+    return (sum(plan.shipments[j]["weight"] for j in route), sum(plan.shipments[j]["volume"] for j in route))
+
+
+def plan_routes(shipments: List[dict], vehicles: List[dict], time_budget_ms: Optional[int] = None) -> dict:
+    """
+    shipments: [{"id", "pickup": (lat, lng), "drop": (lat, lng), "weight", "volume"}]
+    vehicles:  [{"id", "driver_id", "weight_free", "volume_free", "position": (lat, lng) | None}]
+    Returns {"trips": [{"vehicle_id", "driver_id", "shipment_ids", "weight", "volume", "distance_km"}],
+             "unassigned": [shipment ids], "distance_km",
+             "construction": {"shipments", "distance_km"} for the plain savings plan}.
+    """
+    budget = TIME_BUDGET_MS if time_budget_ms is None else time_budget_ms
+    deadline = time.perf_counter() + budget / 1000.0
+    if not shipments or not vehicles:
+        return {"trips": [], "unassigned": [s["id"] for s in shipments], "distance_km": 0.0,
+                "construction": {"shipments": 0, "distance_km": 0.0}}
+
+    plan = _Plan(shipments, vehicles)
+    caps = [(v["weight_free"], v["volume_free"]) for v in vehicles]
+    loads_of = lambda route: _load(plan, route)
+
+    # 1-2. Savings routes, then largest load onto the tightest vehicle that carries it
+    assigned: Dict[int, List[int]] = {}
+    unassigned: List[int] = []
+    for route in sorted(_clarke_wright(plan, caps), key=lambda r: loads_of(r), reverse=True):
+        load = loads_of(route)
+        free = [vi for vi in range(len(vehicles)) if vi not in assigned and _fits(load, caps[vi])]
+        if free:
+            assigned[min(free, key=lambda vi: (caps[vi][0] - load[0], caps[vi][1] - load[1]))] = route
+        else:
+            unassigned.extend(route)
+    construction = {
+        "shipments": sum(len(r) for r in assigned.values()),
+        "distance_km": round(sum(plan.route_cost(vi, r) for vi, r in assigned.items()), 2),
+    }
+
+    # 3. Local search
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+
+        # Leftovers: cheapest feasible insertion, or a trip on a still-idle vehicle
+        for j in list(unassigned):
+            item = (shipments[j]["weight"], shipments[j]["volume"])
+            best = None
+            for vi in range(len(vehicles)):
+                route = assigned.get(vi, [])
+                load = loads_of(route)
+                if not _fits((load[0] + item[0], load[1] + item[1]), caps[vi]):
+                    continue
+                delta, k = plan.best_insertion(vi, route, j)
+                if best is None or delta < best[0]:
+                    best = (delta, vi, k)
+            if best is not None:
+                _, vi, k = best
+                assigned.setdefault(vi, []).insert(k, j)
+                unassigned.remove(j)
+                improved = True
+
+        # Relocate one shipment (same trip or another trip / idle vehicle)
+        for vi in list(assigned):
+            if time.perf_counter() > deadline:
+                break
+            pos = 0
+            while vi in assigned and pos < len(assigned[vi]):
+                route = assigned[vi]
+                j = route[pos]
+                rest = route[:pos] + route[pos + 1:]
+                gain = plan.route_cost(vi, route) - plan.route_cost(vi, rest)
+                item = (shipments[j]["weight"], shipments[j]["volume"])
+                best = None
+                for vk in range(len(vehicles)):
+                    target = rest if vk == vi else assigned.get(vk, [])
+                    if vk != vi:
+                        load = loads_of(target)
+                        if not _fits((load[0] + item[0], load[1] + item[1]), caps[vk]):
+                            continue
+                    delta, k = plan.best_insertion(vk, target, j)
+                    if delta - gain < -EPS and (best is None or delta - gain < best[0]):
+                        best = (delta - gain, vk, k)
+                if best is None:
+                    pos += 1
+                    continue
+                _, vk, k = best
+                if vk == vi:
+                    rest.insert(k, j)
+                    assigned[vi] = rest
+                else:
+                    assigned.setdefault(vk, []).insert(k, j)
+                    if rest:
+                        assigned[vi] = rest
+                    else:
+                        del assigned[vi]
+                improved = True
+
+        # Swap shipments between two trips in place
+        trips = list(assigned)
+        for a_idx, va in enumerate(trips):
+            if time.perf_counter() > deadline:
+                break
+            for vb in trips[a_idx + 1:]:
+                ra, rb = assigned[va], assigned[vb]
+                base = plan.route_cost(va, ra) + plan.route_cost(vb, rb)
+                load_a, load_b = loads_of(ra), loads_of(rb)
+                swapped = False
+                for x in range(len(ra)):
+                    for y in range(len(rb)):
+                        i, j = ra[x], rb[y]
+                        wi, vi_ = shipments[i]["weight"], shipments[i]["volume"]
+                        wj, vj = shipments[j]["weight"], shipments[j]["volume"]
+                        if not (_fits((load_a[0] - wi + wj, load_a[1] - vi_ + vj), caps[va])
+                                and _fits((load_b[0] - wj + wi, load_b[1] - vj + vi_), caps[vb])):
+                            continue
+                        new_a, new_b = ra[:x] + [j] + ra[x + 1:], rb[:y] + [i] + rb[y + 1:]
+                        if plan.route_cost(va, new_a) + plan.route_cost(vb, new_b) < base - EPS:
+                            assigned[va], assigned[vb] = new_a, new_b
+                            swapped = improved = True
+                            break
+                    if swapped:
+                        break
+
+    trips = []
+    for vi, route in sorted(assigned.items()):
+        weight, volume = loads_of(route)
+        trips.append({
+            "vehicle_id": vehicles[vi]["id"],
+            "driver_id": vehicles[vi]["driver_id"],
+            "shipment_ids": [shipments[j]["id"] for j in route],
+            "weight": round(weight, 2),
+            "volume": round(volume, 3),
+            "distance_km": round(plan.route_cost(vi, route), 2),
+        })
+    return {
+        "trips": trips,
+        "unassigned": [shipments[j]["id"] for j in unassigned],
+        "distance_km": round(sum(t["distance_km"] for t in trips), 2),
+        "construction": construction,
+    }
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+async def plan_in_worker(shipments: List[dict], vehicles: List[dict], time_budget_ms: Optional[int] = None) -> dict:
+    """Run plan_routes() in the planner process pool so the event loop stays responsive."""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=WORKERS)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, plan_routes, shipments, vehicles, time_budget_ms)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
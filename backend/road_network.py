@@ -0,0 +1,307 @@
+"""
+Offline road-network distances (contraction hierarchies).
+
+Loads a directed road graph from a local JSON file (optionally gzipped), produced
+from an OpenStreetMap extract by build_road_network.py:
+
+    {"nodes": [[id, lat, lng], ...],
+     "edges": [[from_id, to_id, length_m, speed_kmh, oneway], ...]}
+
+Edges are weighted by travel time. Preprocessing contracts the nodes one at a time
+in order of edge difference (lazy updates), adding a shortcut u -> x around a node
+v only when a bounded witness search finds no path at least as fast that avoids v.
+Every node then keeps only its edges towards more important nodes, so a query is
+two small upward Dijkstra searches that meet at the most important node of the
+shortest path. Many-to-many matrices use the bucket method: one backward search per
+target fills buckets, one forward search per source scans them.
+
+Points are snapped to the nearest graph node; the straight-line distance to that
+node is added at the snapping speed. Pairs with no road path fall back to
+haversine distance. Set ROAD_NETWORK_FILE to load a graph at startup;
+data/sample_road_network.json.gz is a small extract for development.
+"""
+import gzip
+import heapq
+import json
+import math
+import os
+import pickle
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import geodesic
+
+NETWORK_FILE = os.getenv("ROAD_NETWORK_FILE")
+SNAP_SPEED_KMH = float(os.getenv("ROAD_NETWORK_SNAP_SPEED_KMH", "15"))
+FALLBACK_SPEED_KMH = float(os.getenv("ROUTING_AVG_SPEED_KMH", "40"))
+WITNESS_SETTLE_LIMIT = 60
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "sample_road_network.json.gz")
+
+Matrix = List[List[float]]
+Adjacency = List[Dict[int, Tuple[float, float]]]  # node -> {neighbour: (seconds, metres)}
+
+
+def _relax(adj: Adjacency, u: int, v: int, seconds: float, metres: float):
+    current = adj[u].get(v)
+    if current is None or seconds < current[0]:
+        adj[u][v] = (seconds, metres)
+
+
+class RoadNetwork:
+    """Contracted road graph answering shortest travel-time queries between coordinates."""
+
+    def __init__(self, nodes: Sequence[Sequence[float]], edges: Sequence[Sequence[float]]):
+        start = time.perf_counter()
+        self.ids = [int(n[0]) for n in nodes]
+        index = {node_id: k for k, node_id in enumerate(self.ids)}
+        self.coords = np.array([(n[1], n[2]) for n in nodes], dtype=np.float64)
+        n = len(self.ids)
+
+        out_adj: Adjacency = [dict() for _ in range(n)]
+        in_adj: Adjacency = [dict() for _ in range(n)]
+        for edge in edges:
+            u, v = index.get(int(edge[0])), index.get(int(edge[1]))
+            if u is None or v is None or u == v:
+                continue
+            metres, speed = float(edge[2]), float(edge[3]) or FALLBACK_SPEED_KMH
+            seconds = metres / (speed / 3.6)
+            pairs = [(u, v)] if len(edge) > 4 and edge[4] else [(u, v), (v, u)]
+            for a, b in pairs:
+                _relax(out_adj, a, b, seconds, metres)
+                _relax(in_adj, b, a, seconds, metres)
+        self.edge_count = sum(len(a) for a in out_adj)
+
+        self.rank = [0] * n
+        self.up_fwd: List[List[Tuple[int, float, float]]] = [[] for _ in range(n)]
+        self.up_bwd: List[List[Tuple[int, float, float]]] = [[] for _ in range(n)]
+        self.shortcuts = self._contract(out_adj, in_adj)
+        self.preprocess_s = round(time.perf_counter() - start, 3)
+
+        # Equirectangular projection for nearest-node snapping
+        self._cos_lat = math.cos(math.radians(float(self.coords[:, 0].mean()))) if n else 1.0
+        self._proj = np.column_stack((self.coords[:, 0], self.coords[:, 1] * self._cos_lat))
+
+    # --- Preprocessing ---
+
+    def _witness(self, out_adj: Adjacency, contracted: List[bool], source: int, skip: int,
+                 targets: set, limit: float) -> Dict[int, float]:
+        """Bounded Dijkstra from source avoiding `skip`; travel times to the nodes it settled."""
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        settled = 0
+        remaining = set(targets)
+        while heap and remaining and settled < WITNESS_SETTLE_LIMIT:
+            d, u = heapq.heappop(heap)
+            if d > dist.get(u, math.inf):
+                continue
+            if d > limit:
+                break
+            settled += 1
+            remaining.discard(u)
+            for v, (w, _) in out_adj[u].items():
+                if v == skip or contracted[v]:
+                    continue
+                nd = d + w
+                if nd < dist.get(v, math.inf):
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return dist
+
+    def _shortcuts_for(self, v: int, out_adj: Adjacency, in_adj: Adjacency, contracted: List[bool]):
+        """Shortcuts (u, x, seconds, metres) needed to contract v."""
+        needed = []
+        outs = [(x, w) for x, w in out_adj[v].items() if not contracted[x]]
+        if not outs:
+            return needed
+        max_out = max(w[0] for _, w in outs)
+        for u, (w_in, m_in) in in_adj[v].items():
+            if contracted[u]:
+                continue
+            targets = {x for x, _ in outs if x != u}
+            if not targets:
+                continue
+            witness = self._witness(out_adj, contracted, u, v, targets, w_in + max_out)
+            for x, (w_out, m_out) in outs:
+                if x == u:
+                    continue
+                via = w_in + w_out
+                if witness.get(x, math.inf) > via + 1e-9:
+                    needed.append((u, x, via, m_in + m_out))
+        return needed
+
+    def _priority(self, v, out_adj, in_adj, contracted, deleted_neighbours) -> float:
+        degree = sum(1 for x in out_adj[v] if not contracted[x]) + sum(1 for u in in_adj[v] if not contracted[u])
+        return len(self._shortcuts_for(v, out_adj, in_adj, contracted)) - degree + deleted_neighbours[v]
+
+    def _contract(self, out_adj: Adjacency, in_adj: Adjacency) -> int:
+        n = len(out_adj)
+        contracted = [False] * n
+        deleted_neighbours = [0] * n
+        heap = [(self._priority(v, out_adj, in_adj, contracted, deleted_neighbours), v) for v in range(n)]
+        heapq.heapify(heap)
+        shortcuts = 0
+        order = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+            if contracted[v]:
+                continue
+            # Lazy update: re-evaluate and put back if no longer the cheapest
+            priority = self._priority(v, out_adj, in_adj, contracted, deleted_neighbours)
+            if heap and priority > heap[0][0]:
+                heapq.heappush(heap, (priority, v))
+                continue
+
+            for u, x, seconds, metres in self._shortcuts_for(v, out_adj, in_adj, contracted):
+                _relax(out_adj, u, x, seconds, metres)
+                _relax(in_adj, x, u, seconds, metres)
+                shortcuts += 1
+            self.rank[v] = order
+            order += 1
+            contracted[v] = True
+            # Remaining neighbours are all more important than v
+            for x, (w, m) in out_adj[v].items():
+                if not contracted[x]:
+                    self.up_fwd[v].append((x, w, m))
+                    deleted_neighbours[x] += 1
+            for u, (w, m) in in_adj[v].items():
+                if not contracted[u]:
+                    self.up_bwd[v].append((u, w, m))
+                    deleted_neighbours[u] += 1
+        return shortcuts
+
+    # --- Queries ---
+
+    @staticmethod
+    def _upward(graph, source: int) -> Dict[int, Tuple[float, float]]:
+        """Dijkstra over upward edges only: {node: (seconds, metres)}."""
+        best = {source: (0.0, 0.0)}
+        heap = [(0.0, 0.0, source)]
+        while heap:
+            d, m, u = heapq.heappop(heap)
+            if d > best[u][0]:
+                continue
+            for v, w, length in graph[u]:
+                nd = d + w
+                if v not in best or nd < best[v][0]:
+                    best[v] = (nd, m + length)
+                    heapq.heappush(heap, (nd, m + length, v))
+        return best
+
+    def route(self, source: int, target: int) -> Optional[Tuple[float, float]]:
+        """(seconds, metres) of the fastest path between two graph nodes, None if unreachable."""
+        if source == target:
+            return 0.0, 0.0
+        forward = self._upward(self.up_fwd, source)
+        backward = self._upward(self.up_bwd, target)
+        best = None
+        for node, (d, m) in forward.items():
+            other = backward.get(node)
+            if other is not None and (best is None or d + other[0] < best[0]):
+                best = (d + other[0], m + other[1])
+        return best
+
+    def table(self, sources: Sequence[int], targets: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Many-to-many (seconds, metres) matrices between graph nodes (inf where unreachable)."""
+        buckets: Dict[int, List[Tuple[int, float, float]]] = {}
+        for j, t in enumerate(targets):
+            for node, (d, m) in self._upward(self.up_bwd, t).items():
+                buckets.setdefault(node, []).append((j, d, m))
+        seconds = np.full((len(sources), len(targets)), np.inf)
+        metres = np.full((len(sources), len(targets)), np.inf)
+        for i, s in enumerate(sources):
+            row_s, row_m = seconds[i], metres[i]
+            for node, (d, m) in self._upward(self.up_fwd, s).items():
+                for j, db, mb in buckets.get(node, ()):
+                    if d + db < row_s[j]:
+                        row_s[j] = d + db
+                        row_m[j] = m + mb
+        return seconds, metres
+
+    def snap(self, points: Sequence[Tuple[float, float]]) -> Tuple[List[int], np.ndarray]:
+        """Nearest graph node for each (lat, lng) and the straight-line km to it."""
+        pts = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        proj = np.column_stack((pts[:, 0], pts[:, 1] * self._cos_lat))
+        nearest = [int(np.argmin(((self._proj - p) ** 2).sum(axis=1))) for p in proj]
+        return nearest, geodesic.haversine_pairs(pts, self.coords[nearest])
+
+    def matrices(self, points: Sequence[Tuple[float, float]], symmetric: bool = True) -> Tuple[Matrix, Matrix]:
+        """
+        (km, minutes) matrices between the points over the road network. With
+        `symmetric` both directions are averaged (the stop-ordering search assumes
+        symmetric costs).
+        """
+        nodes, offsets = self.snap(points)
+        unique = sorted(set(nodes))
+        col = {node: k for k, node in enumerate(unique)}
+        seconds, metres = self.table(unique, unique)
+        idx = [col[node] for node in nodes]
+        seconds, metres = seconds[np.ix_(idx, idx)], metres[np.ix_(idx, idx)]
+
+        km = metres / 1000.0 + offsets[:, None] + offsets[None, :]
+        minutes = seconds / 60.0 + (offsets[:, None] + offsets[None, :]) / SNAP_SPEED_KMH * 60
+        # No road path: straight line at the fallback speed
+        missing = ~np.isfinite(km)
+        if missing.any():
+            straight = geodesic.haversine_matrix(points)
+            km[missing] = straight[missing]
+            minutes[missing] = straight[missing] / FALLBACK_SPEED_KMH * 60
+        np.fill_diagonal(km, 0.0)
+        np.fill_diagonal(minutes, 0.0)
+        if symmetric:
+            km, minutes = (km + km.T) / 2, (minutes + minutes.T) / 2
+        return km.tolist(), minutes.tolist()
+
+    def stats(self) -> dict:
+        return {"nodes": len(self.ids), "edges": self.edge_count, "shortcuts": self.shortcuts,
+                "preprocess_s": self.preprocess_s}
+
+
+def read_graph(path: str) -> dict:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+_network: Optional[RoadNetwork] = None
+
+
+def load(path: Optional[str] = None) -> Optional[RoadNetwork]:
+    """
+    Load the graph at `path` (default ROAD_NETWORK_FILE; no-op when unset). The
+    contracted graph is cached next to it as <path>.ch.pickle and reused while newer
+    than the graph file.
+    """
+    global _network
+    path = path or NETWORK_FILE
+    if not path:
+        return None
+    cache = path + ".ch.pickle"
+    network = None
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        try:
+            with open(cache, "rb") as f:
+                network = pickle.load(f)
+        except Exception as e:
+            print(f"Road network cache unreadable, rebuilding: {e}")
+    if network is None:
+        graph = read_graph(path)
+        network = RoadNetwork(graph["nodes"], graph["edges"])
+        try:
+            with open(cache, "wb") as f:
+                pickle.dump(network, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            print(f"Road network cache not written: {e}")
+    _network = network
+    print(f"Road network loaded from {path}: {network.stats()}")
+    return network
+
+
+def get() -> Optional[RoadNetwork]:
+    return _network
+
+
+def unload():
+    global _network
+    _network = None
@@ -0,0 +1,165 @@
+"""
+Async client for the external road-distance service.
+
+Trip sequencing runs locally (routing.py); when an external routing API is
+configured, it supplies road distances between the stops instead of straight
+lines. The client is built so that a slow or failing provider can never stall
+trip creation:
+
+- one pooled httpx.AsyncClient (keep-alive connections) for all calls
+- a hard per-call deadline (ROUTING_API_DEADLINE_MS)
+- a circuit breaker: after ROUTING_BREAKER_FAILURES consecutive failures calls are
+  skipped for ROUTING_BREAKER_COOLDOWN_S, then a single trial call decides
+- an LRU/TTL cache keyed by a hash of the waypoint set
+
+Any failure returns None and the caller falls back to the local haversine matrix.
+The request/response format is Google's computeRouteMatrix; point ROUTING_API_URL
+at routing_stub_server.py to exercise the client locally.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+import httpx
+
+import geodesic
+
+DEFAULT_URL = "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix"
+API_URL = os.getenv("ROUTING_API_URL", DEFAULT_URL)
+API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
+DEADLINE_S = int(os.getenv("ROUTING_API_DEADLINE_MS", "3000")) / 1000.0
+MAX_WAYPOINTS = int(os.getenv("ROUTING_API_MAX_WAYPOINTS", "25"))
+BREAKER_FAILURES = int(os.getenv("ROUTING_BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN_S = float(os.getenv("ROUTING_BREAKER_COOLDOWN_S", "30"))
+CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "256"))
+CACHE_TTL_S = float(os.getenv("ROUTING_CACHE_TTL_S", "3600"))
+
+Matrix = List[List[float]]
+
+
+class CircuitBreaker:
+    """Closed -> open after `failures` consecutive errors; half-open after `cooldown` seconds."""
+
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN_S):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial:
+            self._trial = True  # one probe at a time
+            return True
+        return False
+
+    def record_success(self):
+        self.consecutive = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.consecutive += 1
+        self._trial = False
+        if self.opened_at is not None or self.consecutive >= self.failures:
+            self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker()
+_client: Optional[httpx.AsyncClient] = None
+_cache: "OrderedDict[str, Tuple[float, Matrix]]" = OrderedDict()
+stats = {"calls": 0, "cache_hits": 0, "failures": 0, "short_circuited": 0}
+
+
+def enabled() -> bool:
+    return bool(API_KEY) or API_URL != DEFAULT_URL
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(DEADLINE_S),
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
+    return _client
+
+
+def _cache_key(points: Sequence[Tuple[float, float]]) -> str:
+    rounded = [(round(lat, 6), round(lng, 6)) for lat, lng in points]
+    return hashlib.sha256(json.dumps(rounded).encode()).hexdigest()
+
+
+def _waypoints(points):
+    return [{"waypoint": {"location": {"latLng": {"latitude": lat, "longitude": lng}}}} for lat, lng in points]
+
+
+async def _fetch(points: Sequence[Tuple[float, float]]) -> Matrix:
+    headers = {"Content-Type": "application/json", "X-Goog-FieldMask": "originIndex,destinationIndex,distanceMeters,condition"}
+    if API_KEY:
+        headers["X-Goog-Api-Key"] = API_KEY
+    payload = {"origins": _waypoints(points), "destinations": _waypoints(points), "travelMode": "DRIVE"}
+    response = await _get_client().post(API_URL, json=payload, headers=headers)
+    response.raise_for_status()
+
+    # Pairs the provider could not route keep their straight-line distance
+    matrix = geodesic.haversine_matrix(points).tolist()
+    for element in response.json():
+        if element.get("condition", "ROUTE_EXISTS") != "ROUTE_EXISTS" or "distanceMeters" not in element:
+            continue
+        matrix[element.get("originIndex", 0)][element.get("destinationIndex", 0)] = element["distanceMeters"] / 1000.0
+    # The local search assumes symmetric costs: use the mean of both directions
+    n = len(matrix)
+    return [[(matrix[i][j] + matrix[j][i]) / 2 for j in range(n)] for i in range(n)]
+
+
+async def distance_matrix(points: Sequence[Tuple[float, float]]) -> Optional[Matrix]:
+    """Road distance matrix (km) between the points, or None to use the local haversine matrix."""
+    if not enabled() or len(points) < 2 or len(points) > MAX_WAYPOINTS:
+        return None
+    key = _cache_key(points)
+    cached = _cache.get(key)
+    if cached is not None and time.monotonic() - cached[0] < CACHE_TTL_S:
+        _cache.move_to_end(key)
+        stats["cache_hits"] += 1
+        return cached[1]
+    if not breaker.allow():
+        stats["short_circuited"] += 1
+        return None
+
+    stats["calls"] += 1
+    try:
+        matrix = await asyncio.wait_for(_fetch(points), DEADLINE_S)
+    except asyncio.CancelledError:
+        breaker.record_failure()
+        raise
+    except Exception as e:
+        stats["failures"] += 1
+        breaker.record_failure()
+        print(f"Routing API error: {str(e) or type(e).__name__}")
+        return None
+    breaker.record_success()
+    _cache[key] = (time.monotonic(), matrix)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return matrix
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,487 @@
+"""
+Stop ordering for trips.
+
+The distance matrix over the stop coordinates is built once. Routes are open paths:
+they start at the first stop and end wherever the last stop is, so there is no
+return leg.
+
+sequence_pickup_delivery() orders trips that visit every shipment's pickup and drop:
+stops are interleaved so each drop follows its pickup and the load on board never
+exceeds the vehicle's weight/volume capacity, then improved with relocate and 2-opt
+moves until no move helps or the time budget runs out. Node 2*i is shipment i's
+pickup and node 2*i + 1 its drop.
+
+With TimeWindows the same search also keeps every stop inside its time window
+(VRPTW): service at a stop starts no earlier than its window opens (the vehicle
+waits) and no later than it closes. Obviously impossible requests are rejected
+before any search with bounds taken from the distance matrix: a drop that cannot
+be reached from its own pickup in time, or two stops that cannot be served in
+either order. The construction then becomes Solomon's time-oriented nearest
+neighbour, with a deadline-ordered insertion as fallback.
+"""
+import math
+import os
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import geodesic
+import road_network
+
+TIME_BUDGET_MS = int(os.getenv("ROUTING_TIME_BUDGET_MS", "250"))
+AVG_SPEED_KMH = float(os.getenv("ROUTING_AVG_SPEED_KMH", "40"))
+DEFAULT_SERVICE_MIN = float(os.getenv("ROUTING_SERVICE_MIN", "0"))
+EPS = 1e-9
+
+Matrix = List[List[float]]
+
+
+def distance_matrix(points: Sequence[Tuple[float, float]]) -> Matrix:
+    """
+    Symmetric km matrix for a list of (lat, lng), as nested lists for fast scalar lookups.
+    Road distances when a road network is loaded, straight-line otherwise.
+    """
+    if not points:
+        return []
+    network = road_network.get()
+    if network is not None:
+        return network.matrices(points)[0]
+    return geodesic.cached_matrix(points).tolist()
+
+
+def path_length(tour: Sequence[int], matrix: Matrix) -> float:
+    return sum(matrix[tour[k]][tour[k + 1]] for k in range(len(tour) - 1))
+
+
+# --- Pickup and delivery ---
+
+PICKUP, DROP = "PICKUP", "DROP"
+PD_MULTI_START_MAX = 40
+
+
+class TimeWindows:
+    """
+    Time constraints of a pickup and delivery problem, in minutes after the trip start.
+    windows[node] is (earliest, latest) for starting service at the node, either end
+    None when open; service[node] is the minutes spent there. Driving takes
+    km / speed_kmh hours unless `minutes` gives a travel-time matrix over the same nodes
+    (e.g. from the road network). The first stop is reached at minute 0.
+    """
+
+    def __init__(self, windows: Sequence[Tuple[Optional[float], Optional[float]]],
+                 service: Sequence[float], speed_kmh: float = AVG_SPEED_KMH,
+                 minutes: Optional[Matrix] = None):
+        self.earliest = [0.0 if e is None else max(e, 0.0) for e, _ in windows]
+        self.latest = [math.inf if l is None else l for _, l in windows]
+        self.service = [s or 0.0 for s in service]
+        self.speed_kmh = speed_kmh
+        self.minutes = minutes
+        self.constrained = any(l < math.inf for l in self.latest)
+
+    @classmethod
+    def open(cls, nodes: int, speed_kmh: float = AVG_SPEED_KMH, minutes: Optional[Matrix] = None) -> "TimeWindows":
+        return cls([(None, None)] * nodes, [0.0] * nodes, speed_kmh, minutes)
+
+    def drive_min(self, a: int, b: int, matrix: Matrix) -> float:
+        if self.minutes is not None:
+            return self.minutes[a][b]
+        return matrix[a][b] / self.speed_kmh * 60
+
+    def schedule(self, route: Sequence[int], matrix: Matrix) -> Optional[List[Tuple[float, float]]]:
+        """[(arrival, departure)] minutes per stop, or None if some stop misses its window."""
+        out = []
+        t, prev = 0.0, None
+        for node in route:
+            arrival = t if prev is None else t + self.drive_min(prev, node, matrix)
+            start = max(arrival, self.earliest[node])
+            if start > self.latest[node] + EPS:
+                return None
+            t = start + self.service[node]
+            out.append((arrival, t))
+            prev = node
+        return out
+
+    def timeline(self, route: Sequence[int], matrix: Matrix) -> List[Tuple[float, float, float]]:
+        """
+        [(arrival, departure, minutes late)] per stop. Unlike schedule() a missed window
+        does not end the route: the stop is served on arrival and the delay carries on.
+        """
+        out = []
+        t, prev = 0.0, None
+        for node in route:
+            arrival = t if prev is None else t + self.drive_min(prev, node, matrix)
+            start = max(arrival, self.earliest[node])
+            t = start + self.service[node]
+            out.append((arrival, t, max(start - self.latest[node], 0.0)))
+            prev = node
+        return out
+
+    def conflicts(self, matrix: Matrix) -> List[Tuple[int, int]]:
+        """
+        Node pairs that no route can serve, from the matrix alone: (p, d) when shipment
+        p//2's drop cannot be reached from its pickup in time, (a, b) with a < b when
+        neither a-then-b nor b-then-a fits the windows.
+        """
+        if self.minutes is not None:
+            drive = np.asarray(self.minutes, dtype=np.float64)
+        else:
+            drive = np.asarray(matrix, dtype=np.float64) / self.speed_kmh * 60
+        ready = np.asarray(self.earliest) + np.asarray(self.service)
+        latest = np.asarray(self.latest)
+        ok = ready[:, None] + drive <= latest[None, :] + EPS
+        bad = []
+        for node in np.flatnonzero(np.asarray(self.earliest) > latest + EPS):
+            bad.append((int(node), int(node)))
+        n = len(latest) // 2
+        for i in range(n):
+            if not ok[2 * i, 2 * i + 1]:
+                bad.append((2 * i, 2 * i + 1))
+        both = ~ok & ~ok.T
+        np.fill_diagonal(both, False)
+        for a, b in zip(*np.nonzero(np.triu(both))):
+            if a // 2 != b // 2:
+                bad.append((int(a), int(b)))
+        return bad
+
+
+class Infeasible(ValueError):
+    """No stop order satisfies the constraints; `conflicts` holds node pairs proven impossible."""
+
+    def __init__(self, message: str, conflicts: Sequence[Tuple[int, int]] = ()):
+        super().__init__(message)
+        self.conflicts = list(conflicts)
+
+
+def _pd_feasible(route: Sequence[int], loads: Sequence[Tuple[float, float]], capacity: Tuple[float, float],
+                 matrix: Optional[Matrix] = None, tw: Optional[TimeWindows] = None) -> bool:
+    """Every drop after its pickup, the cumulative load within capacity and (with tw) every window met."""
+    cap_w, cap_v = capacity
+    on_board = set()
+    w = v = 0.0
+    for node in route:
+        i = node // 2
+        if node % 2 == 0:
+            on_board.add(i)
+            w += loads[i][0]
+            v += loads[i][1]
+            if w > cap_w + EPS or v > cap_v + EPS:
+                return False
+        else:
+            if i not in on_board:
+                return False
+            w -= loads[i][0]
+            v -= loads[i][1]
+    return tw is None or tw.schedule(route, matrix) is not None
+
+
+def _pd_construct(matrix: Matrix, loads, capacity, start: int = 0, tw: Optional[TimeWindows] = None):
+    """
+    Greedy: from shipment `start`'s pickup, always go to the nearest stop that keeps the route
+    feasible. With tw, "nearest" is Solomon's blend of driving time, waiting time and how
+    soon the stop's window closes; returns None when the greedy runs into a dead end.
+    """
+    n = len(loads)
+    cap_w, cap_v = capacity
+    route = [2 * start]
+    picked, dropped = {start}, set()
+    w, v = loads[start]
+    if tw is not None:
+        if tw.earliest[2 * start] > tw.latest[2 * start] + EPS:
+            return None
+        t = tw.earliest[2 * start] + tw.service[2 * start]
+        horizon = max([l for l in tw.latest if l < math.inf] or [0.0])
+    while len(route) < 2 * n:
+        row = matrix[route[-1]]
+        best, best_d = None, math.inf
+        for i in range(n):
+            if i in dropped:
+                continue
+            if i in picked:
+                node = 2 * i + 1
+            elif w + loads[i][0] <= cap_w + EPS and v + loads[i][1] <= cap_v + EPS:
+                node = 2 * i
+            else:
+                continue
+            score = row[node]
+            if tw is not None:
+                drive = tw.drive_min(route[-1], node, matrix)
+                begin = max(t + drive, tw.earliest[node])
+                if begin > tw.latest[node] + EPS:
+                    continue
+                # Skip stops that would make a drop already on board late
+                finish = begin + tw.service[node]
+                if any(finish + tw.drive_min(node, 2 * j + 1, matrix) > tw.latest[2 * j + 1] + EPS
+                       for j in picked - dropped if 2 * j + 1 != node):
+                    continue
+                urgency = min(tw.latest[node], horizon) - begin
+                score = 0.4 * drive + 0.4 * (begin - t - drive) + 0.2 * urgency
+            if score < best_d:
+                best, best_d = node, score
+        if best is None:
+            return None
+        if tw is not None:
+            t = max(t + tw.drive_min(route[-1], best, matrix), tw.earliest[best]) + tw.service[best]
+        i = best // 2
+        if best % 2 == 0:
+            picked.add(i)
+            w, v = w + loads[i][0], v + loads[i][1]
+        else:
+            dropped.add(i)
+            w, v = w - loads[i][0], v - loads[i][1]
+        route.append(best)
+    return route
+
+
+def _pd_insertion(matrix: Matrix, loads, capacity, tw: TimeWindows) -> Optional[List[int]]:
+    """Insert shipments by closing drop window, each pickup+drop at its cheapest feasible positions."""
+    order = sorted(range(len(loads)), key=lambda i: (tw.latest[2 * i + 1], tw.latest[2 * i]))
+    route: List[int] = []
+    for i in order:
+        p, d = 2 * i, 2 * i + 1
+        candidates = sorted(
+            (_insert_delta(route, a, p, matrix) + _insert_delta(route[:a] + [p] + route[a:], b + 1, d, matrix), a, b)
+            for a in range(len(route) + 1) for b in range(a, len(route) + 1)
+        )
+        for _, a, b in candidates:
+            new_route = route[:a] + [p] + route[a:b] + [d] + route[b:]
+            if _pd_feasible(new_route, loads, capacity, matrix, tw):
+                route = new_route
+                break
+        else:
+            return None
+    return route
+
+
+def _insert_delta(seq: Sequence[int], k: int, node: int, matrix: Matrix) -> float:
+    """Extra length from inserting node before seq[k] (k == len(seq) appends)."""
+    prev = seq[k - 1] if k > 0 else None
+    nxt = seq[k] if k < len(seq) else None
+    delta = 0.0
+    if prev is not None:
+        delta += matrix[prev][node]
+    if nxt is not None:
+        delta += matrix[node][nxt]
+    if prev is not None and nxt is not None:
+        delta -= matrix[prev][nxt]
+    return delta
+
+
+def _pd_relocate_pairs(route: List[int], matrix: Matrix, loads, capacity, deadline: float,
+                       tw: Optional[TimeWindows] = None) -> bool:
+    """Take each shipment's pickup+drop out and reinsert both at their cheapest feasible positions."""
+    improved = False
+    for i in range(len(loads)):
+        if time.perf_counter() > deadline:
+            break
+        p, d = 2 * i, 2 * i + 1
+        rest = [node for node in route if node != p and node != d]
+        removed = path_length(route, matrix) - path_length(rest, matrix)
+        candidates = []
+        for a in range(len(rest) + 1):
+            ins_p = _insert_delta(rest, a, p, matrix)
+            # drop right after the pickup
+            nxt = rest[a] if a < len(rest) else None
+            adjacent = ins_p + matrix[p][d] + (matrix[d][nxt] - matrix[p][nxt] if nxt is not None else 0.0)
+            candidates.append((adjacent - removed, a, a))
+            for b in range(a + 1, len(rest) + 1):
+                candidates.append((ins_p + _insert_delta(rest, b, d, matrix) - removed, a, b))
+        candidates.sort()
+        for delta, a, b in candidates:
+            if delta >= -EPS:
+                break
+            new_route = rest[:a] + [p] + rest[a:b] + [d] + rest[b:]
+            if _pd_feasible(new_route, loads, capacity, matrix, tw):
+                route[:] = new_route
+                improved = True
+                break
+    return improved
+
+
+def _pd_relocate_nodes(route: List[int], matrix: Matrix, loads, capacity, deadline: float,
+                       tw: Optional[TimeWindows] = None) -> bool:
+    """Move single stops to a cheaper feasible position."""
+    improved = False
+    pos = 0
+    while pos < len(route):
+        if time.perf_counter() > deadline:
+            break
+        node = route[pos]
+        rest = route[:pos] + route[pos + 1:]
+        removed = path_length(route, matrix) - path_length(rest, matrix)
+        moved = False
+        for k in sorted(range(len(rest) + 1), key=lambda k: _insert_delta(rest, k, node, matrix)):
+            if k == pos or _insert_delta(rest, k, node, matrix) - removed >= -EPS:
+                break
+            new_route = rest[:k] + [node] + rest[k:]
+            if _pd_feasible(new_route, loads, capacity, matrix, tw):
+                route[:] = new_route
+                improved = moved = True
+                break
+        if not moved:
+            pos += 1
+    return improved
+
+
+def _pd_two_opt(route: List[int], matrix: Matrix, loads, capacity, deadline: float,
+                tw: Optional[TimeWindows] = None) -> bool:
+    """2-opt segment reversals that keep precedence and capacity."""
+    n = len(route)
+    improved = False
+    for i in range(n - 1):
+        if time.perf_counter() > deadline:
+            break
+        for j in range(i + 1, n):
+            delta = 0.0
+            if i > 0:
+                delta += matrix[route[i - 1]][route[j]] - matrix[route[i - 1]][route[i]]
+            if j + 1 < n:
+                delta += matrix[route[i]][route[j + 1]] - matrix[route[j]][route[j + 1]]
+            if delta < -EPS:
+                new_route = route[:i] + route[i:j + 1][::-1] + route[j + 1:]
+                if _pd_feasible(new_route, loads, capacity, matrix, tw):
+                    route[:] = new_route
+                    improved = True
+    return improved
+
+
+def sequence_pickup_delivery(
+    pickups: Sequence[Tuple[float, float]],
+    drops: Sequence[Tuple[float, float]],
+    loads: Sequence[Tuple[float, float]],
+    capacity: Tuple[float, float],
+    time_budget_ms: Optional[int] = None,
+    matrix: Optional[Matrix] = None,
+    windows: Optional[TimeWindows] = None,
+) -> dict:
+    """
+    Order the pickup and drop stops of shipments i = 0..n-1 under precedence and capacity.
+    loads[i] is (weight, volume) and capacity the vehicle's free (weight, volume); every
+    single load must fit. `matrix` (e.g. road distances, nodes ordered pickup_0, drop_0,
+    pickup_1, ...) replaces the straight-line matrix. `windows` adds time windows and
+    service times; raises Infeasible when no order can meet them. Returns
+    {"stops": [(i, PICKUP|DROP), ...], "legs_km": km from the previous stop (None for the
+    first), "schedule": [(arrival_min, departure_min)] per stop, "distance_km",
+    "nearest_neighbour_km", "improvement_pct"} where the baseline is the greedy
+    nearest-feasible-stop route.
+    """
+    n = len(pickups)
+    if n == 0:
+        return {"stops": [], "legs_km": [], "schedule": [], "distance_km": 0.0, "nearest_neighbour_km": 0.0,
+                "improvement_pct": 0.0}
+    if matrix is None:
+        matrix = distance_matrix([pt for i in range(n) for pt in (pickups[i], drops[i])])
+    budget = TIME_BUDGET_MS if time_budget_ms is None else time_budget_ms
+    deadline = time.perf_counter() + budget / 1000.0
+    tw = windows if windows is not None and windows.constrained else None
+
+    if tw is None:
+        # Greedy from every pickup for small trips, from the first one otherwise
+        starts = range(n) if n <= PD_MULTI_START_MAX else [0]
+    else:
+        conflicts = tw.conflicts(matrix)
+        if conflicts:
+            raise Infeasible("Time windows cannot be met", conflicts)
+        # Greedy from the pickups whose windows close first
+        starts = sorted(range(n), key=lambda i: tw.latest[2 * i])[:PD_MULTI_START_MAX]
+    routes = [r for r in (_pd_construct(matrix, loads, capacity, start, tw) for start in starts) if r is not None]
+    if not routes:
+        route = _pd_insertion(matrix, loads, capacity, tw)
+        if route is None:
+            raise Infeasible("No stop order meets every time window")
+        routes = [route]
+    route = min(routes, key=lambda r: path_length(r, matrix))
+    greedy_km = path_length(route, matrix)
+    while time.perf_counter() < deadline:
+        changed = _pd_relocate_pairs(route, matrix, loads, capacity, deadline, tw)
+        changed = _pd_relocate_nodes(route, matrix, loads, capacity, deadline, tw) or changed
+        changed = _pd_two_opt(route, matrix, loads, capacity, deadline, tw) or changed
+        if not changed:
+            break
+    km = path_length(route, matrix)
+    return {
+        "stops": [(node // 2, PICKUP if node % 2 == 0 else DROP) for node in route],
+        "legs_km": [None] + [matrix[route[k - 1]][route[k]] for k in range(1, len(route))],
+        "schedule": (windows or TimeWindows.open(2 * n)).schedule(route, matrix),
+        "distance_km": round(km, 2),
+        "nearest_neighbour_km": round(greedy_km, 2),
+        "improvement_pct": round((greedy_km - km) / greedy_km * 100, 1) if greedy_km > 0 else 0.0,
+    }
+
+
+# --- Editing a planned route ---
+
+def _route_feasible(route: Sequence[int], deltas, capacity, initial_load=(0.0, 0.0),
+                    matrix: Optional[Matrix] = None, tw: Optional[TimeWindows] = None) -> bool:
+    """Load (initial_load plus deltas[node] at each stop) within capacity and, with tw, every window met."""
+    w, v = initial_load
+    for node in route:
+        w += deltas[node][0]
+        v += deltas[node][1]
+        if w > capacity[0] + EPS or v > capacity[1] + EPS:
+            return False
+    return tw is None or tw.schedule(route, matrix) is not None
+
+
+def insert_pickup_delivery(
+    matrix: Matrix,
+    route: Sequence[int],
+    pickup: int,
+    drop: int,
+    deltas: Sequence[Tuple[float, float]],
+    capacity: Tuple[float, float],
+    initial_load: Tuple[float, float] = (0.0, 0.0),
+    origin: Optional[int] = None,
+    windows: Optional[TimeWindows] = None,
+) -> Tuple[float, List[int]]:
+    """
+    Cheapest feasible positions for a new shipment's pickup and drop nodes in an existing
+    route, from insertion deltas alone (the rest of the route keeps its order). deltas[node]
+    is the (weight, volume) change at the stop, initial_load what is on board before
+    route[0], origin the node the vehicle leaves from (stays first). Windows the route
+    already misses are soft: a position is rejected only if it makes a stop late that is
+    on time now (the new stops included). Returns (extra_km, new_route); raises
+    Infeasible when no position fits, with conflicts (node, node) for the stops the
+    cheapest capacity-feasible position would make late.
+    """
+    seq = ([origin] if origin is not None else []) + list(route)
+    lo = 1 if origin is not None else 0
+    tw = windows if windows is not None and windows.constrained else None
+    late_now = set()
+    if tw is not None:
+        late_now = {node for node, (_, _, late) in zip(seq, tw.timeline(seq, matrix)) if late > EPS}
+    candidates = []
+    for a in range(lo, len(seq) + 1):
+        ins_p = _insert_delta(seq, a, pickup, matrix)
+        with_p = seq[:a] + [pickup] + seq[a:]
+        for b in range(a + 1, len(with_p) + 1):
+            candidates.append((ins_p + _insert_delta(with_p, b, drop, matrix), a, b))
+    candidates.sort()
+    blocked = None
+    for delta, a, b in candidates:
+        with_p = seq[:a] + [pickup] + seq[a:]
+        new_seq = with_p[:b] + [drop] + with_p[b:]
+        if not _route_feasible(new_seq[lo:], deltas, capacity, initial_load, matrix, None):
+            continue
+        if tw is None:
+            return delta, new_seq[lo:]
+        made_late = [node for node, (_, _, late) in zip(new_seq, tw.timeline(new_seq, matrix))
+                     if late > EPS and node not in late_now]
+        if not made_late:
+            return delta, new_seq[lo:]
+        if blocked is None:
+            blocked = made_late
+    if blocked is None:
+        raise Infeasible("Vehicle capacity is exceeded at every position")
+    raise Infeasible("Every position makes an on-time stop late", [(node, node) for node in blocked])
+
+
+def removal_delta(matrix: Matrix, route: Sequence[int], nodes: Sequence[int], origin: Optional[int] = None) -> float:
+    """Change in path length (km, <= 0 for metric distances) from dropping `nodes` out of the route."""
+    seq = ([origin] if origin is not None else []) + list(route)
+    delta = 0.0
+    for node in nodes:
+        k = seq.index(node)
+        seq.pop(k)
+        delta -= _insert_delta(seq, k, node, matrix)
+    return delta
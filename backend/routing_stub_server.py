@@ -0,0 +1,43 @@
+"""
+Local stand-in for the routing API (computeRouteMatrix request/response shape).
+
+Road distance is faked as straight-line distance x ROUTING_STUB_DETOUR. Set
+ROUTING_STUB_DELAY_MS to exercise the client deadline and ROUTING_STUB_FAIL=1 to
+trip the circuit breaker.
+
+    uvicorn routing_stub_server:app --port 8081
+    ROUTING_API_URL=http://127.0.0.1:8081/distanceMatrix/v2:computeRouteMatrix uvicorn main:app
+"""
+import asyncio
+import os
+
+from fastapi import FastAPI, HTTPException, Request
+
+import geodesic
+
+DETOUR = float(os.getenv("ROUTING_STUB_DETOUR", "1.3"))
+
+app = FastAPI(title="Routing API stub")
+app.state.requests = 0
+
+
+def _points(waypoints):
+    return [(w["waypoint"]["location"]["latLng"]["latitude"], w["waypoint"]["location"]["latLng"]["longitude"])
+            for w in waypoints]
+
+
+@app.post("/distanceMatrix/v2:computeRouteMatrix")
+async def compute_route_matrix(request: Request):
+    app.state.requests += 1
+    delay_ms = int(os.getenv("ROUTING_STUB_DELAY_MS", "0"))
+    if delay_ms:
+        await asyncio.sleep(delay_ms / 1000.0)
+    if os.getenv("ROUTING_STUB_FAIL") == "1":
+        raise HTTPException(503, "Stub configured to fail")
+    body = await request.json()
+    origins, destinations = _points(body["origins"]), _points(body["destinations"])
+    km = geodesic.haversine_matrix(origins, destinations) * DETOUR
+    return [
+        {"originIndex": i, "destinationIndex": j, "distanceMeters": int(km[i][j] * 1000), "condition": "ROUTE_EXISTS"}
+        for i in range(len(origins)) for j in range(len(destinations))
+    ]
@@ -3,7 +3,7 @@ from typing import Optional, List, Any
 import datetime
 from models import (UserRole, UserStatus, DeliveryStatus, DockType, DockStatus,
                      ShipmentStatus, VehicleStatus, VehicleType, ZoneStatus,
-                     TripStatus, TripStopStatus)
+                     TripStatus, TripStopStatus, TripStopType)
 
 # --- Auth ---
 class Token(BaseModel):
@@ -245,6 +245,7 @@ class VehicleResponse(VehicleBase):
     current_weight_used: float = 0.0
     current_volume_used: float = 0.0
     current_driver_id: Optional[int] = None
+    version: int = 0
     zone_id: Optional[int] = None
     created_at: datetime.datetime
 
@@ -332,6 +333,11 @@ class ShipmentCreate(BaseModel):
     total_volume: float = 0.0
     description: Optional[str] = None
     special_instructions: Optional[str] = None
+    pickup_window_start: Optional[datetime.datetime] = None
+    pickup_window_end: Optional[datetime.datetime] = None
+    drop_window_start: Optional[datetime.datetime] = None
+    drop_window_end: Optional[datetime.datetime] = None
+    service_time_min: Optional[float] = None  # Minutes at each stop (defaults to ROUTING_SERVICE_MIN)
     items: List[ShipmentItemCreate] = []
 
 class ShipmentUpdate(BaseModel):
@@ -342,6 +348,11 @@ class ShipmentUpdate(BaseModel):
     special_instructions: Optional[str] = None
     total_weight: Optional[float] = None
     total_volume: Optional[float] = None
+    pickup_window_start: Optional[datetime.datetime] = None
+    pickup_window_end: Optional[datetime.datetime] = None
+    drop_window_start: Optional[datetime.datetime] = None
+    drop_window_end: Optional[datetime.datetime] = None
+    service_time_min: Optional[float] = None
 
 class ShipmentTimelineResponse(BaseModel):
     id: int
@@ -372,6 +383,11 @@ class ShipmentResponse(BaseModel):
     total_volume: float = 0.0
     description: Optional[str] = None
     special_instructions: Optional[str] = None
+    pickup_window_start: Optional[datetime.datetime] = None
+    pickup_window_end: Optional[datetime.datetime] = None
+    drop_window_start: Optional[datetime.datetime] = None
+    drop_window_end: Optional[datetime.datetime] = None
+    service_time_min: Optional[float] = None
     zone_id: Optional[int] = None
     assigned_vehicle_id: Optional[int] = None
     assigned_driver_id: Optional[int] = None
@@ -395,11 +411,19 @@ class ShipmentResponse(BaseModel):
 class DispatchRequest(BaseModel):
     vehicle_id: Optional[int] = None  # Optional manual override
     driver_id: Optional[int] = None
+    policy: Optional[str] = None  # best_fit | worst_fit | nearest (defaults to DISPATCH_VEHICLE_POLICY)
+    queue: bool = False  # Enqueue for micro-batched dispatch and return 202 with a job id
 
 class AssignRequest(BaseModel):
     vehicle_id: int
     driver_id: int
 
+class BatchDispatchRequest(BaseModel):
+    zone_id: Optional[int] = None
+    date_from: Optional[datetime.date] = None
+    date_to: Optional[datetime.date] = None
+    dry_run: bool = False  # Solve and report without writing assignments
+
 # --- Notifications ---
 class NotificationResponse(BaseModel):
     id: int
@@ -439,11 +463,32 @@ class TripCreate(BaseModel):
     shipment_ids: List[int]
     vehicle_id: int
     driver_id: int
+    start_at: Optional[datetime.datetime] = None  # Planned departure (defaults to now)
+
+class TripPlanRequest(BaseModel):
+    zone_id: Optional[int] = None  # Only plan shipments in this zone
+    time_budget_ms: Optional[int] = None  # Local-search budget (defaults to PLANNER_TIME_BUDGET_MS)
+
+class TripPlanCommit(BaseModel):
+    trips: List[TripCreate]  # Proposed trips from POST /trips/plan (possibly edited)
 
 class UpdateTripLocationRequest(BaseModel):
     lat: float
     lng: float
 
+class LocationPoint(BaseModel):
+    lat: float
+    lng: float
+    at: datetime.datetime  # when the device recorded the point
+
+class LocationBatchRequest(BaseModel):
+    """Points a driver's device recorded while offline, in any order."""
+    points: List[LocationPoint]
+    trip_id: Optional[int] = None  # defaults to the driver's active trip
+
+class TripStopAdd(BaseModel):
+    shipment_id: int
+
 class CompleteStopRequest(BaseModel):
     notes: Optional[str] = None
 
@@ -452,11 +497,18 @@ class TripStopResponse(BaseModel):
     trip_id: int
     shipment_id: int
     sequence_order: int
+    stop_type: TripStopType = TripStopType.PICKUP
     estimated_distance_km: Optional[float] = None
     estimated_duration_min: Optional[float] = None
+    planned_arrival_at: Optional[datetime.datetime] = None
+    planned_departure_at: Optional[datetime.datetime] = None
+    eta_at: Optional[datetime.datetime] = None
     status: TripStopStatus
     notes: Optional[str] = None
     completed_at: Optional[datetime.datetime] = None
+    arrived_at: Optional[datetime.datetime] = None
+    departed_at: Optional[datetime.datetime] = None
+    dwell_min: Optional[float] = None
     shipment: Optional[ShipmentResponse] = None
 
     class Config:
@@ -471,9 +523,11 @@ class TripResponse(BaseModel):
     status: TripStatus
     total_distance_km: Optional[float] = None
     total_duration_min: Optional[float] = None
+    planned_start_at: Optional[datetime.datetime] = None
     current_lat: Optional[float] = None
     current_lng: Optional[float] = None
     last_location_at: Optional[datetime.datetime] = None
+    eta_completion_at: Optional[datetime.datetime] = None
     started_at: Optional[datetime.datetime] = None
     completed_at: Optional[datetime.datetime] = None
     created_at: datetime.datetime
@@ -0,0 +1,169 @@
+"""
+Driver telemetry over one long-lived WebSocket.
+
+The driver app authenticates once when it connects and then sends frames holding a
+batch of GPS points (position, speed, heading) instead of one HTTPS request per
+point. Each frame is acknowledged with {"type": "ack", "seq", "accepted", "stale",
+"rejected", "trip_id"} so the app can drop what the server has; a bad frame gets
+{"type": "error", "seq", "detail"} and the connection stays open. The connection is
+closed with 1008 at the first frame after the token expires.
+
+Frame encodings:
+    packed   binary, first byte 0x01, then uint32 seq and 16-byte points
+             <int32 lat*1e7, int32 lng*1e7, uint32 epoch s, uint16 speed km/h*10,
+             uint16 heading deg*10>; 0xFFFF means unknown speed/heading
+    msgpack  binary map {"seq": n, "points": [[lat, lng, epoch_s, speed_kmh, heading], ...]}
+             (needs the msgpack package on the server)
+    JSON     text frame with the same map as msgpack
+Replies are msgpack for msgpack frames and JSON text otherwise. Points recorded
+offline belong in POST /driver/locations/batch: a point older than the trip's latest
+one is only counted as stale here.
+"""
+import datetime
+import json
+import os
+import struct
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, WebSocket
+
+try:
+    import msgpack
+except ImportError:  # optional: packed and JSON frames work without it
+    msgpack = None
+
+MAX_POINTS = int(os.getenv("TELEMETRY_MAX_POINTS", "500"))
+
+PACKED = 0x01
+_HEADER = struct.Struct("<BI")
+_POINT = struct.Struct("<iiIHH")
+_UNKNOWN = 0xFFFF
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# (lat, lng, at, speed_kmh, heading)
+Point = Tuple[float, float, datetime.datetime, Optional[float], Optional[float]]
+Ingest = Callable[[List[Point]], Awaitable[dict]]
+
+stats = {
+    "connections": 0, "connections_total": 0, "frames": 0, "points": 0, "bytes": 0,
+    "frame_errors": 0, "expired_disconnects": 0,
+}
+
+
+class FrameError(ValueError):
+    def __init__(self, message: str, seq: Optional[int] = None):
+        super().__init__(message)
+        self.seq = seq
+
+
+def pack(points: Sequence[Point], seq: int = 0) -> bytes:
+    """Encode points as a packed frame (what the driver app sends)."""
+    body = [
+        _POINT.pack(round(lat * 1e7), round(lng * 1e7), int((at - _EPOCH).total_seconds()),
+                    _UNKNOWN if speed is None else min(max(round(speed * 10), 0), _UNKNOWN - 1),
+                    _UNKNOWN if heading is None else round(heading % 360 * 10))
+        for lat, lng, at, speed, heading in points
+    ]
+    return _HEADER.pack(PACKED, seq) + b"".join(body)
+
+
+def _unpack(data: bytes) -> Tuple[int, List[Point]]:
+    if (len(data) - _HEADER.size) % _POINT.size:
+        raise FrameError("Packed frame length is not a whole number of points")
+    _, seq = _HEADER.unpack_from(data)
+    points = []
+    for lat, lng, ts, speed, heading in _POINT.iter_unpack(data[_HEADER.size:]):
+        points.append((lat / 1e7, lng / 1e7, _EPOCH + datetime.timedelta(seconds=ts),
+                       None if speed == _UNKNOWN else speed / 10, None if heading == _UNKNOWN else heading / 10))
+    return seq, points
+
+
+def _from_map(body) -> Tuple[Optional[int], List[Point]]:
+    if not isinstance(body, dict) or not isinstance(body.get("points"), list):
+        raise FrameError('Frame must be a map with a "points" list')
+    seq = body.get("seq")
+    points = []
+    try:
+        for p in body["points"]:
+            if not isinstance(p, (list, tuple)):
+                raise TypeError("point is not a list")
+            lat, lng, ts = float(p[0]), float(p[1]), float(p[2])
+            speed = float(p[3]) if len(p) > 3 and p[3] is not None else None
+            heading = float(p[4]) if len(p) > 4 and p[4] is not None else None
+            points.append((lat, lng, _EPOCH + datetime.timedelta(seconds=ts), speed, heading))
+    except (TypeError, ValueError, IndexError, OverflowError):
+        raise FrameError("Points are [lat, lng, epoch_s, speed_kmh?, heading?]", seq)
+    return seq, points
+
+
+def is_msgpack(message: dict) -> bool:
+    data = message.get("bytes")
+    return msgpack is not None and bool(data) and data[0] != PACKED
+
+
+def decode(message: dict) -> Tuple[Optional[int], List[Point]]:
+    """A websocket.receive message -> (seq, points)."""
+    data, text = message.get("bytes"), message.get("text")
+    if data:
+        stats["bytes"] += len(data)
+        if data[0] == PACKED:
+            return _unpack(data)
+        if msgpack is None:
+            raise FrameError("msgpack frames are not supported by this server; send packed (0x01) or JSON frames")
+        try:
+            body = msgpack.unpackb(data, raw=False)
+        except Exception:
+            raise FrameError("Frame is not valid msgpack")
+        return _from_map(body)
+    if text:
+        stats["bytes"] += len(text)
+        try:
+            body = json.loads(text)
+        except ValueError:
+            raise FrameError("Frame is not valid JSON")
+        return _from_map(body)
+    raise FrameError("Empty frame")
+
+
+async def _reply(websocket: WebSocket, body: dict, binary: bool):
+    if binary:
+        await websocket.send_bytes(msgpack.packb(body, default=str))
+    else:
+        await websocket.send_text(json.dumps(body, default=str))
+
+
+async def serve(websocket: WebSocket, ingest: Ingest, expires_at: Optional[datetime.datetime]):
+    """Acknowledge frames until the client disconnects or its token expires."""
+    stats["connections"] += 1
+    stats["connections_total"] += 1
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if expires_at is not None and datetime.datetime.utcnow() >= expires_at:
+                stats["expired_disconnects"] += 1
+                await websocket.close(code=1008, reason="Token expired")
+                return
+            stats["frames"] += 1
+            seq, binary = None, is_msgpack(message)
+            try:
+                seq, points = decode(message)
+                if len(points) > MAX_POINTS:
+                    raise FrameError(f"At most {MAX_POINTS} points per frame")
+                stats["points"] += len(points)
+                result = await ingest(points)
+            except (FrameError, HTTPException) as e:
+                stats["frame_errors"] += 1
+                if isinstance(e, FrameError) and seq is None:
+                    seq = e.seq
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                await _reply(websocket, {"type": "error", "seq": seq, "detail": detail}, binary)
+                continue
+            await _reply(websocket, {"type": "ack", "seq": seq, **result}, binary)
+    finally:
+        stats["connections"] -= 1
+
+
+def metrics() -> dict:
+    return {**stats, "msgpack": msgpack is not None, "max_points": MAX_POINTS}
@@ -0,0 +1,139 @@
+"""
+Simplification and encoding of recorded tracks for map payloads.
+
+Tracks are projected to local metres and simplified with Douglas-Peucker (largest
+deviation from the chord, vectorised per span) or Visvalingam-Whyatt (smallest
+triangle area first). The tolerance follows the map zoom: TRACK_PIXEL_TOLERANCE
+screen pixels at the track's latitude, so a zoomed-out map gets far fewer points.
+Results are cached per (trip, history version, range, algorithm, tolerance); a new
+ping bumps the trip's history version, so finished trips are served from memory.
+"""
+import heapq
+import math
+import os
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Sequence
+
+import numpy as np
+
+PIXEL_TOLERANCE = float(os.getenv("TRACK_PIXEL_TOLERANCE", "1.0"))
+CACHE_SIZE = int(os.getenv("TRACK_CACHE_SIZE", "256"))
+EARTH_RADIUS_M = 6371008.8
+METRES_PER_PIXEL_Z0 = 156543.03392  # Web Mercator at the equator, zoom 0
+
+
+def zoom_tolerance_m(zoom: float, lat: float, pixels: float = PIXEL_TOLERANCE) -> float:
+    return pixels * METRES_PER_PIXEL_Z0 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+
+def _project(latlng: np.ndarray) -> np.ndarray:
+    """Equirectangular projection around the track's mean latitude, in metres."""
+    lat = np.radians(latlng[:, 0])
+    lng = np.radians(latlng[:, 1])
+    return np.column_stack((lng * math.cos(lat.mean()) * EARTH_RADIUS_M, lat * EARTH_RADIUS_M))
+
+
+def douglas_peucker(xy: np.ndarray, tolerance: float) -> np.ndarray:
+    """Keep-mask of the points; distances of a span are computed in one vector operation."""
+    n = len(xy)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        seg = xy[j] - xy[i]
+        rel = xy[i + 1:j] - xy[i]
+        length2 = float(seg @ seg)
+        t = np.clip(rel @ seg / length2, 0.0, 1.0) if length2 > 0 else np.zeros(len(rel))
+        dist = np.hypot(rel[:, 0] - t * seg[0], rel[:, 1] - t * seg[1])
+        k = int(dist.argmax())
+        if dist[k] > tolerance:
+            mid = i + 1 + k
+            keep[mid] = True
+            stack.append((i, mid))
+            stack.append((mid, j))
+    return keep
+
+
+def _areas(xy: np.ndarray, a: np.ndarray, b: np.ndarray, c: np.ndarray) -> np.ndarray:
+    return 0.5 * np.abs((xy[b, 0] - xy[a, 0]) * (xy[c, 1] - xy[a, 1]) - (xy[c, 0] - xy[a, 0]) * (xy[b, 1] - xy[a, 1]))
+
+
+def visvalingam(xy: np.ndarray, tolerance: float) -> np.ndarray:
+    """Keep-mask after repeatedly dropping the point with the smallest effective area below tolerance^2."""
+    n = len(xy)
+    keep = np.ones(n, dtype=bool)
+    if n < 3:
+        return keep
+    mid = np.arange(1, n - 1)
+    area = [math.inf] + _areas(xy, mid - 1, mid, mid + 1).tolist() + [math.inf]
+    prev, nxt = list(range(-1, n - 1)), list(range(1, n + 1))
+    heap = [(area[i], i) for i in range(1, n - 1)]
+    heapq.heapify(heap)
+    threshold = tolerance ** 2
+    xs, ys = xy[:, 0].tolist(), xy[:, 1].tolist()
+    while heap:
+        a, i = heapq.heappop(heap)
+        if not keep[i] or a != area[i]:
+            continue  # stale entry
+        if a >= threshold:
+            break
+        keep[i] = False
+        p, q = prev[i], nxt[i]
+        nxt[p], prev[q] = q, p
+        for k in (p, q):
+            if 0 < k < n - 1:
+                # Never below the removed area, so removal order stays monotone
+                u, w = prev[k], nxt[k]
+                triangle = 0.5 * abs((xs[k] - xs[u]) * (ys[w] - ys[u]) - (xs[w] - xs[u]) * (ys[k] - ys[u]))
+                area[k] = max(triangle, a)
+                heapq.heappush(heap, (area[k], k))
+    return keep
+
+
+def simplify(latlng: Sequence[Sequence[float]], tolerance_m: float, algorithm: str = "dp") -> np.ndarray:
+    """Indices of the points kept from (lat, lng) points within tolerance_m metres."""
+    points = np.asarray(latlng, dtype=np.float64).reshape(-1, 2)
+    if len(points) < 3 or tolerance_m <= 0:
+        return np.arange(len(points))
+    xy = _project(points)
+    keep = visvalingam(xy, tolerance_m) if algorithm == "vw" else douglas_peucker(xy, tolerance_m)
+    return np.flatnonzero(keep)
+
+
+def encode_polyline(latlng: Sequence[Sequence[float]], precision: int = 5) -> str:
+    """Google encoded polyline of (lat, lng) points."""
+    ints = np.round(np.asarray(latlng, dtype=np.float64).reshape(-1, 2) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(ints, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    values = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    chars: List[str] = []
+    for v in values.tolist():
+        while v >= 0x20:
+            chars.append(chr((0x20 | (v & 0x1F)) + 63))
+            v >>= 5
+        chars.append(chr(v + 63))
+    return "".join(chars)
+
+
+_cache: "OrderedDict[Hashable, object]" = OrderedDict()
+stats = {"hits": 0, "misses": 0}
+
+
+def cache_get(key: Hashable) -> Optional[object]:
+    value = _cache.get(key)
+    if value is None:
+        stats["misses"] += 1
+        return None
+    _cache.move_to_end(key)
+    stats["hits"] += 1
+    return value
+
+
+def cache_put(key: Hashable, value: object):
+    _cache[key] = value
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
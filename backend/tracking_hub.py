@@ -0,0 +1,137 @@
+"""
+Live tracking hub: pushes vehicle positions to map views over WebSocket or SSE.
+
+The location-update endpoints publish each accepted ping to the channel of its
+company and of its trip. Every connection owns a Subscriber that keeps only the
+latest message per trip until the connection has sent the previous batch, so a
+slow consumer receives fewer, fresher updates instead of a growing backlog, and
+publishing never waits on a client. If more than TRACKING_MAX_PENDING trips are
+waiting the oldest are dropped, and a WebSocket send that takes longer than
+TRACKING_SEND_TIMEOUT_S closes the connection.
+
+Frames are JSON: {"type": "positions", "data": [{trip_id, vehicle_id, lat, lng, at}, ...]};
+positions sent over driver telemetry also carry speed_kmh and heading.
+"""
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+import anyio
+from fastapi import WebSocket
+
+MAX_PENDING = int(os.getenv("TRACKING_MAX_PENDING", "1000"))
+SEND_TIMEOUT_S = float(os.getenv("TRACKING_SEND_TIMEOUT_S", "5"))
+HEARTBEAT_S = float(os.getenv("TRACKING_HEARTBEAT_S", "15"))
+
+stats = {"published": 0, "delivered": 0, "coalesced": 0, "dropped": 0, "slow_disconnects": 0}
+
+
+class Subscriber:
+    """One connection's view of a channel: the latest undelivered message per trip."""
+
+    def __init__(self, company_id: Optional[int], trip_id: Optional[int] = None):
+        self.company_id = company_id
+        self.trip_id = trip_id
+        self.pending: "OrderedDict[int, dict]" = OrderedDict()
+        self.ready = asyncio.Event()
+
+    def offer(self, trip_id: int, message: dict):
+        if trip_id in self.pending:
+            stats["coalesced"] += 1
+            self.pending.move_to_end(trip_id)
+        self.pending[trip_id] = message
+        while len(self.pending) > MAX_PENDING:
+            self.pending.popitem(last=False)
+            stats["dropped"] += 1
+        self.ready.set()
+
+    async def next_batch(self, timeout: float) -> List[dict]:
+        """Everything waiting, or [] after `timeout` seconds without news."""
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        batch = list(self.pending.values())
+        self.pending.clear()
+        self.ready.clear()
+        stats["delivered"] += len(batch)
+        return batch
+
+
+_by_company: Dict[int, Set[Subscriber]] = {}
+_by_trip: Dict[int, Set[Subscriber]] = {}
+
+
+def subscribe(sub: Subscriber):
+    channels = _by_trip if sub.trip_id is not None else _by_company
+    channels.setdefault(sub.trip_id if sub.trip_id is not None else sub.company_id, set()).add(sub)
+
+
+def unsubscribe(sub: Subscriber):
+    channels = _by_trip if sub.trip_id is not None else _by_company
+    key = sub.trip_id if sub.trip_id is not None else sub.company_id
+    subs = channels.get(key)
+    if subs is not None:
+        subs.discard(sub)
+        if not subs:
+            del channels[key]
+
+
+def publish(company_id: Optional[int], trip_id: int, message: dict):
+    """Hand a message to every subscriber of the company and of the trip; never blocks."""
+    stats["published"] += 1
+    for sub in _by_company.get(company_id, ()) if company_id is not None else ():
+        sub.offer(trip_id, message)
+    for sub in _by_trip.get(trip_id, ()):
+        sub.offer(trip_id, message)
+
+
+def _frame(batch: List[dict]) -> str:
+    return json.dumps({"type": "positions", "data": batch}, default=str)
+
+
+async def serve_websocket(websocket: WebSocket, sub: Subscriber):
+    """Send batches until the client disconnects or cannot keep up."""
+    subscribe(sub)
+
+    async def receiver(scope: anyio.CancelScope):
+        # Clients do not send anything; reading only notices the disconnect
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+        scope.cancel()
+
+    try:
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(receiver, tg.cancel_scope)
+            while True:
+                batch = await sub.next_batch(HEARTBEAT_S)
+                frame = _frame(batch) if batch else json.dumps({"type": "heartbeat"})
+                with anyio.move_on_after(SEND_TIMEOUT_S) as send_scope:
+                    await websocket.send_text(frame)
+                if send_scope.cancelled_caught:
+                    stats["slow_disconnects"] += 1
+                    await websocket.close(code=1013)
+                    tg.cancel_scope.cancel()
+    finally:
+        unsubscribe(sub)
+
+
+async def sse_events(sub: Subscriber) -> AsyncIterator[str]:
+    """Server-sent events; the response stream itself applies the backpressure."""
+    subscribe(sub)
+    try:
+        while True:
+            batch = await sub.next_batch(HEARTBEAT_S)
+            yield f"data: {_frame(batch)}\n\n" if batch else ": heartbeat\n\n"
+    finally:
+        unsubscribe(sub)
+
+
+def metrics() -> dict:
+    return {
+        **stats,
+        "company_subscribers": sum(len(subs) for subs in _by_company.values()),
+        "trip_subscribers": sum(len(subs) for subs in _by_trip.values()),
+    }
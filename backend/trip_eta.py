@@ -0,0 +1,153 @@
+"""
+Live ETAs for the remaining stops of a trip.
+
+Each location ping of a trip is kept for ETA_SPEED_WINDOW_S; the distance covered
+between pings over that window gives the observed speed. It is blended with the
+planning speed (full weight once the window is covered) and turned into a pace
+factor. Planned leg durations are scaled by that factor. ETAs run from the latest
+position, along the remaining stops in sequence, waiting for time windows and
+adding service times.
+
+Results are cached per trip and only recomputed after a new ping or a stop status
+change (invalidate()), so polling the tracking views costs a dict lookup. A trip
+without a position runs from its planned start; its ETAs are cached only until that
+start passes, since from then on they run from the current time.
+"""
+import datetime
+import os
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import geodesic
+import models
+import routing
+
+SPEED_WINDOW_S = float(os.getenv("ETA_SPEED_WINDOW_S", "600"))
+MIN_SPEED_KMH = float(os.getenv("ETA_MIN_SPEED_KMH", "5"))
+MAX_SPEED_KMH = float(os.getenv("ETA_MAX_SPEED_KMH", "90"))
+MAX_PINGS = 50
+
+_DONE = (models.TripStopStatus.COMPLETED, models.TripStopStatus.SKIPPED)
+
+_pings: Dict[int, Deque[Tuple[datetime.datetime, float, float]]] = {}
+_cache: Dict[int, Tuple[dict, Optional[datetime.datetime]]] = {}  # trip_id -> (result, valid until)
+
+
+def record_ping(trip_id: int, lat: float, lng: float, at: Optional[datetime.datetime] = None):
+    """Remember a position of the trip and drop its cached ETAs."""
+    at = at or datetime.datetime.utcnow()
+    pings = _pings.setdefault(trip_id, deque(maxlen=MAX_PINGS))
+    if pings and at < pings[-1][0]:
+        return  # late point from an offline backlog
+    pings.append((at, lat, lng))
+    while pings and (at - pings[0][0]).total_seconds() > SPEED_WINDOW_S:
+        pings.popleft()
+    _cache.pop(trip_id, None)
+
+
+def invalidate(trip_id: int):
+    _cache.pop(trip_id, None)
+
+
+def forget(trip_id: int):
+    """Trip finished or cancelled: drop its pings and ETAs."""
+    _pings.pop(trip_id, None)
+    _cache.pop(trip_id, None)
+
+
+def observed_speed(trip_id: int) -> Tuple[float, str]:
+    """(km/h, source): the blended observed speed, or the planning speed without enough pings."""
+    pings = _pings.get(trip_id)
+    if not pings or len(pings) < 2:
+        return routing.AVG_SPEED_KMH, "planned"
+    span_s = (pings[-1][0] - pings[0][0]).total_seconds()
+    if span_s < 30:
+        return routing.AVG_SPEED_KMH, "planned"
+    lats = [(p[1], p[2]) for p in pings]
+    km = float(geodesic.haversine_pairs(lats[:-1], lats[1:]).sum())
+    speed = min(max(km / (span_s / 3600), MIN_SPEED_KMH), MAX_SPEED_KMH)
+    weight = min(span_s / SPEED_WINDOW_S, 1.0)
+    return weight * speed + (1 - weight) * routing.AVG_SPEED_KMH, "observed"
+
+
+def cached(trip_id: int, now: Optional[datetime.datetime] = None) -> Optional[dict]:
+    entry = _cache.get(trip_id)
+    if entry is None:
+        return None
+    result, valid_until = entry
+    if valid_until is not None and (now or datetime.datetime.utcnow()) >= valid_until:
+        _cache.pop(trip_id, None)
+        return None
+    return result
+
+
+def compute(trip: models.Trip, stops: List[models.TripStop], now: Optional[datetime.datetime] = None,
+            position: Optional[Tuple[Optional[float], Optional[float], Optional[datetime.datetime]]] = None) -> dict:
+    """
+    ETAs for the trip's remaining stops (stops need their shipment loaded); cached until
+    invalidated, or until the planned start when there is no position yet. position is the trip's (lat, lng, at), e.g. from location_buffer.overlay;
+    the trip row's columns by default.
+    """
+    now = now or datetime.datetime.utcnow()
+    lat, lng, located_at = position or (trip.current_lat, trip.current_lng, trip.last_location_at)
+    remaining = [st for st in sorted(stops, key=lambda st: st.sequence_order) if st.status not in _DONE]
+    speed, source = observed_speed(trip.id)
+    pace = routing.AVG_SPEED_KMH / speed
+
+    has_position = lat is not None and lng is not None
+    if has_position:
+        clock = located_at or now
+    else:
+        clock = max(trip.planned_start_at or now, now)
+
+    etas = []
+    prev_point = (lat, lng) if has_position else None
+    reachable = True
+    for k, st in enumerate(remaining):
+        s = st.shipment
+        is_drop = st.stop_type == models.TripStopType.DROP
+        point = (s.drop_lat, s.drop_lng) if is_drop else (s.pickup_lat, s.pickup_lng)
+        point = point if point[0] is not None and point[1] is not None else None
+
+        # Leg into this stop: from the live position for the first stop, the planned leg otherwise
+        if k == 0 and prev_point is not None and point is not None:
+            km = routing.distance_matrix([prev_point, point])[0][1]
+            leg_min = km / routing.AVG_SPEED_KMH * 60
+        elif k == 0:
+            km, leg_min = 0.0, 0.0
+        elif st.estimated_distance_km is not None:
+            km = st.estimated_distance_km
+            leg_min = st.estimated_duration_min if st.estimated_duration_min is not None else km / routing.AVG_SPEED_KMH * 60
+        else:
+            reachable = False
+        if point is None:
+            reachable = False
+
+        if not reachable:
+            etas.append({"stop_id": st.id, "sequence_order": st.sequence_order, "shipment_id": st.shipment_id,
+                         "stop_type": st.stop_type.value, "distance_km": None, "eta_at": None})
+            continue
+        clock += datetime.timedelta(minutes=leg_min * pace)
+        etas.append({"stop_id": st.id, "sequence_order": st.sequence_order, "shipment_id": st.shipment_id,
+                     "stop_type": st.stop_type.value, "distance_km": round(km, 2),
+                     "eta_at": clock.replace(microsecond=0)})
+        window_start = s.drop_window_start if is_drop else s.pickup_window_start
+        if window_start and window_start > clock:
+            clock = window_start
+        service = s.service_time_min if s.service_time_min is not None else routing.DEFAULT_SERVICE_MIN
+        clock += datetime.timedelta(minutes=service)
+
+    result = {
+        "trip_id": trip.id,
+        "computed_at": now.replace(microsecond=0),
+        "position": {"lat": lat, "lng": lng, "at": located_at} if has_position else None,
+        "speed_kmh": round(speed, 1),
+        "speed_source": source,
+        "stops": etas,
+        "completion_eta_at": etas[-1]["eta_at"] if etas and reachable else None,
+    }
+    if has_position:
+        _cache[trip.id] = (result, None)
+    elif trip.planned_start_at and trip.planned_start_at > now:
+        _cache[trip.id] = (result, trip.planned_start_at)
+    return result
@@ -0,0 +1,171 @@
+"""
+Capacity-ordered index of AVAILABLE vehicles.
+
+Each company gets its AVAILABLE vehicles kept sorted by remaining (weight, volume)
+capacity - once for the whole fleet and once per zone - in buckets that know their
+largest remaining volume, so dispatch can bisect to the vehicles that can take a
+shipment's weight and skip runs of them without the volume, instead of loading and
+scanning every vehicle:
+
+    best_fit   smallest remaining weight that still fits (packs vehicles tightly)
+    worst_fit  largest remaining weight (spreads load across the fleet)
+    nearest    closest vehicle to the pickup that fits (ranked by the fleet_positions grid),
+               falling back to best_fit when no positioned vehicle fits
+
+The live fleet store (fleet_state) keeps one index per company and syncs it from
+the same committed vehicle changes it applies to its own entries. The database
+stays the source of truth: callers reserve the chosen vehicle with
+capacity.reserve_capacity() and resync the entry if another worker got there
+first. Entries remember Vehicle.version so a late sync of an older row cannot
+overwrite a newer one.
+"""
+import bisect
+import os
+from typing import Dict, List, Optional, Tuple
+
+import models
+
+POLICIES = ("best_fit", "worst_fit", "nearest")
+DEFAULT_POLICY = os.getenv("DISPATCH_VEHICLE_POLICY", "best_fit")
+
+BUCKET_SIZE = 32
+
+Key = Tuple[float, float, int]  # (remaining_weight, remaining_volume, vehicle_id)
+
+
+def remaining_capacity(vehicle: models.Vehicle) -> Tuple[float, float]:
+    return (
+        (vehicle.weight_capacity or 0.0) - (vehicle.current_weight_used or 0.0),
+        (vehicle.volume_capacity or 0.0) - (vehicle.current_volume_used or 0.0),
+    )
+
+
+class _SortedKeys:
+    """
+    Keys in (weight, volume, id) order, split into sorted buckets of BUCKET_SIZE to
+    2 * BUCKET_SIZE keys that each know their largest volume. add/discard bisect to
+    the bucket and insert into it; find bisects to the first key with enough weight and
+    skips whole buckets without enough volume, so every operation looks at
+    O(n / BUCKET_SIZE + BUCKET_SIZE) keys rather than every heavier vehicle.
+    """
+
+    def __init__(self):
+        self.buckets: List[List[Key]] = []
+        self.firsts: List[Key] = []  # first key of each bucket
+        self.max_volume: List[float] = []
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def _bucket_of(self, key: Key) -> int:
+        return max(bisect.bisect_right(self.firsts, key) - 1, 0)
+
+    def add(self, key: Key):
+        if not self.buckets:
+            self.buckets, self.firsts, self.max_volume = [[key]], [key], [key[1]]
+            return
+        b = self._bucket_of(key)
+        bucket = self.buckets[b]
+        bisect.insort(bucket, key)
+        self.firsts[b] = bucket[0]
+        self.max_volume[b] = max(self.max_volume[b], key[1])
+        if len(bucket) > 2 * BUCKET_SIZE:
+            upper = bucket[BUCKET_SIZE:]
+            del bucket[BUCKET_SIZE:]
+            self.buckets.insert(b + 1, upper)
+            self.firsts.insert(b + 1, upper[0])
+            self.max_volume[b] = max(k[1] for k in bucket)
+            self.max_volume.insert(b + 1, max(k[1] for k in upper))
+
+    def discard(self, key: Key):
+        if not self.buckets:
+            return
+        b = self._bucket_of(key)
+        bucket = self.buckets[b]
+        i = bisect.bisect_left(bucket, key)
+        if i == len(bucket) or bucket[i] != key:
+            return
+        del bucket[i]
+        if not bucket:
+            del self.buckets[b], self.firsts[b], self.max_volume[b]
+            return
+        self.firsts[b] = bucket[0]
+        if key[1] >= self.max_volume[b]:
+            self.max_volume[b] = max(k[1] for k in bucket)
+
+    def find(self, weight: float, volume: float, policy: str) -> Optional[int]:
+        """Vehicle id that fits (weight, volume) under the policy, or None."""
+        if not self.buckets:
+            return None
+        lowest = (weight, float("-inf"), -1)
+        first = self._bucket_of(lowest)
+        start = bisect.bisect_left(self.buckets[first], lowest)
+        if policy == "worst_fit":
+            order = range(len(self.buckets) - 1, first - 1, -1)
+        else:
+            order = range(first, len(self.buckets))
+        for b in order:
+            if self.max_volume[b] < volume:
+                continue
+            bucket = self.buckets[b]
+            positions = range(start if b == first else 0, len(bucket))
+            for i in (reversed(positions) if policy == "worst_fit" else positions):
+                if bucket[i][1] >= volume:
+                    return bucket[i][2]
+        return None
+
+
+class CapacityIndex:
+    """AVAILABLE vehicles of one company, ordered by remaining capacity."""
+
+    def __init__(self, vehicles: List[models.Vehicle] = ()):
+        self._all = _SortedKeys()
+        self._by_zone: Dict[int, _SortedKeys] = {}
+        self._entries: Dict[int, Tuple[Key, Optional[int]]] = {}
+        self._versions: Dict[int, int] = {}
+        for vehicle in vehicles:
+            self.sync(vehicle)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, vehicle_id: int):
+        return vehicle_id in self._entries
+
+    def fits(self, vehicle_id: int, weight: float, volume: float) -> bool:
+        entry = self._entries.get(vehicle_id)
+        return entry is not None and entry[0][0] >= weight and entry[0][1] >= volume
+
+    def remove(self, vehicle_id: int):
+        entry = self._entries.pop(vehicle_id, None)
+        if entry is None:
+            return
+        key, zone_id = entry
+        self._all.discard(key)
+        if zone_id is not None:
+            self._by_zone[zone_id].discard(key)
+
+    def sync(self, vehicle: models.Vehicle):
+        """Insert, move or drop the vehicle's entry to match its current row."""
+        version = vehicle.version or 0
+        if version < self._versions.get(vehicle.id, -1):
+            return
+        self._versions[vehicle.id] = version
+        self.remove(vehicle.id)
+        if vehicle.status != models.VehicleStatus.AVAILABLE:
+            return
+        rem_w, rem_v = remaining_capacity(vehicle)
+        key = (rem_w, rem_v, vehicle.id)
+        self._entries[vehicle.id] = (key, vehicle.zone_id)
+        self._all.add(key)
+        if vehicle.zone_id is not None:
+            self._by_zone.setdefault(vehicle.zone_id, _SortedKeys()).add(key)
+
+    def select(self, weight: float, volume: float, policy: str = DEFAULT_POLICY, zone_id: Optional[int] = None) -> Optional[int]:
+        """Pick a vehicle for the load, preferring the zone and falling back to the whole fleet."""
+        if zone_id is not None and zone_id in self._by_zone:
+            vehicle_id = self._by_zone[zone_id].find(weight, volume, policy)
+            if vehicle_id is not None:
+                return vehicle_id
+        return self._all.find(weight, volume, policy)
+
@@ -0,0 +1,179 @@
+"""
+Checks for the routing building blocks, without a server or database:
+
+- road_network: RoadNetwork.route and .table on the sample graph against plain
+  Dijkstra over the uncontracted edges;
+- location_history: encode/decode round trip of varint segments;
+- routing: sequence_pickup_delivery keeps every drop after its pickup, the load within
+  capacity and (with TimeWindows) every stop inside its window.
+
+Run from backend/: python verify_routing.py
+"""
+import heapq
+import math
+import random
+
+import location_history
+import road_network
+import routing
+
+
+def dijkstra(adj, source):
+    """{node: seconds} over the plain graph."""
+    best = {source: 0.0}
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > best[u]:
+            continue
+        for v, w in adj[u].items():
+            if d + w < best.get(v, math.inf):
+                best[v] = d + w
+                heapq.heappush(heap, (d + w, v))
+    return best
+
+
+def check_road_network(queries=100, table_size=15):
+    graph = road_network.read_graph(road_network.SAMPLE_FILE)
+    network = road_network.RoadNetwork(graph["nodes"], graph["edges"])
+    index = {node_id: k for k, node_id in enumerate(network.ids)}
+    adj = [dict() for _ in network.ids]
+    for edge in graph["edges"]:
+        u, v = index[int(edge[0])], index[int(edge[1])]
+        if u == v:
+            continue
+        seconds = float(edge[2]) / ((float(edge[3]) or road_network.FALLBACK_SPEED_KMH) / 3.6)
+        for a, b in ([(u, v)] if len(edge) > 4 and edge[4] else [(u, v), (v, u)]):
+            adj[a][b] = min(adj[a].get(b, math.inf), seconds)
+
+    n = len(adj)
+    for _ in range(queries):
+        s, t = random.randrange(n), random.randrange(n)
+        expected = dijkstra(adj, s).get(t)
+        got = network.route(s, t)
+        if expected is None:
+            assert got is None, f"route({s}, {t}) = {got}, but {t} is unreachable"
+        else:
+            assert got is not None and math.isclose(got[0], expected, rel_tol=1e-9, abs_tol=1e-6), \
+                f"route({s}, {t}) = {got}, Dijkstra {expected:.3f} s"
+
+    sources = random.sample(range(n), table_size)
+    targets = random.sample(range(n), table_size)
+    seconds, _ = network.table(sources, targets)
+    for i, s in enumerate(sources):
+        reference = dijkstra(adj, s)
+        for j, t in enumerate(targets):
+            expected = reference.get(t, math.inf)
+            assert math.isclose(seconds[i][j], expected, rel_tol=1e-9, abs_tol=1e-6), \
+                f"table[{s}][{t}] = {seconds[i][j]:.3f} s, Dijkstra {expected:.3f} s"
+    print(f"road_network: {queries} routes and a {table_size}x{table_size} table match Dijkstra "
+          f"({network.stats()})")
+
+
+def check_history_codec(segments=200):
+    scale = location_history.SCALE
+    # Varint boundaries (7, 14, 28 bits and beyond) in every field, both signs
+    edge_deltas = [0, 1, -1, 63, -64, 64, -65, 8191, -8192, 8192, 2 ** 27, -(2 ** 27), 2 ** 35]
+    cases = [[], [(0, 0.0, 0.0)], [(1_700_000_000, -33.86785, 151.20732)]]
+    ts, lat, lng = 1_700_000_000, 1_290_000, 7_750_000
+    boundary = []
+    for delta in edge_deltas:
+        ts, lat, lng = ts + delta, lat - delta, lng + delta
+        boundary.append((ts, lat / scale, lng / scale))
+    cases.append(boundary)
+    for _ in range(segments):
+        ts = random.randint(1_600_000_000, 1_800_000_000)
+        lat, lng = random.randint(-90 * scale, 90 * scale), random.randint(-180 * scale, 180 * scale)
+        points = []
+        for _ in range(random.randint(1, 300)):
+            # Mostly GPS-sized steps, sometimes a jump or an out-of-order timestamp
+            ts += random.choice([random.randint(1, 30), random.randint(-60, 0), random.randint(0, 10 ** 6)])
+            lat += random.choice([random.randint(-50, 50), random.randint(-10 ** 6, 10 ** 6)])
+            lng += random.choice([random.randint(-50, 50), random.randint(-10 ** 6, 10 ** 6)])
+            points.append((ts, lat / scale, lng / scale))
+        cases.append(points)
+
+    total_points = total_bytes = 0
+    for points in cases:
+        data = location_history.encode(points)
+        decoded = location_history.decode(data)
+        expected = [(t, round(a * scale), round(b * scale)) for t, a, b in points]
+        assert [(t, round(a * scale), round(b * scale)) for t, a, b in decoded] == expected, \
+            f"round trip changed a segment of {len(points)} points"
+        total_points += len(points)
+        total_bytes += len(data)
+    print(f"location_history: {len(cases)} segments ({total_points} points, "
+          f"{total_bytes / max(total_points, 1):.1f} bytes/point) round-trip exactly")
+
+
+def _check_pd_result(result, n, loads, capacity, windows=None, matrix=None):
+    nodes = [2 * i + (kind == routing.DROP) for i, kind in result["stops"]]
+    assert sorted(nodes) == list(range(2 * n)), f"stops are not each pickup and drop once: {result['stops']}"
+    position = {node: k for k, node in enumerate(nodes)}
+    for i in range(n):
+        assert position[2 * i] < position[2 * i + 1], f"shipment {i} is dropped before its pickup"
+    w = v = 0.0
+    for node in nodes:
+        sign = -1 if node % 2 else 1
+        w += sign * loads[node // 2][0]
+        v += sign * loads[node // 2][1]
+        assert w <= capacity[0] + 1e-9 and v <= capacity[1] + 1e-9, \
+            f"load {w:.1f} kg / {v:.2f} m3 over capacity {capacity} at {result['stops']}"
+    if matrix is not None:
+        km = sum(matrix[nodes[k - 1]][nodes[k]] for k in range(1, len(nodes)))
+        assert math.isclose(result["distance_km"], round(km, 2), abs_tol=0.011), "distance_km does not match the legs"
+    if windows is not None:
+        assert result["schedule"] is not None, "no schedule returned under time windows"
+        for node, (_, departure) in zip(nodes, result["schedule"]):
+            start = departure - windows.service[node]
+            assert windows.earliest[node] - 1e-6 <= start <= windows.latest[node] + 1e-6, \
+                f"node {node} served at {start:.1f} min outside {windows.earliest[node]}-{windows.latest[node]}"
+
+
+def check_pickup_delivery(instances=100):
+    def point():
+        return 12.85 + random.random() * 0.3, 77.45 + random.random() * 0.3
+
+    missed = 0
+    for _ in range(instances):
+        n = random.randint(1, 12)
+        pickups = [point() for _ in range(n)]
+        drops = [point() for _ in range(n)]
+        loads = [(random.randint(1, 8) * 50.0, random.randint(1, 8) * 0.25) for _ in range(n)]
+        # Tight instances force drops in between pickups; every single load still fits
+        capacity = (max(w for w, _ in loads) + random.choice([0, 100, 10000]),
+                    max(v for _, v in loads) + random.choice([0.0, 0.5, 100.0]))
+        matrix = routing.distance_matrix([pt for i in range(n) for pt in (pickups[i], drops[i])])
+        result = routing.sequence_pickup_delivery(pickups, drops, loads, capacity, time_budget_ms=50, matrix=matrix)
+        _check_pd_result(result, n, loads, capacity, matrix=matrix)
+
+        # The same instance with windows around the schedule of that order (5 min service),
+        # so at least that order fits. The pre-search bounds must then find no conflict;
+        # the greedy construction may still dead-end (VRPTW feasibility is NP-hard).
+        order = [2 * i + (kind == routing.DROP) for i, kind in result["stops"]]
+        service = [5.0] * (2 * n)
+        schedule = routing.TimeWindows([(None, None)] * (2 * n), service).schedule(order, matrix)
+        arrival = {node: a for node, (a, _) in zip(order, schedule)}
+        windows = routing.TimeWindows(
+            [(max(arrival[node] - random.uniform(0, 30), 0.0), arrival[node] + random.uniform(0, 60))
+             for node in range(2 * n)],
+            service,
+        )
+        try:
+            timed = routing.sequence_pickup_delivery(pickups, drops, loads, capacity, time_budget_ms=50,
+                                                     matrix=matrix, windows=windows)
+        except routing.Infeasible as e:
+            assert not e.conflicts, f"feasible instance rejected with conflicts {e.conflicts}"
+            missed += 1
+            continue
+        _check_pd_result(timed, n, loads, capacity, windows=windows, matrix=matrix)
+    print(f"routing: {instances} pickup/delivery instances keep precedence and capacity, with and "
+          f"without time windows ({missed} feasible windowed instances not solved by the heuristic)")
+
+
+if __name__ == "__main__":
+    random.seed(7)
+    check_road_network()
+    check_history_codec()
+    check_pickup_delivery()
+    print("All routing checks passed")
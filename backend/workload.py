@@ -0,0 +1,125 @@
+"""
+Driver workload index.
+
+driver_workloads keeps one row per driver with the number of shipments in each
+active status plus a completed count. The shipment transitions (assign, pickup,
+in-transit, deliver, cancel) adjust it with a single UPDATE, so dispatch can find an
+idle driver with one indexed lookup on (company_id, active) instead of counting
+shipments per driver, and the driver analytics/dashboard read the counts directly.
+"""
+import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import select, update, delete, func, case
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+
+# Shipment status -> counter column. PENDING/CANCELLED are not counted.
+STATUS_COLUMNS = {
+    models.ShipmentStatus.ASSIGNED: "assigned",
+    models.ShipmentStatus.PICKED_UP: "picked_up",
+    models.ShipmentStatus.IN_TRANSIT: "in_transit",
+    models.ShipmentStatus.DELIVERED: "completed",
+    models.ShipmentStatus.CONFIRMED: "completed",
+}
+ACTIVE_COLUMNS = ("assigned", "picked_up", "in_transit")
+
+
+async def record_transition(db: AsyncSession, driver_id: Optional[int], old_status, new_status, count: int = 1):
+    """Move `count` shipments of `driver_id` from `old_status` to `new_status` in the counters."""
+    if not driver_id or count <= 0:
+        return
+    old_col, new_col = STATUS_COLUMNS.get(old_status), STATUS_COLUMNS.get(new_status)
+    if old_col == new_col:
+        return
+
+    W = models.DriverWorkload
+    values = {}
+    if old_col:
+        column = getattr(W, old_col)
+        values[column] = case((column > count, column - count), else_=0)
+    if new_col:
+        values[getattr(W, new_col)] = getattr(W, new_col) + count
+    active_delta = (new_col in ACTIVE_COLUMNS) - (old_col in ACTIVE_COLUMNS)
+    if active_delta > 0:
+        values[W.active] = W.active + count
+    elif active_delta < 0:
+        values[W.active] = case((W.active > count, W.active - count), else_=0)
+    values[W.updated_at] = datetime.datetime.utcnow()
+
+    result = await db.execute(update(W).where(W.driver_id == driver_id).values(values))
+    if result.rowcount == 0:
+        row = await _new_row(db, driver_id)
+        if new_col:
+            setattr(row, new_col, count)
+        row.active = count if new_col in ACTIVE_COLUMNS else 0
+        db.add(row)
+
+
+async def ensure_driver_row(db: AsyncSession, driver: models.User):
+    """Create an empty workload row for a newly created driver."""
+    db.add(models.DriverWorkload(driver_id=driver.id, company_id=driver.company_id))
+
+
+async def _new_row(db: AsyncSession, driver_id: int) -> models.DriverWorkload:
+    company_res = await db.execute(select(models.User.company_id).where(models.User.id == driver_id))
+    return models.DriverWorkload(
+        driver_id=driver_id, company_id=company_res.scalar(),
+        assigned=0, picked_up=0, in_transit=0, active=0, completed=0,
+    )
+
+
+def _idle_query(company_id: Optional[int], exclude: Iterable[int]):
+    W = models.DriverWorkload
+    query = select(W.driver_id).where(W.company_id == company_id, W.active == 0)
+    exclude = list(exclude)
+    if exclude:
+        query = query.where(W.driver_id.notin_(exclude))
+    return query.order_by(W.driver_id)
+
+
+async def pick_idle_driver(db: AsyncSession, company_id: Optional[int], exclude: Iterable[int] = ()) -> Optional[int]:
+    """Lowest-id driver in the company with no active shipments."""
+    result = await db.execute(_idle_query(company_id, exclude).limit(1))
+    return result.scalar()
+
+
+async def idle_drivers(db: AsyncSession, company_id: Optional[int], exclude: Iterable[int] = ()) -> list:
+    """All idle drivers in the company, lowest id first."""
+    result = await db.execute(_idle_query(company_id, exclude))
+    return [r[0] for r in result.fetchall()]
+
+
+async def get_workload(db: AsyncSession, driver_id: int) -> Optional[models.DriverWorkload]:
+    result = await db.execute(select(models.DriverWorkload).where(models.DriverWorkload.driver_id == driver_id))
+    return result.scalars().first()
+
+
+async def rebuild_driver_workloads(db: AsyncSession):
+    """Recompute every driver's counters from the shipments table (run at startup)."""
+    W = models.DriverWorkload
+    drivers = await db.execute(
+        select(models.User.id, models.User.company_id).where(models.User.role == models.UserRole.DRIVER)
+    )
+    rows = {
+        driver_id: W(driver_id=driver_id, company_id=company_id,
+                     assigned=0, picked_up=0, in_transit=0, active=0, completed=0)
+        for driver_id, company_id in drivers.fetchall()
+    }
+    counts = await db.execute(
+        select(models.Shipment.assigned_driver_id, models.Shipment.status, func.count(models.Shipment.id))
+        .where(models.Shipment.assigned_driver_id.isnot(None))
+        .group_by(models.Shipment.assigned_driver_id, models.Shipment.status)
+    )
+    for driver_id, status, count in counts.fetchall():
+        row, col = rows.get(driver_id), STATUS_COLUMNS.get(status)
+        if row is None or col is None:
+            continue
+        setattr(row, col, getattr(row, col) + count)
+        if col in ACTIVE_COLUMNS:
+            row.active += count
+
+    await db.execute(delete(W))
+    db.add_all(rows.values())
+    await db.commit()
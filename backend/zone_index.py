@@ -0,0 +1,110 @@
+"""
+Spatial index for zone matching.
+
+Zones store their boundary as a list of [lng, lat] points in Zone.coordinates.
+Instead of ray-casting a point against every zone on each request, each company
+gets an STRtree over its active zone polygons (bounding-box prefilter) plus
+prepared geometries for the exact containment test. The index is built lazily
+and rebuilt whenever a zone is created, updated or deleted.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from shapely import STRtree
+from shapely.geometry import Point, Polygon
+from shapely.prepared import prep
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import models
+
+
+def zone_polygon(coordinates) -> Optional[Polygon]:
+    """Build a shapely polygon from stored zone coordinates ([lng, lat] ring or GeoJSON)."""
+    if not coordinates:
+        return None
+    if isinstance(coordinates, dict):
+        coordinates = (coordinates.get("coordinates") or [None])[0]
+        if not coordinates:
+            return None
+    # Accept a list of rings as well as a bare ring
+    if isinstance(coordinates[0], (list, tuple)) and coordinates[0] and isinstance(coordinates[0][0], (list, tuple)):
+        coordinates = coordinates[0]
+    if len(coordinates) < 3:
+        return None
+    try:
+        polygon = Polygon([(float(p[0]), float(p[1])) for p in coordinates])
+    except (TypeError, ValueError, IndexError):
+        return None
+    if not polygon.is_valid:
+        polygon = polygon.buffer(0)
+    return polygon if not polygon.is_empty else None
+
+
+class ZoneIndex:
+    """STRtree + prepared polygons for one company's active zones."""
+
+    def __init__(self, zones: List[models.Zone]):
+        self.zone_ids: List[int] = []
+        polygons = []
+        for zone in zones:
+            polygon = zone_polygon(zone.coordinates)
+            if polygon is None:
+                continue
+            self.zone_ids.append(zone.id)
+            polygons.append(polygon)
+        self._polygons = polygons
+        self._by_id = dict(zip(self.zone_ids, polygons))
+        self._prepared = [prep(p) for p in polygons]
+        self._tree = STRtree(polygons) if polygons else None
+
+    def __len__(self):
+        return len(self.zone_ids)
+
+    def match(self, lat: float, lng: float) -> Optional[int]:
+        """Return the id of the first (lowest id) zone containing the point."""
+        if self._tree is None:
+            return None
+        point = Point(lng, lat)
+        for i in sorted(self._tree.query(point)):
+            if self._prepared[i].contains(point):
+                return self.zone_ids[i]
+        return None
+
+    def centroid(self, zone_id: Optional[int]) -> Optional[Tuple[float, float]]:
+        """(lat, lng) centroid of the zone polygon, or None."""
+        polygon = self._by_id.get(zone_id)
+        if polygon is None:
+            return None
+        point = polygon.centroid
+        return point.y, point.x
+
+
+# company_id -> ZoneIndex (None key covers users without a company, who see all zones)
+_indexes: Dict[Optional[int], ZoneIndex] = {}
+
+
+async def get_zone_index(db: AsyncSession, company_id: Optional[int]) -> ZoneIndex:
+    index = _indexes.get(company_id)
+    if index is None:
+        query = select(models.Zone).where(models.Zone.status == models.ZoneStatus.ACTIVE).order_by(models.Zone.id)
+        if company_id:
+            query = query.where(models.Zone.company_id == company_id)
+        result = await db.execute(query)
+        index = ZoneIndex(result.scalars().all())
+        _indexes[company_id] = index
+    return index
+
+
+async def rebuild_zone_index(db: AsyncSession, company_id: Optional[int]) -> ZoneIndex:
+    """Drop and rebuild the company's index. Call after committing a zone change."""
+    _indexes.pop(company_id, None)
+    _indexes.pop(None, None)
+    return await get_zone_index(db, company_id)
+
+
+async def match_zone(db: AsyncSession, company_id: Optional[int], lat: Optional[float], lng: Optional[float]) -> Optional[int]:
+    """Zone id containing (lat, lng) for the company, or None."""
+    if lat is None or lng is None:
+        return None
+    index = await get_zone_index(db, company_id)
+    return index.match(lat, lng)